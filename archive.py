@@ -0,0 +1,249 @@
+"""
+Archival compaction for generated_tests.
+
+Most tests are never opened again once graded, yet their test_data JSON
+stays in the hot database forever. The compaction job moves test_data of
+tests past the retention policy into a separate archive database next to
+each shard (mindcraftr.archive.db, mindcraftr.shard0.archive.db, ...),
+zlib-compressed, and leaves a stub row (test_data '' and archived_at set)
+behind. load_test() reads either transparently. Afterwards the freed pages
+are handed back to the filesystem with PRAGMA incremental_vacuum, a few
+pages at a time. Shards created before incremental auto-vacuum are skipped
+for that step until converted, which rewrites the whole file with VACUUM
+and so must run with the server stopped:
+
+    python archive.py convert
+
+Retention policy (environment):
+  MINDCRAFTR_ARCHIVE_AFTER_DAYS           graded tests older than this (default 30)
+  MINDCRAFTR_ARCHIVE_UNGRADED_AFTER_DAYS  any test older than this (default 90)
+
+    python archive.py compact
+    python archive.py compact --older-than 7
+    python archive.py status
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import database
+import metrics
+
+ARCHIVE_AFTER_DAYS = float(os.environ.get('MINDCRAFTR_ARCHIVE_AFTER_DAYS', 30))
+UNGRADED_AFTER_DAYS = float(os.environ.get('MINDCRAFTR_ARCHIVE_UNGRADED_AFTER_DAYS', 90))
+BATCH_SIZE = 500
+# Only one process compacts a shard at a time; a dead run's claim lapses after this
+RUN_LEASE_SECONDS = 3600
+# Free pages handed back per incremental_vacuum statement, so each holds the write lock briefly
+VACUUM_PAGES = 1000
+INCREMENTAL = 2
+
+
+def archive_path(shard_file):
+    root, ext = os.path.splitext(shard_file)
+    return f"{root}.archive{ext or '.db'}"
+
+
+def _connect_archive(path):
+    conn = sqlite3.connect(path, factory=database.TimedConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archived_tests (
+            test_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            test_data BLOB NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS compaction_runs (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT,
+            expires_at REAL
+        )
+    ''')
+    conn.commit()
+    return conn
+
+
+def load_test(user_id, test_id, deflate=False):
+    """
+    A generated test's stored JSON as (body, content encoding), from the live
+    row or the archive, or None if the user has no such test. With deflate,
+    archived bodies are returned still compressed, encoded 'deflate'.
+    """
+    conn = database.get_db_connection(user_id)
+    database.ensure_table(conn, database.add_generated_tests_columns)
+    row = conn.execute('SELECT test_data, archived_at FROM generated_tests WHERE test_id = ? AND user_id = ?',
+                       (test_id, user_id)).fetchone()
+    shard_file = conn.path
+    conn.close()
+    if row is None:
+        return None
+    if row['archived_at'] is None:
+        return row['test_data'].encode(), None
+    archive = _connect_archive(archive_path(shard_file))
+    stored = archive.execute('SELECT test_data FROM archived_tests WHERE test_id = ?', (test_id,)).fetchone()
+    archive.close()
+    if stored is None:
+        raise LookupError(f'Test {test_id} is marked archived but missing from the archive')
+    metrics.archived_tests.inc(event='loaded')
+    if deflate:
+        return stored['test_data'], 'deflate'
+    return zlib.decompress(stored['test_data']), None
+
+
+def _claim_run(archive, owner):
+    now = time.time()
+    archive.execute('INSERT OR IGNORE INTO compaction_runs (id, owner, expires_at) VALUES (1, NULL, 0)')
+    cursor = archive.execute('UPDATE compaction_runs SET owner = ?, expires_at = ? WHERE id = 1 AND expires_at < ?',
+                             (owner, now + RUN_LEASE_SECONDS, now))
+    archive.commit()
+    return cursor.rowcount == 1
+
+
+def _release_run(archive, owner):
+    archive.execute('UPDATE compaction_runs SET expires_at = 0 WHERE id = 1 AND owner = ?', (owner,))
+    archive.commit()
+
+
+def _reclaim_space(conn):
+    """Hand free pages back to the filesystem in VACUUM_PAGES steps; a no-op until the file is converted"""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != INCREMENTAL:
+        return
+    while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+        # Each step frees one page per row it returns, so it must be read to the end
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+
+
+def convert():
+    """
+    Switch every shard to incremental auto-vacuum, rewriting files that are
+    not already in that mode with a full VACUUM. Exclusive and as slow as a
+    copy of the database: run it with the server stopped. Returns
+    {shard index: True if converted, False if it already was}.
+    """
+    converted = {}
+    for index in range(database.SHARD_COUNT):
+        conn = database.get_shard_connection(index)
+        converted[index] = conn.execute('PRAGMA auto_vacuum').fetchone()[0] != INCREMENTAL
+        if converted[index]:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        conn.close()
+    return converted
+
+
+def compact_shard(index, archive_after_days=ARCHIVE_AFTER_DAYS, ungraded_after_days=UNGRADED_AFTER_DAYS):
+    """
+    Archive one shard's tests that are past the retention policy. Returns
+    (tests archived, bytes of test_data moved), or None if another process
+    is already compacting the shard.
+    """
+    conn = database.get_shard_connection(index)
+    database.ensure_table(conn, database.add_generated_tests_columns)
+    # Adds test_results.test_id on shards that never saved a result, and its index
+    database.ensure_table(conn, database.add_test_results_columns)
+    archive = _connect_archive(archive_path(conn.path))
+    owner = f"{os.getpid()}:{time.time()}"
+    if not _claim_run(archive, owner):
+        archive.close()
+        conn.close()
+        return None
+    archived = moved = 0
+    try:
+        while True:
+            rows = conn.execute('''
+                SELECT g.test_id, g.user_id, g.created_at, g.test_data FROM generated_tests g
+                WHERE g.archived_at IS NULL
+                  AND ((g.created_at < datetime('now', ?)
+                        AND EXISTS (SELECT 1 FROM test_results r WHERE r.test_id = g.test_id))
+                       OR g.created_at < datetime('now', ?))
+                LIMIT ?
+            ''', (f'-{archive_after_days} days', f'-{ungraded_after_days} days', BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            # The archive copy is committed before the stub, so a crash in between only repeats work
+            archive.executemany('''
+                INSERT OR REPLACE INTO archived_tests (test_id, user_id, created_at, test_data)
+                VALUES (?, ?, ?, ?)
+            ''', [(row['test_id'], row['user_id'], row['created_at'], zlib.compress(row['test_data'].encode(), 6))
+                  for row in rows])
+            archive.commit()
+            conn.executemany("UPDATE generated_tests SET test_data = '', archived_at = CURRENT_TIMESTAMP "
+                             "WHERE test_id = ?", [(row['test_id'],) for row in rows])
+            conn.commit()
+            archived += len(rows)
+            metrics.archived_tests.inc(len(rows), event='archived')
+            moved += sum(len(row['test_data']) for row in rows)
+        if archived:
+            _reclaim_space(conn)
+    finally:
+        _release_run(archive, owner)
+        archive.close()
+        conn.close()
+    return archived, moved
+
+
+def compact(archive_after_days=ARCHIVE_AFTER_DAYS, ungraded_after_days=UNGRADED_AFTER_DAYS):
+    """Run compaction on every shard; returns {shard index: (archived, bytes) or None}"""
+    return {index: compact_shard(index, archive_after_days, ungraded_after_days)
+            for index in range(database.SHARD_COUNT)}
+
+
+def status():
+    """Live vs archived test counts and file sizes per shard"""
+    report = {}
+    for index in range(database.SHARD_COUNT):
+        conn = database.get_shard_connection(index)
+        database.ensure_table(conn, database.add_generated_tests_columns)
+        live, archived = conn.execute('''
+            SELECT SUM(archived_at IS NULL), SUM(archived_at IS NOT NULL) FROM generated_tests
+        ''').fetchone()
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        path = conn.path
+        conn.close()
+        report[index] = {
+            "file": path,
+            "liveTests": live or 0,
+            "archivedTests": archived or 0,
+            "fileBytes": os.path.getsize(path),
+            "freePages": free_pages,
+            "incrementalVacuum": auto_vacuum == INCREMENTAL,
+            "archiveBytes": os.path.getsize(archive_path(path)) if os.path.exists(archive_path(path)) else 0
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old generated tests')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('compact', help='Archive tests past the retention policy')
+    run.add_argument('--older-than', type=float, help='Archive graded tests older than this many days '
+                     '(default: MINDCRAFTR_ARCHIVE_AFTER_DAYS)')
+    commands.add_parser('status', help='Live and archived tests per shard')
+    commands.add_parser('convert', help='Switch shards to incremental auto-vacuum (server stopped)')
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        older_than = args.older_than if args.older_than is not None else ARCHIVE_AFTER_DAYS
+        for index, result in compact(older_than, max(older_than, UNGRADED_AFTER_DAYS)).items():
+            if result is None:
+                print(f"⏭️  shard {index}: skipped, another compaction is running")
+            else:
+                print(f"✅ shard {index}: archived {result[0]} tests ({result[1]} bytes of test data)")
+    elif args.command == 'convert':
+        for index, converted in convert().items():
+            print(f"✅ shard {index}: {'converted' if converted else 'already incremental'}")
+    else:
+        print(json.dumps(status(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+API token authentication.
+
+Clients send `Authorization: Bearer <token>`. Tokens are random strings
+stored only as SHA-256 hashes in the api_tokens table of the main database,
+each belonging to one user. Lookups are cached in-process for
+TOKEN_CACHE_SECONDS, so a revoked token may keep working that long in
+other workers.
+
+    python auth.py create-user "Ada Lovelace" ada@example.com
+    python auth.py issue-token 2 --label laptop
+    python auth.py revoke-token <token>
+"""
+
+import argparse
+import hashlib
+import secrets
+import threading
+import time
+
+import database
+
+TOKEN_CACHE_SECONDS = 60
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _connect():
+    conn = database.get_db_connection()
+    database.ensure_table(conn, database.create_api_tokens_table)
+    return conn
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def user_for_token(token):
+    """User id a token belongs to, or None if it is unknown or revoked"""
+    if not token:
+        return None
+    digest = token_hash(token)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(digest)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    conn = _connect()
+    row = conn.execute('SELECT user_id FROM api_tokens WHERE token_hash = ? AND revoked_at IS NULL',
+                       (digest,)).fetchone()
+    conn.close()
+    user_id = row['user_id'] if row else None
+    with _cache_lock:
+        if len(_cache) > 10000:
+            _cache.clear()
+        _cache[digest] = (user_id, now + TOKEN_CACHE_SECONDS)
+    return user_id
+
+
+def create_user(name, email):
+    """Add a user to the main database's users table; returns the new id"""
+    conn = _connect()
+    cursor = conn.execute('INSERT INTO users (name, email) VALUES (?, ?)', (name, email))
+    conn.commit()
+    user_id = cursor.lastrowid
+    conn.close()
+    return user_id
+
+
+def issue_token(user_id, label=None):
+    """Create a token for user_id; the plain token is only ever returned here"""
+    token = secrets.token_urlsafe(32)
+    conn = _connect()
+    if conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is None:
+        conn.close()
+        raise ValueError(f'No user with id {user_id}')
+    conn.execute('INSERT INTO api_tokens (token_hash, user_id, label) VALUES (?, ?, ?)',
+                 (token_hash(token), user_id, label))
+    conn.commit()
+    conn.close()
+    return token
+
+
+def revoke_token(token):
+    """Revoke a token; returns False if it was unknown or already revoked"""
+    digest = token_hash(token)
+    conn = _connect()
+    cursor = conn.execute('UPDATE api_tokens SET revoked_at = CURRENT_TIMESTAMP '
+                          'WHERE token_hash = ? AND revoked_at IS NULL', (digest,))
+    conn.commit()
+    conn.close()
+    with _cache_lock:
+        _cache.pop(digest, None)
+    return cursor.rowcount == 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage MindCraftr users and API tokens')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create-user', help='Add a user')
+    create.add_argument('name')
+    create.add_argument('email')
+    issue = commands.add_parser('issue-token', help='Issue an API token for a user')
+    issue.add_argument('user_id', type=int)
+    issue.add_argument('--label', help='What the token is for')
+    revoke = commands.add_parser('revoke-token', help='Revoke an API token')
+    revoke.add_argument('token')
+    args = parser.parse_args()
+
+    if args.command == 'create-user':
+        print(f"✅ Created user {create_user(args.name, args.email)}")
+    elif args.command == 'issue-token':
+        print(issue_token(args.user_id, args.label))
+    elif not revoke_token(args.token):
+        raise SystemExit('❌ Unknown or already revoked token')
+    else:
+        print('✅ Token revoked')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+"""
+Load and latency benchmark for the MindCraftr API.
+
+Starts the Flask app and a fake Opus API on local ports, seeds a scratch
+SQLite database, then drives a scenario at a fixed concurrency and reports
+throughput and p50/p95/p99 latency per route, plus mean bytes on the wire
+(request and response) and server CPU time per request.
+
+Usage:
+    python benchmark.py                                  # all scenarios
+    python benchmark.py --scenario dashboard -c 16 -n 2000
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json --threshold 0.15
+    python benchmark.py --scenario large-test --encoding identity --explanation-words 40
+    python benchmark.py --scenario large-test --encoding gzip --gzip-requests --explanation-words 40
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+import requests
+from werkzeug.serving import make_server
+
+import database
+from fake_opus import FakeOpusServer
+from opus_service import OpusClient
+
+API = '/api/v1'
+
+GENERATE_PAYLOAD = {
+    "examType": "custom",
+    "examName": "Benchmark Exam",
+    "numQuestions": 10,
+    "questionFormat": "objective",
+    "syllabusContent": "React Hooks, Context API, useEffect, useState",
+    "difficulty": "standard"
+}
+
+# An endurance exam: many questions, long explanations with --explanation-words
+LARGE_TEST_PAYLOAD = dict(GENERATE_PAYLOAD, examName="Endurance Exam", numQuestions=150)
+
+SYLLABUS_TEXT = "React Hooks\n\nuseState and useEffect, dependency arrays, cleanup.\n\nContext API and reducers.\n" * 20
+
+# Numbers the varied request bodies of a whole run, so no two scenarios repeat one
+_variant = itertools.count(1)
+
+
+def varied_generation(base):
+    """
+    A body factory for generate requests with a syllabus no earlier request
+    used, so each one misses the question bank and reaches Opus
+    """
+    def body():
+        return dict(base, syllabusContent=f"{base['syllabusContent']}, unit {next(_variant)}")
+    return body
+
+
+def varied_submission(base):
+    """
+    A body factory for submissions of base's test with different answers and
+    duration each time, so none is answered from a reused grading
+    """
+    questions = base['fullTestContext']['questions']
+
+    def body():
+        n = next(_variant)
+        answers = {}
+        for position, question in enumerate(questions):
+            options = [option['id'] for option in question.get('options') or []]
+            if options and (n >> position) & 1:
+                answers[question['id']] = options[(n + position) % len(options)]
+            else:
+                answers[question['id']] = question['correctAnswer']
+        return dict(base, answers=answers, durationSeconds=base['durationSeconds'] + n)
+    return body
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, errors, elapsed, bytes_in=(), bytes_out=(), cpu=()):
+    """
+    Summarize a list of latencies (seconds) into a JSON-friendly dict, with
+    the mean request/response bytes and server CPU seconds per request
+    """
+    ordered = sorted(latencies)
+    count = len(ordered)
+
+    def mean(values, scale=1, digits=1):
+        return round(sum(values) / len(values) * scale, digits) if values else 0.0
+
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "mean_ms": round(sum(ordered) / count * 1000, 3) if count else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if count else 0.0,
+        "bytes_in": mean(bytes_in),
+        "bytes_out": mean(bytes_out),
+        "cpu_ms": mean(cpu, 1000, 3)
+    }
+
+
+class CpuMeter:
+    """
+    WSGI wrapper that adds up the server thread CPU time spent on each
+    (method, path), including sending the body. The threaded dev server runs
+    every request on its own thread, so the thread clock isolates it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def __call__(self, environ, start_response):
+        key = (environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''))
+        started = time.thread_time()
+        result = self.app(environ, start_response)
+        try:
+            yield from result
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            with self._lock:
+                self._samples.setdefault(key, []).append(time.thread_time() - started)
+
+    def take(self):
+        """Return and reset the samples collected so far"""
+        with self._lock:
+            samples, self._samples = self._samples, {}
+        return samples
+
+
+class BenchmarkEnvironment:
+    """Scratch database, fake Opus and a threaded API server"""
+
+    def __init__(self, database_path=None, opus_latency=0.0, log_level='WARNING', opus_callbacks=False,
+                 explanation_words=0):
+        self._tmpdir = None
+        self.opus_callbacks = opus_callbacks
+        self.log_level = log_level.upper()
+        self.database_path = database_path
+        self.opus = FakeOpusServer(job_latency=opus_latency, explanation_words=explanation_words)
+        self.cpu = None
+        self._server = None
+        self._thread = None
+        self.fixtures = {}
+
+    def __enter__(self):
+        if self.database_path is None:
+            self._tmpdir = tempfile.TemporaryDirectory()
+            self.database_path = os.path.join(self._tmpdir.name, 'bench.db')
+            database.DATABASE_NAME = self.database_path
+            database.create_storage()
+        database.DATABASE_NAME = self.database_path
+
+        self.opus.start()
+        OpusClient.BASE_URL = self.opus.url
+
+        from server import app
+        # server.py configures DEBUG logging on import; quieten it for the run
+        for name in ('', 'werkzeug'):
+            logging.getLogger(name).setLevel(self.log_level)
+
+        self.cpu = CpuMeter(app)
+        self._server = make_server('127.0.0.1', 0, self.cpu, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        if self.opus_callbacks:
+            OpusClient.CALLBACK_URL = f"{self.base_url}{API}/opus/callback"
+
+        self._prepare_fixtures()
+        return self
+
+    def __exit__(self, *exc):
+        OpusClient.CALLBACK_URL = ''
+        self._server.shutdown()
+        self._thread.join()
+        self.opus.stop()
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.port}"
+
+    def _prepare_fixtures(self):
+        """Generate and grade one test and upload a syllabus so submit, results and report routes have data"""
+        test = requests.post(f"{self.base_url}{API}/tests/generate", json=GENERATE_PAYLOAD).json()
+        submission = {
+            "answers": {q['id']: q['correctAnswer'] for q in test['questions']},
+            "durationSeconds": 600,
+            "fullTestContext": test
+        }
+        requests.post(f"{self.base_url}{API}/tests/submit", json=submission).raise_for_status()
+        large = requests.post(f"{self.base_url}{API}/tests/generate", json=LARGE_TEST_PAYLOAD).json()
+        large_submission = {
+            "answers": {q['id']: q['correctAnswer'] for q in large['questions']},
+            "durationSeconds": 5400,
+            "fullTestContext": large
+        }
+        syllabus = requests.post(f"{self.base_url}{API}/syllabi?name=Benchmark", data=SYLLABUS_TEXT.encode(),
+                                 headers={'Content-Type': 'text/plain'}).json()
+        self.fixtures = {"test_id": test['id'], "test_name": test['name'], "submission": submission,
+                         "large_test_id": large['id'], "large_submission": large_submission,
+                         "syllabus_id": syllabus['id']}
+        self.cpu.take()
+
+
+def build_scenarios(fixtures):
+    """
+    Return {scenario: [(route_name, method, path, json_body), ...]}, where
+    json_body may also be a function returning a fresh body per request
+    """
+    test_name = quote(fixtures['test_name'])
+    generate = varied_generation(GENERATE_PAYLOAD)
+    submit = varied_submission(fixtures['submission'])
+    dashboard = [
+        ('GET /dashboard/stats', 'GET', f'{API}/dashboard/stats', None),
+        ('GET /dashboard/recommendations', 'GET', f'{API}/dashboard/recommendations', None),
+        ('GET /profile/stats', 'GET', f'{API}/profile/stats', None),
+        ('GET /profile/mastery', 'GET', f'{API}/profile/mastery', None),
+        ('GET /flashcards', 'GET', f'{API}/flashcards', None),
+    ]
+    aggregate = [('GET /dashboard', 'GET', f'{API}/dashboard', None)]
+    routes = dashboard + aggregate + [
+        ('GET /', 'GET', '/', None),
+        ('GET /topics/<id>/details', 'GET', f'{API}/topics/1/details', None),
+        ('GET /presets', 'GET', f'{API}/presets', None),
+        ('GET /tests/<id>', 'GET', f"{API}/tests/{fixtures['test_id']}", None),
+        ('GET /tests/<id>/results', 'GET', f"{API}/tests/{fixtures['test_id']}/results", None),
+        ('GET /profile/trends', 'GET', f'{API}/profile/trends', None),
+        ('GET /percentiles', 'GET', f'{API}/percentiles?testName={test_name}&score=70', None),
+        ('GET /syllabi', 'GET', f'{API}/syllabi', None),
+        ('GET /syllabi/<id>', 'GET', f"{API}/syllabi/{fixtures['syllabus_id']}", None),
+        ('GET /reports/items', 'GET', f'{API}/reports/items?testName={test_name}', None),
+        ('POST /tests/generate', 'POST', f'{API}/tests/generate', generate),
+        ('POST /tests/generate/stream', 'POST', f'{API}/tests/generate/stream', generate),
+        ('POST /tests/submit', 'POST', f'{API}/tests/submit', submit),
+    ]
+    return {
+        'dashboard': dashboard,
+        'dashboard-aggregate': aggregate,
+        'routes': routes,
+        'generate': [('POST /tests/generate', 'POST', f'{API}/tests/generate', generate)],
+        'submit': [('POST /tests/submit', 'POST', f'{API}/tests/submit', submit)],
+        'large-test': [
+            ('GET /tests/<id> (large)', 'GET', f"{API}/tests/{fixtures['large_test_id']}", None),
+            ('POST /tests/submit (large)', 'POST', f'{API}/tests/submit',
+             varied_submission(fixtures['large_submission'])),
+        ],
+    }
+
+
+def run_scenario(base_url, mix, concurrency, total_requests, encoding='gzip', gzip_requests=False, cpu=None):
+    """
+    Drive `total_requests` through the route mix with `concurrency` workers,
+    accepting responses in `encoding` and optionally gzipping request bodies
+    """
+    local = threading.local()
+    samples = {name: [] for name, _, _, _ in mix}
+    errors = {name: 0 for name, _, _, _ in mix}
+    sizes = {name: ([], []) for name, _, _, _ in mix}
+    lock = threading.Lock()
+    def encode(body):
+        data = json.dumps(body).encode() if body is not None else None
+        return gzip.compress(data) if data is not None and gzip_requests else data
+
+    # Serialize (and compress) fixed bodies once; varied ones per request, but
+    # always outside the timed section
+    bodies = {name: body if callable(body) else encode(body) for name, _, _, body in mix}
+    headers = {'Content-Type': 'application/json'}
+    if gzip_requests:
+        headers['Content-Encoding'] = 'gzip'
+
+    def one(index):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.headers['Accept-Encoding'] = encoding
+        name, method, path, _ = mix[index % len(mix)]
+        data = bodies[name]
+        if callable(data):
+            data = encode(data())
+        start = time.perf_counter()
+        try:
+            response = session.request(method, base_url + path, data=data,
+                                       headers=headers if data is not None else None)
+            failed = response.status_code >= 400
+            # Content-Length is the size on the wire, before requests decodes the body
+            wire = int(response.headers.get('Content-Length', len(response.content)))
+        except requests.RequestException:
+            failed, wire = True, 0
+        latency = time.perf_counter() - start
+        with lock:
+            samples[name].append(latency)
+            sizes[name][0].append(len(data) if data else 0)
+            sizes[name][1].append(wire)
+            if failed:
+                errors[name] += 1
+
+    if cpu is not None:
+        cpu.take()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    cpu_samples = cpu.take() if cpu is not None else {}
+    route_cpu = {name: cpu_samples.get((method, path.split('?')[0]), []) for name, method, path, _ in mix}
+    all_latencies = [lat for values in samples.values() for lat in values]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "total": summarize(all_latencies, sum(errors.values()), elapsed,
+                           [n for sent, _ in sizes.values() for n in sent],
+                           [n for _, received in sizes.values() for n in received],
+                           [t for values in cpu_samples.values() for t in values]),
+        "routes": {name: summarize(samples[name], errors[name], elapsed, sizes[name][0], sizes[name][1], route_cpu[name])
+                   for name in samples}
+    }
+
+
+def compare(current, baseline, threshold):
+    """Return a list of human readable regressions beyond `threshold`"""
+    regressions = []
+    for scenario, result in current['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(scenario)
+        if not base:
+            continue
+        pairs = [('total', result['total'], base['total'])]
+        pairs += [(route, stats, base['routes'][route])
+                  for route, stats in result['routes'].items() if route in base.get('routes', {})]
+        for label, now, before in pairs:
+            if before['p95_ms'] and now['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                regressions.append(f"{scenario} / {label}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+            if before['throughput_rps'] and now['throughput_rps'] < before['throughput_rps'] * (1 - threshold):
+                regressions.append(
+                    f"{scenario} / {label}: throughput {before['throughput_rps']} -> {now['throughput_rps']} req/s")
+    return regressions
+
+
+def print_report(report):
+    for scenario, result in report['scenarios'].items():
+        print(f"\n📊 {scenario} ({result['elapsed_s']}s)")
+        print(f"   {'route':<34}{'reqs':>7}{'err':>5}{'req/s':>10}{'p50':>9}{'p95':>9}{'p99':>9}"
+              f"{'KB in':>9}{'KB out':>9}{'cpu ms':>9}")
+        rows = list(result['routes'].items()) + [('TOTAL', result['total'])]
+        for name, s in rows:
+            print(f"   {name:<34}{s['requests']:>7}{s['errors']:>5}{s['throughput_rps']:>10}"
+                  f"{s['p50_ms']:>9}{s['p95_ms']:>9}{s['p99_ms']:>9}"
+                  f"{s.get('bytes_in', 0) / 1024:>9.1f}{s.get('bytes_out', 0) / 1024:>9.1f}{s.get('cpu_ms', 0):>9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MindCraftr API load and latency benchmark')
+    parser.add_argument('--scenario', action='append',
+                        choices=['dashboard', 'dashboard-aggregate', 'routes', 'generate', 'submit', 'large-test'],
+                        help='Scenario to run (repeatable, default: all)')
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-n', '--requests', type=int, default=500,
+                        help='Requests per scenario')
+    parser.add_argument('--database', help='Existing SQLite file to run against (default: seeded scratch copy)')
+    parser.add_argument('--opus-latency', type=float, default=0.0,
+                        help='Seconds each fake Opus job stays in progress')
+    parser.add_argument('--opus-callbacks', action='store_true',
+                        help='Have the fake Opus post completion callbacks instead of relying on polling')
+    parser.add_argument('--explanation-words', type=int, default=0,
+                        help='Pad fake Opus explanations by this many phrases (large-test payload size)')
+    parser.add_argument('--encoding', choices=['identity', 'gzip', 'br'], default='gzip',
+                        help='Accept-Encoding sent with every request (default gzip)')
+    parser.add_argument('--gzip-requests', action='store_true', help='Send request bodies gzip-compressed')
+    parser.add_argument('--output', help='Write results JSON to this path')
+    parser.add_argument('--compare', help='Baseline results JSON to check against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Allowed fractional regression in p95 and throughput (default 0.10)')
+    parser.add_argument('--log-level', default='WARNING', help='Server log level during the run')
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or ['dashboard', 'dashboard-aggregate', 'routes', 'generate', 'submit', 'large-test']
+
+    with BenchmarkEnvironment(args.database, args.opus_latency, args.log_level, args.opus_callbacks,
+                              args.explanation_words) as env:
+        mixes = build_scenarios(env.fixtures)
+        report = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(timespec='seconds'),
+                "python": platform.python_version(),
+                "concurrency": args.concurrency,
+                "requests_per_scenario": args.requests,
+                "opus_latency_s": args.opus_latency,
+                "opus_callbacks": args.opus_callbacks,
+                "encoding": args.encoding,
+                "gzip_requests": args.gzip_requests,
+                "explanation_words": args.explanation_words
+            },
+            "scenarios": {}
+        }
+        for name in scenarios:
+            print(f"🏃 Running {name} scenario...")
+            report['scenarios'][name] = run_scenario(env.base_url, mixes[name], args.concurrency, args.requests,
+                                                     args.encoding, args.gzip_requests, env.cpu)
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"   {line}")
+            return 1
+        print(f"\n✅ No regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
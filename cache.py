@@ -0,0 +1,106 @@
+"""Bounded in-process LRU cache for serialized read responses"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('MINDCRAFTR_CACHE_MAX_ENTRIES', 2048))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('MINDCRAFTR_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get('MINDCRAFTR_CACHE_TTL', 300))
+
+
+class ResponseCache:
+    """
+    LRU cache of response bodies keyed by user and request path.
+
+    Each entry is tagged with the tables it was built from so write paths
+    can drop exactly the entries they affect via invalidate(). Entries also
+    expire after `ttl` seconds, and the cache is bounded both by entry count
+    and by total body bytes.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] <= now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['value']
+
+    def set(self, key, value, size, user_id, tables=()):
+        """Store value, evicting least recently used entries to stay in bounds"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                'value': value,
+                'size': size,
+                'user_id': user_id,
+                'tables': frozenset(tables),
+                'expires': time.monotonic() + self.ttl
+            }
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, user_id, *tables):
+        """Drop every entry for user_id built from any of the given tables"""
+        tables = set(tables)
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if entry['user_id'] == user_id and entry['tables'] & tables]
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxEntries": self.max_entries,
+                "maxBytes": self.max_bytes,
+                "ttlSeconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+
+
+response_cache = ResponseCache()
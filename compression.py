@@ -0,0 +1,170 @@
+"""
+HTTP compression for the Flask app.
+
+Responses with a JSON or text body of at least MINDCRAFTR_COMPRESS_MIN_BYTES
+are compressed for clients that accept it: brotli when the optional
+`brotli` package is installed and preferred by the client, gzip otherwise.
+Streamed responses (Server-Sent Events) and responses that already carry a
+Content-Encoding are left alone. Request bodies sent with
+`Content-Encoding: gzip` are decoded before the view sees them. Settings:
+
+    MINDCRAFTR_COMPRESS               set to 0 to disable response compression (default 1)
+    MINDCRAFTR_COMPRESS_MIN_BYTES     smallest body worth compressing (default 1024)
+    MINDCRAFTR_GZIP_LEVEL             zlib level 1-9 (default 6)
+    MINDCRAFTR_BROTLI_QUALITY         brotli quality 0-11 (default 4)
+    MINDCRAFTR_MAX_REQUEST_BYTES      largest decoded request body (default 16 MiB)
+"""
+
+import gzip
+import io
+import logging
+import os
+import time
+import zlib
+
+from flask import jsonify, request
+from werkzeug.wsgi import get_input_stream
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESS = os.environ.get('MINDCRAFTR_COMPRESS', '1') != '0'
+COMPRESS_MIN_BYTES = int(os.environ.get('MINDCRAFTR_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('MINDCRAFTR_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('MINDCRAFTR_BROTLI_QUALITY', 4))
+MAX_REQUEST_BYTES = int(os.environ.get('MINDCRAFTR_MAX_REQUEST_BYTES', 16 * 1024 * 1024))
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain', 'text/csv')
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+_READ_CHUNK = 64 * 1024
+
+
+class RequestTooLarge(ValueError):
+    pass
+
+
+def negotiate(accept_encodings=None):
+    """Encoding to use for the current request's response, or None for identity"""
+    if not COMPRESS:
+        return None
+    accepted = accept_encodings if accept_encodings is not None else request.accept_encodings
+    return accepted.best_match(ENCODINGS)
+
+
+def compress(data, encoding):
+    """Compress bytes with one of ENCODINGS"""
+    started = time.perf_counter()
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        # mtime=0 keeps the output identical for identical bodies
+        compressed = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    metrics.compression_seconds.observe(time.perf_counter() - started, encoding=encoding)
+    metrics.compressed_bytes.inc(len(data), encoding=encoding, stage='raw')
+    metrics.compressed_bytes.inc(len(compressed), encoding=encoding, stage='wire')
+    return compressed
+
+
+def compressible(response):
+    """Whether a response's body may be compressed (its size is checked separately)"""
+    return (response.status_code in (200, 201)
+            and response.mimetype in COMPRESSIBLE_TYPES
+            and not response.is_streamed
+            and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers)
+
+
+def encode_cached(response, encoded):
+    """
+    Compress a response rebuilt from a cached body, reusing (and filling)
+    the entry's {encoding: bytes} dict so each encoding is computed once.
+    """
+    if not compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+        return response
+    if encoding not in encoded:
+        encoded[encoding] = compress(data, encoding)
+    response.set_data(encoded[encoding])
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def gunzip_limited(stream, limit):
+    """Decode a gzip stream, refusing output larger than limit bytes"""
+    decoder = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    out = io.BytesIO()
+    while True:
+        chunk = stream.read(_READ_CHUNK)
+        if not chunk:
+            break
+        while chunk:
+            out.write(decoder.decompress(chunk, limit + 1 - out.tell()))
+            if out.tell() > limit:
+                raise RequestTooLarge(f'Decoded body exceeds {limit} bytes')
+            chunk = decoder.unconsumed_tail
+    out.write(decoder.flush())
+    if not decoder.eof:
+        raise zlib.error('Truncated gzip body')
+    if out.tell() > limit:
+        raise RequestTooLarge(f'Decoded body exceeds {limit} bytes')
+    return out.getvalue()
+
+
+def init_compression(app):
+    """Register request decoding and response compression on app"""
+
+    @app.before_request
+    def decode_request_body():
+        encoding = request.headers.get('Content-Encoding', '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return
+        if encoding != 'gzip':
+            return jsonify({"error": "Unsupported Content-Encoding", "message": "Only gzip request bodies are accepted"}), 415
+        environ = request.environ
+        try:
+            body = gunzip_limited(get_input_stream(environ), MAX_REQUEST_BYTES)
+        except RequestTooLarge as e:
+            return jsonify({"error": "Request body too large", "message": str(e)}), 413
+        except (OSError, EOFError, zlib.error) as e:
+            return jsonify({"error": "Invalid gzip body", "message": str(e)}), 400
+        # The view reads the decoded body as if it had been sent uncompressed
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ.pop('HTTP_CONTENT_ENCODING', None)
+        for cached in ('stream', 'content_length'):
+            request.__dict__.pop(cached, None)
+
+    if not COMPRESS:
+        return
+    logger.info(f'🗜️ Response compression enabled: {", ".join(ENCODINGS)} above {COMPRESS_MIN_BYTES} bytes')
+
+    # Registered before the app's own hooks, so it runs after them on the final response
+    @app.after_request
+    def compress_response(response):
+        if not compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate()
+        if encoding is None or request.method == 'HEAD':
+            return response
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        # A strong validator must change with the representation's bytes
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -1,16 +1,190 @@
 import sqlite3
 import os
+import queue
+import re
+import threading
+import time
+import zlib
+
+from metrics import db_query_seconds
 
 DATABASE_NAME = 'mindcraftr.db'
 
-def get_db_connection():
+# User data can be spread over several SQLite files ("shards") picked by a
+# hash of the user id, so writes for different users don't queue on one
+# file lock. The main database (DATABASE_NAME) keeps the tables shared by
+# all users; with a single shard (the default) it holds everything.
+SHARD_COUNT = max(1, int(os.environ.get('MINDCRAFTR_DB_SHARDS', 1)))
+POOL_SIZE = int(os.environ.get('MINDCRAFTR_DB_POOL_SIZE', 8))
+
+# Tables whose rows belong to one user and live in that user's shard
+SHARDED_TABLES = ('test_results', 'recommended_topics', 'flashcards', 'topic_mastery',
+                  'generated_tests', 'idempotency_keys', 'daily_scores',
+                  'user_syllabi', 'item_responses')
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+
+def _observe_query(sql, started, operation=None):
+    """Record a statement's latency labelled by operation and main table"""
+    if operation is None:
+        words = sql.split(None, 1)
+        operation = words[0].upper() if words else ''
+    match = _STATEMENT_TABLE.search(sql)
+    db_query_seconds.observe(time.perf_counter() - started,
+                             operation=operation, table=match.group(1) if match else '')
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement latency in the metrics registry"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe_query(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe_query(sql, started)
+
+    def executescript(self, sql_script):
+        # A script is timed as a whole, labelled by the first table it names
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _observe_query(sql_script, started, operation='SCRIPT')
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors and execute shortcuts are timed"""
+
+    path = None
+    _pool = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def close(self):
+        # Pooled connections go back to their pool instead of closing
+        if self._pool is not None:
+            self._pool.release(self)
+        else:
+            super().close()
+
+
+class ConnectionPool:
     """
-    Establishes a connection to the SQLite database.
+    Idle connections to one database file, reused across requests.
+    
+    acquire() never blocks: when no idle connection is left a new one is
+    opened, and at most `size` are kept once they are given back.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=max(0, size))
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, factory=TimedConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.path = self.path
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        conn._pool = self
+        return conn
+
+    def release(self, conn):
+        conn._pool = None
+        try:
+            # Don't hand an open transaction to the next user
+            conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_for(path):
+    # Keyed by pid too: connections must not be shared with forked workers
+    key = (os.getpid(), path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, ConnectionPool(path))
+    return pool
+
+
+def shard_for(user_id, shards=None):
+    """Index of the shard holding a user's data"""
+    return zlib.crc32(str(user_id).encode()) % (shards or SHARD_COUNT)
+
+
+def shard_path(index, shards=None):
+    """Database file for a shard; a single shard is the main database itself"""
+    if (shards or SHARD_COUNT) == 1:
+        return DATABASE_NAME
+    root, ext = os.path.splitext(DATABASE_NAME)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def shard_paths(shards=None):
+    return [shard_path(index, shards) for index in range(shards or SHARD_COUNT)]
+
+
+def get_db_connection(user_id=None):
+    """
+    Returns a pooled connection to the SQLite database: the main database,
+    or the shard holding user_id's data when one is given.
     Sets row_factory to sqlite3.Row to access columns by name.
+    close() returns the connection to its pool.
+    """
+    path = DATABASE_NAME if user_id is None else shard_path(shard_for(user_id))
+    return _pool_for(path).acquire()
+
+
+def get_shard_connection(index):
+    """Pooled connection to one shard, for work that spans all users"""
+    return _pool_for(shard_path(index)).acquire()
+
+_ensured_tables = set()
+_ensure_lock = threading.Lock()
+
+
+def ensure_table(conn, create):
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    Run create(conn) once per process and database file, so tables added
+    after an existing database was seeded are created on first use.
+    """
+    key = (getattr(conn, "path", None) or DATABASE_NAME, create.__name__)
+    if key in _ensured_tables:
+        return
+    with _ensure_lock:
+        if key not in _ensured_tables:
+            create(conn)
+            _ensured_tables.add(key)
 
 def create_tables(conn):
     """
@@ -95,13 +269,341 @@ def create_tables(conn):
             preset_duration TEXT,
             syllabus_content TEXT,
             test_data TEXT NOT NULL,
+            opus_inputs TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            archived_at TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_generated_tests_archive ON generated_tests (archived_at, created_at)')
+    
+    create_opus_jobs_table(conn)
+    create_opus_callbacks_table(conn)
+    create_idempotency_keys_table(conn)
+    create_question_bank_tables(conn)
+    create_prefetched_tests_table(conn)
+    create_api_tokens_table(conn)
+    create_daily_scores_table(conn)
+    create_score_histograms_table(conn)
+    create_syllabi_tables(conn)
+    create_user_syllabi_table(conn)
+    create_item_responses_table(conn)
     
     conn.commit()
 
+def add_generated_tests_columns(conn):
+    """
+    Adds generated_tests.opus_inputs and archived_at (and the archive index)
+    to databases created before they existed.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(generated_tests)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'opus_inputs' not in columns:
+        cursor.execute('ALTER TABLE generated_tests ADD COLUMN opus_inputs TEXT')
+    if 'archived_at' not in columns:
+        cursor.execute('ALTER TABLE generated_tests ADD COLUMN archived_at TIMESTAMP')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_generated_tests_archive ON generated_tests (archived_at, created_at)')
+    conn.commit()
+
+def add_test_results_columns(conn):
+    """
+    Adds the test_results columns saved with graded submissions (strengths,
+    weaknesses, ai_summary, test_id) to databases created before they
+    existed, and the index for looking results up by test.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(test_results)")
+    columns = [col[1] for col in cursor.fetchall()]
+    for column in ('strengths', 'weaknesses', 'ai_summary', 'test_id'):
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE test_results ADD COLUMN {column} TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_test_results_test ON test_results (test_id, user_id)')
+    conn.commit()
+
+def create_opus_jobs_table(conn):
+    """
+    Creates the Opus job ledger (see job_ledger.py) if it doesn't exist.
+    Times are unix seconds so heartbeats can be compared directly.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS opus_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            workflow_id TEXT NOT NULL,
+            input_hash TEXT NOT NULL,
+            job_execution_id TEXT,
+            status TEXT NOT NULL,
+            context TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            owner TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL,
+            persisted_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_opus_jobs_inputs ON opus_jobs (user_id, kind, input_hash)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_opus_jobs_status ON opus_jobs (status, heartbeat_at)')
+    conn.commit()
+
+def create_opus_callbacks_table(conn):
+    """
+    Creates the table of Opus completion callbacks if it doesn't exist.
+    Any worker may receive a callback; the one driving the job reads it here.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS opus_callbacks (
+            job_execution_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            received_at REAL NOT NULL
+        )
+    ''')
+    conn.commit()
+
+def create_idempotency_keys_table(conn):
+    """
+    Creates the Idempotency-Key store (see idempotency.py) if it doesn't exist.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status TEXT NOT NULL,
+            response_status INTEGER,
+            response_body BLOB,
+            content_type TEXT,
+            locked_until REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (user_id, idempotency_key),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expiry ON idempotency_keys (expires_at)')
+    conn.commit()
+
+def create_question_bank_tables(conn):
+    """
+    Creates the question bank (see question_bank.py) if it doesn't exist:
+    deduplicated questions from past generations, and which of them each
+    user has already been served.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS questions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content_hash TEXT UNIQUE NOT NULL,
+            topic TEXT NOT NULL,
+            syllabus_hash TEXT NOT NULL,
+            difficulty TEXT NOT NULL,
+            question_format TEXT NOT NULL,
+            question_type TEXT NOT NULL,
+            question_data TEXT NOT NULL,
+            source_test_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_questions_match
+        ON questions (topic, syllabus_hash, difficulty, question_format)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_questions_type ON questions (question_type)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_seen_questions (
+            user_id INTEGER NOT NULL,
+            question_id INTEGER NOT NULL,
+            seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, question_id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (question_id) REFERENCES questions(id)
+        ) WITHOUT ROWID
+    ''')
+    conn.commit()
+
+def create_prefetched_tests_table(conn):
+    """
+    Creates the store of speculative follow-up tests (see prefetch.py) if it doesn't exist.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS prefetched_tests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            request_hash TEXT NOT NULL,
+            source_test_id TEXT,
+            status TEXT NOT NULL,
+            test_data TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            served_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_prefetched_tests_lookup
+        ON prefetched_tests (user_id, request_hash, status)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_prefetched_tests_status ON prefetched_tests (status, expires_at)')
+    conn.commit()
+
+def create_syllabi_tables(conn):
+    """
+    Creates the uploaded syllabus tables (see syllabi.py) if they don't exist:
+    one row per distinct content hash, plus its chunk boundaries and summaries.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS syllabi (
+            id TEXT PRIMARY KEY,
+            size_bytes INTEGER NOT NULL,
+            chunk_count INTEGER NOT NULL,
+            prompt TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS syllabus_chunks (
+            syllabus_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            char_offset INTEGER NOT NULL,
+            char_length INTEGER NOT NULL,
+            summary TEXT NOT NULL,
+            PRIMARY KEY (syllabus_id, position),
+            FOREIGN KEY (syllabus_id) REFERENCES syllabi(id)
+        ) WITHOUT ROWID
+    ''')
+    conn.commit()
+
+def create_user_syllabi_table(conn):
+    """
+    Creates the per-user references to uploaded syllabi if it doesn't exist.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_syllabi (
+            user_id INTEGER NOT NULL,
+            syllabus_id TEXT NOT NULL,
+            name TEXT,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, syllabus_id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    conn.commit()
+
+def create_item_responses_table(conn):
+    """
+    Creates the per-question outcome table (see item_analysis.py) if it doesn't
+    exist: one row per graded submission, its answers packed column-wise.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS item_responses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            test_id TEXT,
+            cohort TEXT NOT NULL,
+            item_ids BLOB NOT NULL,
+            choices BLOB NOT NULL,
+            correct BLOB NOT NULL,
+            graded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_item_responses_cohort ON item_responses (cohort, id)')
+    conn.commit()
+
+def create_api_tokens_table(conn):
+    """
+    Creates the API token table (see auth.py) if it doesn't exist.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            label TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            revoked_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_tokens_user ON api_tokens (user_id)')
+    conn.commit()
+
+def create_daily_scores_table(conn):
+    """
+    Creates the per-user daily score rollups (see rollups.py) if they don't exist.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_scores (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            tests_taken INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            score_min INTEGER NOT NULL,
+            score_max INTEGER NOT NULL,
+            duration_seconds INTEGER NOT NULL,
+            questions_answered INTEGER NOT NULL,
+            total_questions INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        ) WITHOUT ROWID
+    ''')
+    conn.commit()
+
+def create_score_histograms_table(conn):
+    """
+    Creates the per-test-name score histograms (see percentiles.py) if they don't exist.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS score_histograms (
+            cohort TEXT PRIMARY KEY,
+            counts TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    conn.commit()
+
+def create_storage(seed=True):
+    """
+    Creates the tables in the main database and, when sharded, in every
+    shard, optionally seeding the demo user into the shard that owns it.
+    Expects files without tables (see seed.py).
+    """
+    main = sqlite3.connect(DATABASE_NAME)
+    # Must be set before the first table exists; lets archive.py hand freed pages back
+    main.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    create_tables(main)
+    if SHARD_COUNT == 1:
+        if seed:
+            seed_data(main)
+        main.close()
+        return
+    for index, path in enumerate(shard_paths()):
+        shard = sqlite3.connect(path)
+        shard.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        create_tables(shard)
+        if seed and index == shard_for(1):
+            seed_data(shard)
+            # The users directory lives in the main database
+            main.executemany('INSERT INTO users (id, name, email) VALUES (?, ?, ?)',
+                             shard.execute('SELECT id, name, email FROM users').fetchall())
+            main.commit()
+        shard.close()
+    main.close()
+
 def seed_data(conn):
     """
     Populates the database with initial test data.
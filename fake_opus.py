@@ -0,0 +1,224 @@
+"""Local fake of the Opus job API for benchmarks and offline development"""
+
+import json
+import random
+import threading
+import time
+import uuid
+import logging
+from typing import Dict, Any
+
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from opus_service import OpusClient, sign_callback
+
+logger = logging.getLogger(__name__)
+
+
+def _input_value(payload_schema: Dict[str, Any], name: str, default=None):
+    """Read a value from a jobPayloadSchemaInstance dict"""
+    entry = payload_schema.get(name)
+    if isinstance(entry, dict) and 'value' in entry:
+        return entry['value']
+    return default
+
+
+def _generation_results(payload_schema: Dict[str, Any], job_id: str = '', explanation_words: int = 0) -> Dict:
+    """
+    Build a generation result shaped like the real workflow output, with
+    questions unique to the job. explanation_words pads each explanation, to
+    mimic the long worked answers of endurance exams.
+    """
+    num_questions = int(_input_value(payload_schema, 'NUMBER_OF_QUESTIONS', 10))
+    exam_name = _input_value(payload_schema, 'EXAM_NAME', 'Custom Test')
+
+    questions = []
+    for i in range(num_questions):
+        options = [f"Choice {letter} for {exam_name} #{i + 1}" for letter in 'ABCD']
+        questions.append({
+            "type": "mcq",
+            "text": f"Question {i + 1} about {exam_name}? ({job_id[:8]})",
+            "options": options,
+            "correctAnswer": options[i % len(options)],
+            "explanation": f"Choice {'ABCD'[i % 4]} is the expected answer." + ''.join(
+                f" step{w} of the worked solution for {exam_name}" for w in range(explanation_words))
+        })
+
+    return {
+        "jobResultsPayloadSchema": {
+            "quiz_questions": {"display_name": "Quiz Questions", "value": questions}
+        }
+    }
+
+
+def _grading_results(payload_schema: Dict[str, Any]) -> Dict:
+    """Build a grading result by comparing answers with the reference"""
+    raw_sheet = _input_value(payload_schema, 'Answer sheet and grading reference', '{}')
+    try:
+        sheet = json.loads(raw_sheet) if isinstance(raw_sheet, str) else raw_sheet
+    except ValueError:
+        sheet = {}
+
+    answers = sheet.get('answers', {})
+    questions = sheet.get('fullTestContext', {}).get('questions', [])
+    correct = sum(1 for q in questions if answers.get(q.get('id')) == q.get('correctAnswer'))
+    total = len(questions)
+    score = int(correct / total * 100) if total else 0
+
+    def field(display_name, value):
+        return {"display_name": display_name, "value": value}
+
+    return {
+        "jobResultsPayloadSchema": {
+            "score": field("Score", score),
+            "total": field("Total Questions", total),
+            "correct": field("Correctly Answered", correct),
+            "strength": field("Strength", ["Consistent pacing"]),
+            "weakness": field("Weakness", ["Review incorrect answers"]),
+            "summary": field("AI Summary", f"You answered {correct} of {total} questions correctly.")
+        }
+    }
+
+
+def _post_callback(url: str, job_id: str, secret: str):
+    body = json.dumps({"jobExecutionId": job_id, "status": "COMPLETED"}).encode()
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Opus-Signature'] = sign_callback(secret, body)
+    try:
+        requests.post(url, data=body, headers=headers, timeout=10)
+    except requests.RequestException as e:
+        logger.warning(f"Callback to {url} failed: {e}")
+
+
+def create_fake_opus_app(job_latency: float = 0.0, callback_secret: str = '',
+                         callback_drop_rate: float = 0.0, explanation_words: int = 0) -> Flask:
+    """
+    Create a Flask app that mimics the Opus job endpoints used by OpusClient.
+
+    Jobs report IN_PROGRESS until `job_latency` seconds after execution,
+    then COMPLETED with results shaped like the real workflows. If execute
+    carried a callbackUrl, a signed completion callback is POSTed there when
+    the job completes, except for a `callback_drop_rate` fraction of jobs.
+    """
+    app = Flask('fake_opus')
+    jobs = {}
+    lock = threading.Lock()
+
+    @app.route('/workflow/<workflow_id>', methods=['GET'])
+    def workflow_details(workflow_id):
+        return jsonify({"workflowId": workflow_id, "jobPayloadSchema": {}})
+
+    @app.route('/job/initiate', methods=['POST'])
+    def initiate():
+        body = request.get_json() or {}
+        job_id = str(uuid.uuid4())
+        with lock:
+            jobs[job_id] = {"workflowId": body.get('workflowId'), "inputs": {}, "started_at": None}
+        return jsonify({"jobExecutionId": job_id})
+
+    @app.route('/job/execute', methods=['POST'])
+    def execute():
+        body = request.get_json() or {}
+        with lock:
+            job = jobs.get(body.get('jobExecutionId'))
+            if job is None:
+                return jsonify({"error": "Unknown job"}), 404
+            job['inputs'] = body.get('jobPayloadSchemaInstance', {})
+            job['started_at'] = time.time()
+        callback_url = body.get('callbackUrl')
+        if callback_url and random.random() >= callback_drop_rate:
+            def complete(job_id=body['jobExecutionId']):
+                if not jobs[job_id].get('cancelled'):
+                    _post_callback(callback_url, job_id, callback_secret)
+            timer = threading.Timer(job_latency, complete)
+            timer.daemon = True
+            timer.start()
+        return jsonify({"success": True})
+
+    @app.route('/job/<job_id>/status', methods=['GET'])
+    def status(job_id):
+        with lock:
+            job = jobs.get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        if job.get('cancelled'):
+            return jsonify({"status": "CANCELLED"})
+        if job['started_at'] is None:
+            return jsonify({"status": "PENDING"})
+        done = time.time() - job['started_at'] >= job_latency
+        return jsonify({"status": "COMPLETED" if done else "IN PROGRESS"})
+
+    @app.route('/job/<job_id>/cancel', methods=['POST'])
+    def cancel(job_id):
+        with lock:
+            job = jobs.get(job_id)
+            if job is None:
+                return jsonify({"error": "Unknown job"}), 404
+            job['cancelled'] = True
+        logger.info(f"Job {job_id} cancelled")
+        return jsonify({"success": True})
+
+    @app.route('/job/<job_id>/results', methods=['GET'])
+    def results(job_id):
+        with lock:
+            job = jobs.get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        if job['workflowId'] == OpusClient.GRADING_WORKFLOW_ID:
+            return jsonify(_grading_results(job['inputs']))
+        return jsonify(_generation_results(job['inputs'], job_id, explanation_words))
+
+    return app
+
+
+class FakeOpusServer:
+    """Runs the fake Opus app on a background thread"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, job_latency: float = 0.0,
+                 callback_secret: str = '', callback_drop_rate: float = 0.0, explanation_words: int = 0):
+        self.app = create_fake_opus_app(job_latency, callback_secret, callback_drop_rate, explanation_words)
+        self._server = make_server(host, port, self.app, threaded=True)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self._server.host}:{self._server.port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Fake Opus listening on {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a local fake Opus API')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--job-latency', type=float, default=0.0,
+                        help='Seconds a job stays IN PROGRESS before completing')
+    parser.add_argument('--callback-secret', default='',
+                        help='Sign completion callbacks with this secret (MINDCRAFTR_OPUS_CALLBACK_SECRET)')
+    parser.add_argument('--drop-callbacks', type=float, default=0.0,
+                        help='Fraction of completion callbacks to drop, to exercise the polling fallback')
+    parser.add_argument('--explanation-words', type=int, default=0,
+                        help='Pad each generated explanation by this many filler phrases')
+    args = parser.parse_args()
+
+    create_fake_opus_app(args.job_latency, args.callback_secret, args.drop_callbacks,
+                         args.explanation_words).run(port=args.port, threaded=True)
@@ -0,0 +1,97 @@
+"""
+Gunicorn settings for production serving.
+
+    gunicorn -c gunicorn.conf.py server:app
+
+Preforked worker processes, each with a thread pool, with the app preloaded
+in the master. All values can be overridden through MINDCRAFTR_* variables.
+"""
+
+import multiprocessing
+import os
+import signal
+import tempfile
+
+bind = os.environ.get('MINDCRAFTR_BIND', '0.0.0.0:5001')
+workers = int(os.environ.get('MINDCRAFTR_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('MINDCRAFTR_THREADS', 8))
+worker_class = 'gthread'
+preload_app = True
+
+# Threads kept free for fast read endpoints; the rest may run Opus-backed requests
+reserved_read_threads = int(os.environ.get('MINDCRAFTR_RESERVED_READ_THREADS', 2))
+
+# Opus jobs can wait up to 300s, so give in-flight requests that long to drain
+graceful_timeout = int(os.environ.get('MINDCRAFTR_GRACEFUL_TIMEOUT', 320))
+timeout = int(os.environ.get('MINDCRAFTR_WORKER_TIMEOUT', 60))
+keepalive = 5
+
+accesslog = os.environ.get('MINDCRAFTR_ACCESS_LOG', '-')
+loglevel = os.environ.get('MINDCRAFTR_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    # Runs in the master after the app is preloaded and before workers fork
+    from versions import resource_versions
+    from scheduler import opus_scheduler
+    import metrics
+    resource_versions.use_shared_memory()
+    opus_scheduler.use_shared_memory()
+    # Workers write their metrics here and every scrape merges them all
+    metrics.registry.use_directory(os.environ.get('MINDCRAFTR_METRICS_DIR')
+                                   or tempfile.mkdtemp(prefix='mindcraftr-metrics-'))
+
+
+def child_exit(server, worker):
+    # Give back Opus slots a worker still held when it died
+    from scheduler import opus_scheduler
+    import metrics
+    opus_scheduler.release_process(worker.pid)
+    metrics.registry.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    import server as app_module
+
+    app_module.limit_opus_requests(worker.cfg.threads - reserved_read_threads)
+    # Every worker scans for orphaned Opus jobs; the ledger lets only one claim each
+    app_module.start_job_resumer()
+    app_module.start_histogram_flusher()
+    app_module.start_metrics_flusher()
+    # Compaction runs are serialized per shard, so every worker can try
+    app_module.start_archiver()
+
+    # Flip readiness to "draining" as soon as the worker is told to stop
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(signum, frame):
+        app_module.begin_draining()
+        if callable(previous):
+            previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_exit(server, worker):
+    # Requests are drained by now; wait for any Opus jobs still running off-request
+    from opus_service import wait_for_active_jobs
+
+    remaining = wait_for_active_jobs(graceful_timeout)
+    if remaining:
+        worker.log.warning(f"Exiting with {remaining} Opus job(s) still running")
+
+    # Persist score histogram counts not flushed yet
+    from percentiles import score_histograms
+
+    try:
+        score_histograms.flush()
+    except Exception as e:
+        worker.log.warning(f"Score histogram flush failed: {e}")
+
+    # Last metrics snapshot, kept after exit so counters never go backwards
+    import metrics
+
+    try:
+        metrics.registry.flush()
+    except OSError as e:
+        worker.log.warning(f"Metrics flush failed: {e}")
@@ -0,0 +1,82 @@
+"""
+Storage for Idempotency-Key request deduplication.
+
+The first request with a given (user, key) claims a row in the "processing"
+state and holds it for up to a lease period. When it finishes, its response
+is stored and replayed to any retry with the same key until the row expires.
+A claim whose lease ran out (its process died) can be taken over.
+Keys are stored in the user's shard.
+"""
+
+import hashlib
+import time
+
+import database
+
+IN_PROGRESS = 'processing'
+COMPLETED = 'completed'
+
+
+def _connect(user_id):
+    conn = database.get_db_connection(user_id)
+    database.ensure_table(conn, database.create_idempotency_keys_table)
+    return conn
+
+
+def request_hash(method, path, body):
+    """Fingerprint of the request a key was first used with"""
+    digest = hashlib.sha256(f"{method} {path}\n".encode())
+    digest.update(body or b'')
+    return digest.hexdigest()
+
+
+def claim(user_id, key, hash_, lease_seconds, ttl_seconds):
+    """
+    Try to claim key for a new request.
+
+    Returns None if the claim succeeded (the caller should do the work),
+    otherwise the existing row.
+    """
+    now = time.time()
+    conn = _connect(user_id)
+    try:
+        conn.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+        # Take over claims whose owner stopped renewing them
+        conn.execute('''
+            DELETE FROM idempotency_keys
+            WHERE user_id = ? AND idempotency_key = ? AND status = ? AND locked_until < ?
+        ''', (user_id, key, IN_PROGRESS, now))
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO idempotency_keys
+            (user_id, idempotency_key, request_hash, status, locked_until, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, key, hash_, IN_PROGRESS, now + lease_seconds, now + ttl_seconds))
+        conn.commit()
+        if cursor.rowcount == 1:
+            return None
+        return conn.execute('SELECT * FROM idempotency_keys WHERE user_id = ? AND idempotency_key = ?',
+                            (user_id, key)).fetchone()
+    finally:
+        conn.close()
+
+
+def complete(user_id, key, status_code, body, content_type, ttl_seconds):
+    """Store the response for a claimed key"""
+    conn = _connect(user_id)
+    conn.execute('''
+        UPDATE idempotency_keys
+        SET status = ?, response_status = ?, response_body = ?, content_type = ?, expires_at = ?
+        WHERE user_id = ? AND idempotency_key = ?
+    ''', (COMPLETED, status_code, body, content_type, time.time() + ttl_seconds, user_id, key))
+    conn.commit()
+    conn.close()
+
+
+def release(user_id, key):
+    """Drop a claim without storing a response so the request can be retried"""
+    conn = _connect(user_id)
+    conn.execute('DELETE FROM idempotency_keys WHERE user_id = ? AND idempotency_key = ? AND status = ?',
+                 (user_id, key, IN_PROGRESS))
+    conn.commit()
+    conn.close()
+
@@ -0,0 +1,256 @@
+"""
+Item analysis over graded tests.
+
+When a submission is graded, its answers to question bank questions are
+stored as one item_responses row in the user's shard, column-wise: the
+bank ids as int64, the chosen option index as int8 (-1 unanswered, -2 a
+free-text answer) and whether each answer was correct as uint8. A report
+for a test name reads those blobs from every shard, joins them into flat
+NumPy arrays and computes each question's statistics with bincounts, with
+no per-answer Python loop:
+
+    pValue          share of answers that were correct (difficulty)
+    discrimination  point-biserial correlation between answering correctly
+                    and the rest of the submission's score (the item itself
+                    left out), from -1 to 1
+    options         how often each option was chosen (distractor frequencies)
+
+Reports are cached per test name and recomputed only when rows were added
+or removed for it in some shard. Only results graded since this table
+existed are included; earlier ones didn't keep their answers.
+
+    python item_analysis.py report "Biology"
+"""
+
+import argparse
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import database
+import percentiles
+from metrics import item_reports
+
+UNANSWERED = -1
+FREE_TEXT = -2
+
+REPORT_CACHE_SIZE = 64
+# SQLite's default limit on bound parameters is 999
+_ID_BATCH = 900
+
+_reports = OrderedDict()
+_reports_lock = threading.Lock()
+
+
+def ensure(conn):
+    database.ensure_table(conn, database.create_item_responses_table)
+
+
+def _norm(text):
+    return ' '.join(str(text or '').split()).lower()
+
+
+def encode(questions, answers):
+    """(item_ids, choices, correct) blobs for the bank questions of a submission, or None if it has none"""
+    item_ids, choices, correct = [], [], []
+    for question in questions:
+        if question.get('bankId') is None:
+            continue
+        answer = answers.get(question.get('id'))
+        options = [opt.get('id') for opt in question.get('options') or []]
+        if answer is None or answer == '':
+            choice = UNANSWERED
+        elif answer in options:
+            choice = options.index(answer)
+        else:
+            choice = FREE_TEXT
+        item_ids.append(question['bankId'])
+        choices.append(choice)
+        if options:
+            correct.append(answer == question.get('correctAnswer'))
+        else:
+            correct.append(choice != UNANSWERED and _norm(answer) == _norm(question.get('correctAnswer')))
+    if not item_ids:
+        return None
+    return (np.asarray(item_ids, dtype='<i8').tobytes(), np.asarray(choices, dtype=np.int8).tobytes(),
+            np.asarray(correct, dtype=np.uint8).tobytes())
+
+
+def record(conn, user_id, submission):
+    """Store a graded submission's answers; the caller ensures the table and commits"""
+    context = submission.get('fullTestContext', {})
+    encoded = encode(context.get('questions', []), submission.get('answers') or {})
+    if encoded is None:
+        return
+    conn.execute('INSERT INTO item_responses (user_id, test_id, cohort, item_ids, choices, correct) '
+                 'VALUES (?, ?, ?, ?, ?, ?)',
+                 (user_id, context.get('id'), percentiles.cohort(context.get('name', 'Test')), *encoded))
+
+
+def analyze(rows):
+    """
+    Per-item statistics for rows of (item_ids, choices, correct) blobs, as a
+    dict of arrays indexed like its "itemIds".
+    """
+    lengths = np.fromiter((len(row[2]) for row in rows), dtype=np.int64, count=len(rows))
+    item_ids = np.frombuffer(b''.join(row[0] for row in rows), dtype='<i8')
+    choices = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.int8).astype(np.int64)
+    correct = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.uint8).astype(np.float64)
+
+    keys, item = np.unique(item_ids, return_inverse=True)
+    item = item.reshape(-1)
+    count = len(keys)
+    responses = np.bincount(item, minlength=count)
+    right = np.bincount(item, weights=correct, minlength=count)
+
+    # Rest score: the share of the submission's other items answered correctly
+    submission = np.repeat(np.arange(len(rows)), lengths)
+    totals = np.bincount(submission, weights=correct, minlength=len(rows))
+    others = (lengths - 1)[submission]
+    scored = others > 0
+    x, y, at = correct[scored], (totals[submission] - correct)[scored] / others[scored], item[scored]
+    n = np.bincount(at, minlength=count).astype(np.float64)
+    sx = np.bincount(at, weights=x, minlength=count)
+    sy = np.bincount(at, weights=y, minlength=count)
+    syy = np.bincount(at, weights=y * y, minlength=count)
+    sxy = np.bincount(at, weights=x * y, minlength=count)
+    # x is 0/1, so the sum of its squares is sx
+    spread = (n * sx - sx ** 2) * (n * syy - sy ** 2)
+    discrimination = np.divide(n * sxy - sx * sy, np.sqrt(np.maximum(spread, 0)),
+                               out=np.full(count, np.nan), where=spread > 0)
+
+    width = int(choices.max()) + 1 if len(choices) else 0
+    chosen = choices >= 0
+    options = np.bincount(item[chosen] * width + choices[chosen],
+                          minlength=count * width).reshape(count, width) if width > 0 else np.zeros((count, 0))
+    return {
+        "itemIds": keys,
+        "responses": responses,
+        "pValue": right / np.maximum(responses, 1),
+        "discrimination": discrimination,
+        "options": options,
+        "unanswered": np.bincount(item, weights=choices == UNANSWERED, minlength=count),
+        "submissions": len(rows),
+    }
+
+
+def _questions(bank_ids):
+    """Bank question data by id"""
+    found = {}
+    conn = database.get_db_connection()
+    database.ensure_table(conn, database.create_question_bank_tables)
+    for start in range(0, len(bank_ids), _ID_BATCH):
+        batch = bank_ids[start:start + _ID_BATCH]
+        rows = conn.execute(f"SELECT id, question_data FROM questions WHERE id IN ({', '.join('?' * len(batch))})",
+                            batch)
+        found.update((row['id'], json.loads(row['question_data'])) for row in rows)
+    conn.close()
+    return found
+
+
+def _describe(stats):
+    """JSON-ready items from analyze() output, hardest first"""
+    bank_ids = [int(bank_id) for bank_id in stats['itemIds']]
+    questions = _questions(bank_ids)
+    items = []
+    for index, bank_id in enumerate(bank_ids):
+        question = questions.get(bank_id, {})
+        responses = int(stats['responses'][index])
+        counts = stats['options'][index]
+        discrimination = stats['discrimination'][index]
+        items.append({
+            "bankId": bank_id,
+            "text": question.get('text'),
+            "type": question.get('type'),
+            "responses": responses,
+            "pValue": round(float(stats['pValue'][index]), 3),
+            "discrimination": None if np.isnan(discrimination) else round(float(discrimination), 3),
+            "unanswered": int(stats['unanswered'][index]),
+            "options": [{
+                "id": option.get('id'),
+                "text": option.get('text'),
+                "correct": option.get('id') == question.get('correctAnswer'),
+                "count": int(counts[position]) if position < len(counts) else 0,
+                "share": round(float(counts[position]) / responses, 3) if position < len(counts) else 0.0
+            } for position, option in enumerate(question.get('options') or [])]
+        })
+    items.sort(key=lambda item: item['pValue'])
+    return items
+
+
+def _fingerprint(key):
+    """Changes whenever item_responses rows for a cohort are added or removed in any shard"""
+    parts = []
+    for index in range(database.SHARD_COUNT):
+        conn = database.get_shard_connection(index)
+        ensure(conn)
+        parts.append(tuple(conn.execute('SELECT COUNT(*), MAX(id) FROM item_responses WHERE cohort = ?',
+                                        (key,)).fetchone()))
+        conn.close()
+    return tuple(parts)
+
+
+def _load(key):
+    rows = []
+    for index in range(database.SHARD_COUNT):
+        conn = database.get_shard_connection(index)
+        ensure(conn)
+        rows.extend(tuple(row) for row in conn.execute(
+            'SELECT item_ids, choices, correct FROM item_responses WHERE cohort = ?', (key,)))
+        conn.close()
+    return rows
+
+
+def item_report(test_name):
+    """(submission count, items) for a test name, from the cache while no shard has new rows for it"""
+    key = percentiles.cohort(test_name)
+    fingerprint = _fingerprint(key)
+    with _reports_lock:
+        cached = _reports.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            _reports.move_to_end(key)
+            item_reports.inc(outcome='cached')
+            return cached[1]
+    rows = _load(key)
+    report = (len(rows), _describe(analyze(rows)) if rows else [])
+    item_reports.inc(outcome='computed')
+    with _reports_lock:
+        _reports[key] = (fingerprint, report)
+        _reports.move_to_end(key)
+        if len(_reports) > REPORT_CACHE_SIZE:
+            _reports.popitem(last=False)
+    return report
+
+
+def score_distribution(test_name):
+    """Score summary and 10-point histogram of every result for a test name"""
+    counts = np.asarray(percentiles.score_histograms.counts(test_name), dtype=np.int64)
+    total = int(counts.sum())
+    scores = np.arange(len(counts))
+    bands = np.add.reduceat(counts, np.arange(0, len(counts), 10))
+    summary = {"sampleSize": total, "mean": None, "stdDev": None,
+               "histogram": [{"from": 10 * band, "to": min(10 * band + 9, len(counts) - 1), "count": int(n)}
+                             for band, n in enumerate(bands)]}
+    if total:
+        mean = float((scores * counts).sum() / total)
+        summary['mean'] = round(mean, 1)
+        summary['stdDev'] = round(float(np.sqrt(((scores - mean) ** 2 * counts).sum() / total)), 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MindCraftr item analysis')
+    commands = parser.add_subparsers(dest='command', required=True)
+    report = commands.add_parser('report', help='Print the item report for a test name')
+    report.add_argument('test_name')
+    args = parser.parse_args()
+    submissions, items = item_report(args.test_name)
+    print(json.dumps({"submissions": submissions, "items": items,
+                      "scores": score_distribution(args.test_name)}, indent=2))
+    print(f"✅ {len(items)} items from {submissions} graded submissions")
+
+
+if __name__ == '__main__':
+    main()
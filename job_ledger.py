@@ -0,0 +1,239 @@
+"""
+Persistent ledger of Opus jobs.
+
+Every Opus job started by the API gets an opus_jobs row recording its kind,
+workflow, input hash, jobExecutionId and status, updated as the job moves
+through its phases. The process driving a job refreshes heartbeat_at on
+every phase and, through heartbeat(), on a timer in between (a single Opus
+call can block for longer than the stale window), so a row whose heartbeat
+has gone stale belongs to a process that died (restart, crash, OOM) and can
+be claimed and resumed by another.
+
+Statuses: pending -> initiated -> executing -> polling -> completed | failed | timeout | cancelled.
+A job is cancelled when its request's deadline passed or its client
+disconnected; the error column says which.
+persisted_at is set once the job's results have been saved to
+generated_tests / test_results.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import database
+
+ACTIVE_STATUSES = ('pending', 'initiated', 'executing', 'polling')
+
+
+# Callbacks are kept this long, well past any job's max_wait
+CALLBACK_RETENTION_SECONDS = 24 * 3600
+
+
+def _connect():
+    conn = database.get_db_connection()
+    database.ensure_table(conn, database.create_opus_jobs_table)
+    database.ensure_table(conn, database.create_opus_callbacks_table)
+    return conn
+
+
+def owner_id():
+    """Identifies the process driving a job (evaluated per call, so forked workers differ)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def input_hash(workflow_id, inputs):
+    """Stable hash of a workflow and its inputs"""
+    canonical = json.dumps({"workflow": workflow_id, "inputs": inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def create(user_id, kind, workflow_id, hash_, context):
+    """Record a new job before it is initiated; returns the ledger id"""
+    now = time.time()
+    conn = _connect()
+    cursor = conn.execute('''
+        INSERT INTO opus_jobs
+        (user_id, kind, workflow_id, input_hash, status, context, owner, created_at, updated_at, heartbeat_at)
+        VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?, ?)
+    ''', (user_id, kind, workflow_id, hash_, json.dumps(context), owner_id(), now, now, now))
+    conn.commit()
+    ledger_id = cursor.lastrowid
+    conn.close()
+    return ledger_id
+
+
+def update(ledger_id, status=None, job_execution_id=None, result=None, error=None):
+    """Advance a job's status and refresh its heartbeat"""
+    now = time.time()
+    conn = _connect()
+    conn.execute('''
+        UPDATE opus_jobs SET
+            status = COALESCE(?, status),
+            job_execution_id = COALESCE(?, job_execution_id),
+            result = COALESCE(?, result),
+            error = COALESCE(?, error),
+            updated_at = ?,
+            heartbeat_at = ?
+        WHERE id = ?
+    ''', (status, job_execution_id, json.dumps(result) if result is not None else None,
+          error, now, now, ledger_id))
+    conn.commit()
+    conn.close()
+
+
+def touch(ledger_id, owner):
+    """Refresh the heartbeat of a job owner still drives; False once it lost the job or the job ended"""
+    conn = _connect()
+    cursor = conn.execute(f'''
+        UPDATE opus_jobs SET heartbeat_at = ?
+        WHERE id = ? AND owner = ?
+          AND (status IN ({','.join('?' * len(ACTIVE_STATUSES))}) OR (status = 'completed' AND persisted_at IS NULL))
+    ''', (time.time(), ledger_id, owner, *ACTIVE_STATUSES))
+    conn.commit()
+    conn.close()
+    return cursor.rowcount == 1
+
+
+@contextmanager
+def heartbeat(ledger_id, interval):
+    """Refresh a job's heartbeat every interval seconds while the with-block drives it"""
+    owner = owner_id()
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                if not touch(ledger_id, owner):
+                    return
+            except sqlite3.Error:
+                # A busy database only delays this beat; the next one retries
+                continue
+
+    thread = threading.Thread(target=loop, daemon=True, name=f'opus-job-heartbeat-{ledger_id}')
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def phase_recorder(ledger_id, forward=None):
+    """
+    Build an on_phase callback for OpusClient that writes each phase to the
+    ledger, then forwards it to `forward` if given.
+    """
+    def on_phase(phase, **details):
+        if phase in ('initiated', 'executing', 'polling'):
+            update(ledger_id, status=phase, job_execution_id=details.get('jobId'))
+        if forward:
+            forward(phase, **details)
+    return on_phase
+
+
+def get(ledger_id):
+    conn = _connect()
+    row = conn.execute('SELECT * FROM opus_jobs WHERE id = ?', (ledger_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def find_duplicate(user_id, kind, hash_, stale_seconds, include_completed_within=0):
+    """
+    Return a job with the same inputs that a new request can reuse: one
+    still running (fresh heartbeat), or, if include_completed_within is set,
+    one that completed within that many seconds.
+    """
+    now = time.time()
+    conn = _connect()
+    row = conn.execute(f'''
+        SELECT * FROM opus_jobs
+        WHERE user_id = ? AND kind = ? AND input_hash = ?
+          AND ((status IN ({','.join('?' * len(ACTIVE_STATUSES))}) AND heartbeat_at >= ?)
+               OR (status = 'completed' AND updated_at >= ?))
+        ORDER BY id DESC LIMIT 1
+    ''', (user_id, kind, hash_, *ACTIVE_STATUSES, now - stale_seconds,
+          # A cutoff in the future matches no completed job
+          now - include_completed_within if include_completed_within else now + 1)).fetchone()
+    conn.close()
+    return row
+
+
+def wait_for(ledger_id, timeout, interval=0.5):
+    """Block until a job leaves the active statuses (or timeout); returns its row"""
+    deadline = time.time() + timeout
+    while True:
+        row = get(ledger_id)
+        if row is None or row['status'] not in ACTIVE_STATUSES or time.time() >= deadline:
+            return row
+        time.sleep(interval)
+
+
+def claim_persist(ledger_id):
+    """Mark a completed job's results as saved; False if another process already did"""
+    conn = _connect()
+    cursor = conn.execute('UPDATE opus_jobs SET persisted_at = ? WHERE id = ? AND persisted_at IS NULL',
+                          (time.time(), ledger_id))
+    conn.commit()
+    conn.close()
+    return cursor.rowcount == 1
+
+
+def release_persist(ledger_id):
+    """Undo claim_persist() after a failed save so the job is retried"""
+    conn = _connect()
+    conn.execute('UPDATE opus_jobs SET persisted_at = NULL WHERE id = ?', (ledger_id,))
+    conn.commit()
+    conn.close()
+
+
+def claim_orphans(stale_seconds, max_age):
+    """
+    Take ownership of jobs whose driving process has gone away: still active
+    or completed-but-unsaved, with a heartbeat older than stale_seconds and
+    created within max_age seconds. Returns the claimed rows.
+    """
+    now = time.time()
+    me = owner_id()
+    conn = _connect()
+    candidates = conn.execute(f'''
+        SELECT id, heartbeat_at FROM opus_jobs
+        WHERE (status IN ({','.join('?' * len(ACTIVE_STATUSES))})
+               OR (status = 'completed' AND persisted_at IS NULL))
+          AND heartbeat_at < ? AND created_at >= ?
+    ''', (*ACTIVE_STATUSES, now - stale_seconds, now - max_age)).fetchall()
+
+    claimed = []
+    for candidate in candidates:
+        # Compare-and-set on the heartbeat so only one process wins each job
+        cursor = conn.execute('UPDATE opus_jobs SET owner = ?, heartbeat_at = ? WHERE id = ? AND heartbeat_at = ?',
+                              (me, now, candidate['id'], candidate['heartbeat_at']))
+        if cursor.rowcount == 1:
+            claimed.append(candidate['id'])
+    conn.commit()
+    rows = [conn.execute('SELECT * FROM opus_jobs WHERE id = ?', (ledger_id,)).fetchone() for ledger_id in claimed]
+    conn.close()
+    return rows
+
+
+def record_callback(job_execution_id, status):
+    """Store a completion callback so whichever process drives the job can see it"""
+    now = time.time()
+    conn = _connect()
+    conn.execute('DELETE FROM opus_callbacks WHERE received_at < ?', (now - CALLBACK_RETENTION_SECONDS,))
+    conn.execute('INSERT OR REPLACE INTO opus_callbacks (job_execution_id, status, received_at) VALUES (?, ?, ?)',
+                 (job_execution_id, status, now))
+    conn.commit()
+    conn.close()
+
+
+def callback_status(job_execution_id):
+    """Status from the latest callback for a job, or None"""
+    conn = _connect()
+    row = conn.execute('SELECT status FROM opus_callbacks WHERE job_execution_id = ?', (job_execution_id,)).fetchone()
+    conn.close()
+    return row['status'] if row else None
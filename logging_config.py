@@ -0,0 +1,149 @@
+"""
+Logging setup for the MindCraftr API.
+
+Records are handed to a bounded queue and written by a background listener
+thread, so request threads never block on terminal or file I/O. Settings
+come from the environment:
+
+    MINDCRAFTR_LOG_LEVEL        root level (default INFO)
+    MINDCRAFTR_LOG_LEVELS       per-logger levels, e.g. "opus_service=DEBUG,werkzeug=WARNING"
+    MINDCRAFTR_LOG_FORMAT       "text" (default) or "json"
+    MINDCRAFTR_LOG_SAMPLE_RATE  fraction of requests whose request/response lines are logged (default 1.0)
+    MINDCRAFTR_LOG_MAX_PAYLOAD  characters kept when logging payloads (default 512)
+    MINDCRAFTR_LOG_QUEUE_SIZE   records buffered before new ones are dropped (default 10000)
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get('MINDCRAFTR_LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('MINDCRAFTR_LOG_LEVELS', '')
+LOG_FORMAT = os.environ.get('MINDCRAFTR_LOG_FORMAT', 'text').lower()
+LOG_SAMPLE_RATE = float(os.environ.get('MINDCRAFTR_LOG_SAMPLE_RATE', 1.0))
+LOG_MAX_PAYLOAD = int(os.environ.get('MINDCRAFTR_LOG_MAX_PAYLOAD', 512))
+LOG_QUEUE_SIZE = int(os.environ.get('MINDCRAFTR_LOG_QUEUE_SIZE', 10000))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, including any `extra` fields"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_text or record.exc_info:
+            entry["exc"] = record.exc_text or self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Resolve the message and traceback now (args may be mutated later),
+        # but leave the final formatting to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+class Truncated:
+    """
+    Lazy, length-capped string form of a payload for log arguments.
+
+    Nothing is formatted unless the record is actually emitted:
+        logger.debug('Request body: %s', Truncated(data))
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = LOG_MAX_PAYLOAD if limit is None else limit
+
+    def __str__(self):
+        return truncate(self.value, self.limit)
+
+
+def truncate(value, limit=None):
+    """Return str(value) cut to `limit` characters with a note of what was dropped"""
+    limit = LOG_MAX_PAYLOAD if limit is None else limit
+    text = value if isinstance(value, str) else str(value)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}… (+{len(text) - limit} chars)"
+
+
+def sample_request():
+    """Decide whether this request's request/response lines should be logged"""
+    return LOG_SAMPLE_RATE >= 1.0 or random.random() < LOG_SAMPLE_RATE
+
+
+_listener = None
+_queue_handler = None
+
+
+def _start_listener(output_handler):
+    global _listener
+    _queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def configure_logging():
+    """Install the queue-based handler on the root logger (idempotent)"""
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    for item in filter(None, (part.strip() for part in LOG_LEVELS.split(','))):
+        name, _, level = item.partition('=')
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _start_listener(output)
+    atexit.register(lambda: _listener.stop())
+
+    # The listener thread does not survive fork (gunicorn preload); start a
+    # fresh queue and listener in each child
+    os.register_at_fork(after_in_child=lambda: _start_listener(output))
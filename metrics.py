@@ -0,0 +1,355 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Counters, gauges and histograms are keyed by label values and rendered by
+render() for the /metrics endpoint. Under gunicorn, use_directory() in the
+master makes every worker write its values to <pid>.json in a shared
+directory (every FLUSH_SECONDS, and at each scrape it answers); render()
+merges all the files, so any worker's scrape covers the whole server.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# How often each worker writes its values for the others to merge
+FLUSH_SECONDS = float(os.environ.get('MINDCRAFTR_METRICS_FLUSH_SECONDS', 5))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        """This process's values in a JSON-ready form"""
+        return [[list(key), value] for key, value in self.items()]
+
+    def merge(self, snapshots):
+        """Items combined from several processes' snapshots, summing values per label set"""
+        merged = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(key)
+                merged[key] = merged.get(key, 0) + value
+        return list(merged.items())
+
+    def render(self, items=None):
+        if items is None:
+            items = self.items()
+        return self.header() + [
+            f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}' for key, value in items
+        ]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down. Across processes values are summed, or
+    with merge='max' the largest is taken (for values that are already
+    server-wide, so every process reports the same one).
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), function=None, merge='sum'):
+        super().__init__(name, help_text, labels)
+        self._function = function
+        self._merge = merge
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def items(self):
+        if self._function is not None:
+            return [((), self._function())]
+        return super().items()
+
+    def merge(self, snapshots):
+        if self._merge != 'max':
+            return super().merge(snapshots)
+        merged = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(key)
+                merged[key] = max(merged.get(key, value), value)
+        return list(merged.items())
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][i] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def items(self):
+        with self._lock:
+            return [(key, {'counts': list(e['counts']), 'sum': e['sum'], 'count': e['count']})
+                    for key, e in self._values.items()]
+
+    def merge(self, snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for key, entry in snapshot:
+                # Skip entries written with a different bucket layout
+                if len(entry['counts']) != len(self.buckets):
+                    continue
+                key = tuple(key)
+                total = merged.setdefault(key, {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                total['counts'] = [a + b for a, b in zip(total['counts'], entry['counts'])]
+                total['sum'] += entry['sum']
+                total['count'] += entry['count']
+        return list(merged.items())
+
+    def render(self, items=None):
+        if items is None:
+            items = self.items()
+        lines = self.header()
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry['counts']):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, [("le", _format_value(float(bound)))])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, [("le", "+Inf")])} {entry["count"]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(entry["sum"])}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {entry["count"]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.directory = None
+
+    def use_directory(self, path):
+        """
+        Share metrics between preforked workers through files in path.
+
+        Call in the master before workers fork. Files left by a previous run
+        are removed. What the master recorded while preloading stays in its
+        own file, and forked children start from zero, so nothing is counted
+        twice.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith('.json'):
+                os.unlink(os.path.join(path, name))
+        self.directory = path
+        self.flush()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _all(self):
+        with self._lock:
+            return list(self._metrics)
+
+    def _reset(self):
+        for metric in self._all():
+            metric.reset()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def flush(self):
+        """Write this process's values to the shared directory, if one is in use"""
+        if self.directory is None:
+            return
+        with self._flush_lock:
+            snapshot = {metric.name: metric.snapshot() for metric in self._all()}
+            path = self._path(os.getpid())
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(f'{path}.tmp', path)
+
+    def mark_process_dead(self, pid):
+        """
+        Keep an exited worker's counters and histograms, which must never go
+        backwards, but drop its gauges. The file is renamed so a new process
+        that gets the same pid starts a file of its own.
+        """
+        if self.directory is None:
+            return
+        dead = os.path.join(self.directory, f'dead-{pid}-{time.time_ns()}.json')
+        try:
+            os.rename(self._path(pid), dead)
+        except FileNotFoundError:
+            return
+        with open(dead) as f:
+            snapshot = json.load(f)
+        gauges = {metric.name for metric in self._all() if isinstance(metric, Gauge)}
+        with open(f'{dead}.tmp', 'w') as f:
+            json.dump({name: values for name, values in snapshot.items() if name not in gauges}, f)
+        os.replace(f'{dead}.tmp', dead)
+
+    def _read_all(self):
+        """Every process's snapshot; starts over if a file is renamed away mid-read"""
+        snapshots = []
+        for _ in range(3):
+            snapshots = []
+            try:
+                for name in os.listdir(self.directory):
+                    if name.endswith('.json'):
+                        with open(os.path.join(self.directory, name)) as f:
+                            snapshots.append(json.load(f))
+                return snapshots
+            except FileNotFoundError:
+                continue
+        return snapshots
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), function=None, merge='sum'):
+        return self.register(Gauge(name, help_text, labels, function, merge))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        metrics = self._all()
+        lines = []
+        if self.directory is None:
+            for metric in metrics:
+                lines.extend(metric.render())
+        else:
+            self.flush()
+            snapshots = self._read_all()
+            for metric in metrics:
+                lines.extend(metric.render(metric.merge(snapshot.get(metric.name, []) for snapshot in snapshots)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# HTTP
+http_requests = registry.counter(
+    'mindcraftr_http_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status'))
+http_request_seconds = registry.histogram(
+    'mindcraftr_http_request_duration_seconds', 'HTTP request latency by route', ('route', 'method'))
+json_serialize_seconds = registry.histogram(
+    'mindcraftr_json_serialize_seconds', 'Time spent serializing JSON responses', ('route',))
+compression_seconds = registry.histogram(
+    'mindcraftr_http_compression_seconds', 'Time spent compressing response bodies', ('encoding',))
+compressed_bytes = registry.counter(
+    'mindcraftr_http_compressed_bytes_total', 'Response bytes before (raw) and after (wire) compression',
+    ('encoding', 'stage'))
+
+# SQLite
+db_query_seconds = registry.histogram(
+    'mindcraftr_db_query_duration_seconds', 'SQLite statement latency by operation and table', ('operation', 'table'))
+
+# Opus
+opus_phase_seconds = registry.histogram(
+    'mindcraftr_opus_phase_duration_seconds',
+    'Opus API call latency by workflow and phase (initiate, schema, execute, poll, results, total)',
+    ('workflow', 'phase'))
+opus_jobs = registry.counter(
+    'mindcraftr_opus_jobs_total', 'Opus jobs by workflow and outcome', ('workflow', 'outcome'))
+opus_cancellations = registry.counter(
+    'mindcraftr_opus_cancellations_total', 'Cancels sent to Opus for abandoned jobs, by reason and result',
+    ('reason', 'result'))
+opus_queue_depth = registry.gauge(
+    'mindcraftr_opus_queue_depth', 'Opus jobs waiting for a slot, by priority', ('priority',))
+opus_queue_wait_seconds = registry.histogram(
+    'mindcraftr_opus_queue_wait_seconds', 'Time Opus jobs spent queued before starting', ('priority',))
+opus_admission_rejected = registry.counter(
+    'mindcraftr_opus_admission_rejected_total', 'Opus jobs refused a slot (queue_full, timeout)', ('priority', 'reason'))
+opus_callbacks = registry.counter(
+    'mindcraftr_opus_callbacks_total', 'Opus completion callbacks received (accepted, rejected, invalid)', ('outcome',))
+questions_served = registry.counter(
+    'mindcraftr_questions_served_total', 'Questions put into generated tests by source (bank, opus, mock, prefetch)', ('source',))
+prefetches = registry.counter(
+    'mindcraftr_prefetches_total', 'Speculative follow-up tests by outcome (started, ready, failed, hit, miss, skipped_*)',
+    ('outcome',))
+fallbacks = registry.counter(
+    'mindcraftr_fallbacks_total', 'Fallbacks taken when Opus fails (mock_questions, manual_grading)', ('kind',))
+syllabus_uploads = registry.counter(
+    'mindcraftr_syllabus_uploads_total', 'Syllabus uploads by outcome (stored, duplicate, too_large, invalid)',
+    ('outcome',))
+archived_tests = registry.counter(
+    'mindcraftr_archived_tests_total', 'Generated tests moved to or read back from the archive (archived, loaded)',
+    ('event',))
+item_reports = registry.counter(
+    'mindcraftr_item_reports_total', 'Item analysis reports served from cache or computed (cached, computed)',
+    ('outcome',))
+
+
+def render():
+    return registry.render()
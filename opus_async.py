@@ -0,0 +1,455 @@
+"""
+asyncio-native Opus client.
+
+AsyncOpusClient has the same run_workflow / resume_workflow / grade_test
+API as OpusClient, as coroutines: HTTP calls go over non-blocking
+keep-alive connections, waits between status polls are asyncio sleeps (or
+callback notices through job_completions.wait_async), and the workflow
+schema is cached per workflow behind an asyncio lock. A job waiting on Opus
+costs a suspended coroutine instead of a parked thread, so one event loop
+can drive thousands of jobs at once.
+
+Flask views are synchronous; SyncOpusClient is a drop-in OpusClient that
+runs each call on one shared background event loop (opus_loop) and blocks
+only the calling thread. Configuration (BASE_URL, API_KEY, workflow ids,
+callbacks, poll intervals) is read from OpusClient, so both clients always
+talk to the same Opus.
+
+Only the standard library is used: the HTTP/1.1 client below supports
+exactly what the Opus API needs (JSON bodies, Content-Length and chunked
+responses, TLS, keep-alive).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+from typing import Any, Callable, Dict
+from urllib.parse import urlsplit
+
+from logging_config import Truncated
+from metrics import opus_phase_seconds, opus_jobs
+import opus_service
+from opus_service import (REQUEST_TIMEOUT, OpusAPIError, OpusCancelled, OpusClient, OpusTimeoutError,
+                          TERMINAL_STATUSES, _job_deadline, _track_job, cancel_wait_slices, check_cancelled,
+                          job_completions, job_payload_schema, job_title, record_cancel, request_timeout, retryable,
+                          schema_mapping_from)
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open per Opus host; further requests queue for one
+MAX_CONNECTIONS = int(os.environ.get('MINDCRAFTR_OPUS_ASYNC_CONNECTIONS', 64))
+# How long a fetched workflow schema is reused
+SCHEMA_TTL = 300
+
+
+class HTTPPool:
+    """Minimal HTTP/1.1 client over asyncio streams with per-host keep-alive connections"""
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, timeout=REQUEST_TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = {}
+        self._limits = {}
+        self._ssl = None
+
+    async def request(self, method: str, url: str, headers: Dict[str, str], body: bytes = None,
+                      timeout: float = None):
+        """
+        Returns (status, response body bytes). Queueing for a connection,
+        connecting and the exchange together get at most timeout seconds.
+        """
+        loop = asyncio.get_running_loop()
+        expires = loop.time() + (timeout or self.timeout)
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        key = (parts.hostname, parts.port or (443 if secure else 80), secure)
+        limit = self._limits.setdefault(key, asyncio.Semaphore(self.max_connections))
+        target = parts.path + (f'?{parts.query}' if parts.query else '')
+        async with limit:
+            # A pooled connection may have been closed by the server meanwhile; retry once on a fresh one
+            for attempt in range(2):
+                reader, writer, reused = await self._connect(key, expires - loop.time())
+                try:
+                    status, data, keep = await asyncio.wait_for(
+                        self._exchange(reader, writer, method, target, parts.netloc, headers, body),
+                        expires - loop.time())
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise OpusAPIError(f"Connection to {parts.netloc} failed: {e}")
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep:
+                    self._idle.setdefault(key, []).append((reader, writer))
+                else:
+                    writer.close()
+                return status, data
+
+    async def _connect(self, key, timeout):
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        host, port, secure = key
+        if secure and self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl if secure else None), timeout)
+        return reader, writer, False
+
+    @staticmethod
+    async def _exchange(reader, writer, method, target, host, headers, body):
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}", f"Content-Length: {len(body or b'')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed before a response')
+        version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep = response_headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        if method == 'HEAD' or status in ('204', '304'):
+            data = b''
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            data = await reader.readexactly(int(response_headers['content-length']))
+        else:
+            data, keep = await reader.read(), False
+        return int(status), data, keep
+
+    async def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncOpusClient:
+    """Coroutine counterpart of OpusClient; one instance can be shared by every job on its loop"""
+
+    def __init__(self, http: HTTPPool = None):
+        self.http = http or HTTPPool()
+        self._schemas = {}
+        self._schema_locks = {}
+
+    @property
+    def headers(self):
+        return {'x-service-key': OpusClient.API_KEY, 'Content-Type': 'application/json',
+                'Accept': 'application/json'}
+
+    async def _request(self, method: str, endpoint: str, data: Dict = None) -> Dict:
+        url = f"{OpusClient.BASE_URL}{endpoint}"
+        timeout = request_timeout()
+        logger.info(f"{method} {url}")
+        if data:
+            logger.debug("Request body: %s", Truncated(data))
+        try:
+            status, body = await self.http.request(method, url, self.headers,
+                                                   json.dumps(data).encode() if data is not None else None, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"API error: {method} {url} timed out")
+            if timeout < REQUEST_TIMEOUT:
+                raise OpusCancelled('Deadline passed', 'deadline')
+            raise OpusAPIError(f"{method} {endpoint} timed out after {timeout}s")
+        except OpusAPIError as e:
+            logger.error(f"API error: {e}")
+            raise
+        if status >= 400:
+            logger.error(f"API error: {status} for {url}")
+            logger.error("Error response: %s", Truncated(body.decode('utf-8', 'replace')))
+            raise OpusAPIError(f"{status} Error for url: {url}", status)
+        result = json.loads(body) if body else {}
+        logger.debug("Response: %s", Truncated(result))
+        return result
+
+    @staticmethod
+    def workflow_name(workflow_id: str) -> str:
+        return 'grading' if workflow_id == OpusClient.GRADING_WORKFLOW_ID else 'generation'
+
+    async def get_workflow_details(self, workflow_id: str = None) -> Dict:
+        return await self._request('GET', f'/workflow/{workflow_id or OpusClient.WORKFLOW_ID}')
+
+    async def get_workflow_schema_mapping(self, workflow_id: str = None) -> Dict[str, str]:
+        """Display name -> variable name, fetched at most once per SCHEMA_TTL per workflow"""
+        workflow_id = workflow_id or OpusClient.WORKFLOW_ID
+        cached = self._schemas.get(workflow_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        # One fetch per workflow; concurrent jobs wait for it instead of each asking Opus
+        lock = self._schema_locks.setdefault(workflow_id, asyncio.Lock())
+        async with lock:
+            cached = self._schemas.get(workflow_id)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+            try:
+                mapping = schema_mapping_from(await self.get_workflow_details(workflow_id))
+            except OpusAPIError:
+                logger.warning("Could not get schema, using direct mapping")
+                return {}
+            logger.info(f"Schema mapping: {mapping}")
+            self._schemas[workflow_id] = (time.monotonic() + SCHEMA_TTL, mapping)
+            return mapping
+
+    async def initiate_job(self, workflow_id: str = None, title: str = None, description: str = None) -> str:
+        workflow_id = workflow_id or OpusClient.WORKFLOW_ID
+        default_title, default_description = job_title(workflow_id == OpusClient.GRADING_WORKFLOW_ID)
+        response = await self._request('POST', '/job/initiate', data={
+            "workflowId": workflow_id,
+            "title": title or default_title,
+            "description": description or default_description
+        })
+        job_id = response.get('jobExecutionId')
+        logger.info(f"Job initiated: {job_id} - {title or default_title}")
+        return job_id
+
+    async def execute_job(self, job_id: str, inputs: Dict[str, Any], workflow_id: str = None) -> Dict:
+        workflow_id = workflow_id or OpusClient.WORKFLOW_ID
+        workflow = self.workflow_name(workflow_id)
+        logger.info(f"Executing job: {job_id}")
+        with opus_phase_seconds.time(workflow=workflow, phase='schema'):
+            schema_mapping = await self.get_workflow_schema_mapping(workflow_id)
+        body = {
+            "jobExecutionId": job_id,
+            "jobPayloadSchemaInstance": job_payload_schema(inputs, schema_mapping)
+        }
+        if OpusClient.CALLBACK_URL:
+            body["callbackUrl"] = OpusClient.CALLBACK_URL
+        logger.debug("Execute payload: %s", Truncated(body))
+        with opus_phase_seconds.time(workflow=workflow, phase='execute'):
+            return await self._request('POST', '/job/execute', data=body)
+
+    async def get_status(self, job_id: str) -> str:
+        response = await self._request('GET', f'/job/{job_id}/status')
+        status = response.get('status', 'UNKNOWN')
+        logger.info(f"Job {job_id} status: {status}")
+        return status
+
+    async def get_results(self, job_id: str) -> Dict:
+        logger.info(f"Getting results for job: {job_id}")
+        return await self._request('GET', f'/job/{job_id}/results')
+
+    async def cancel_job(self, job_id: str, reason: str) -> bool:
+        """See OpusClient.cancel_job"""
+        if opus_service._cancel_unsupported:
+            return False
+        try:
+            await self._request('POST', f'/job/{job_id}/cancel')
+        except OpusAPIError as e:
+            record_cancel(reason, 'unsupported' if e.status_code in (404, 405, 501) else 'error')
+            logger.warning(f"Could not cancel job {job_id}: {e}")
+            return False
+        record_cancel(reason, 'cancelled')
+        logger.info(f"🛑 Cancelled job {job_id} ({reason})")
+        return True
+
+    async def run_workflow(self, inputs: Dict[str, Any], max_wait: int = 300, workflow_id: str = None,
+                           on_phase: Callable[..., None] = None, deadline: float = None,
+                           cancelled: Callable[[], str] = None) -> Dict:
+        """
+        See OpusClient.run_workflow; on_phase is called on a worker thread, in
+        order, while cancelled() runs on the event loop and must not block.
+        """
+        return await self._drive_job(None, inputs, max_wait, workflow_id, on_phase, deadline, cancelled)
+
+    async def resume_workflow(self, job_id: str, max_wait: int = 300, workflow_id: str = None,
+                              on_phase: Callable[..., None] = None, inputs: Dict[str, Any] = None) -> Dict:
+        """See OpusClient.resume_workflow"""
+        return await self._drive_job(job_id, inputs, max_wait, workflow_id, on_phase)
+
+    async def grade_test(self, answer_sheet: Dict[str, Any], syllabus_text: str = "", max_wait: int = 300,
+                         on_phase: Callable[..., None] = None, deadline: float = None,
+                         cancelled: Callable[[], str] = None) -> Dict:
+        """See OpusClient.grade_test"""
+        logger.info("Grading test with Opus...")
+        result = await self.run_workflow(OpusClient.grading_inputs(answer_sheet, syllabus_text), max_wait=max_wait,
+                                         workflow_id=OpusClient.GRADING_WORKFLOW_ID, on_phase=on_phase,
+                                         deadline=deadline, cancelled=cancelled)
+        logger.info("Grading completed")
+        return result
+
+    async def _wait(self, job_id, timeout, shared, cancelled):
+        """job_completions.wait_async, giving up early with OpusCancelled"""
+        for slice_ in cancel_wait_slices(timeout, cancelled):
+            notified = await job_completions.wait_async(job_id, slice_, shared=shared)
+            if notified:
+                return notified
+        return None
+
+    async def _drive_job(self, job_id, inputs, max_wait, workflow_id, on_phase, deadline=None,
+                         cancelled=None) -> Dict:
+        workflow_id = workflow_id or OpusClient.WORKFLOW_ID
+        workflow = self.workflow_name(workflow_id)
+
+        async def report(phase, **details):
+            if on_phase:
+                try:
+                    # Phase callbacks may write to SQLite; keep them off the event loop
+                    await asyncio.to_thread(on_phase, phase, **details)
+                except Exception as e:
+                    logger.warning(f"Phase callback failed: {e}")
+
+        outcome = 'error'
+        job_started = time.perf_counter()
+        shared = bool(OpusClient.CALLBACK_URL)
+        poll_interval = OpusClient.SAFETY_POLL_INTERVAL if shared else OpusClient.POLL_INTERVAL
+        # Each task has its own context, so concurrent jobs keep separate deadlines
+        deadline_token = _job_deadline.set(deadline)
+
+        _track_job(1)
+        try:
+            check_cancelled(cancelled)
+            if job_id is None:
+                with opus_phase_seconds.time(workflow=workflow, phase='initiate'):
+                    job_id = await self.initiate_job(workflow_id)
+                await report('initiated', jobId=job_id)
+            job_completions.watch(job_id)
+
+            if inputs is not None:
+                await self.execute_job(job_id, inputs, workflow_id)
+                await report('executing', jobId=job_id)
+
+            start = time.time()
+            notified = None
+            while time.time() - start < max_wait:
+                try:
+                    if notified:
+                        # Callbacks may be unsigned, so one only cuts the wait short; Opus has the final word
+                        logger.info(f"Job {job_id} callback: {notified}, confirming")
+                    source = 'callback' if notified else 'poll'
+                    with opus_phase_seconds.time(workflow=workflow, phase='poll'):
+                        status = await self.get_status(job_id)
+                    await report('polling', jobId=job_id, status=status, source=source,
+                                 elapsedSeconds=round(time.time() - start, 1))
+
+                    if status == 'COMPLETED':
+                        with opus_phase_seconds.time(workflow=workflow, phase='results'):
+                            results = await self.get_results(job_id)
+                        outcome = 'completed'
+                        await report('completed', jobId=job_id)
+                        return results
+
+                    if status in TERMINAL_STATUSES:
+                        outcome = 'failed'
+                        raise OpusAPIError(f"Job failed with status: {status}")
+
+                    notified = await self._wait(
+                        job_id, min(poll_interval, max(0, max_wait - (time.time() - start))), shared, cancelled)
+
+                except OpusAPIError as e:
+                    # Same rule as the blocking client: only transient failures are polled again
+                    if outcome == 'failed' or not retryable(e):
+                        raise
+                    logger.warning(f"Status check error: {e}, retrying...")
+                    notified = await self._wait(job_id, poll_interval, shared, cancelled)
+
+            check_cancelled(cancelled)
+            raise OpusTimeoutError(f"Job timeout after {max_wait}s")
+        except (OpusCancelled, OpusTimeoutError) as e:
+            reason = e.reason if isinstance(e, OpusCancelled) else 'timeout'
+            outcome = 'cancelled' if isinstance(e, OpusCancelled) else 'timeout'
+            logger.warning(f"Abandoning job {job_id}: {e}")
+            _job_deadline.reset(deadline_token)
+            deadline_token = None
+            if job_id is not None:
+                await self.cancel_job(job_id, reason)
+            raise
+        finally:
+            if deadline_token is not None:
+                _job_deadline.reset(deadline_token)
+            opus_phase_seconds.observe(time.perf_counter() - job_started, workflow=workflow, phase='total')
+            opus_jobs.inc(workflow=workflow, outcome=outcome)
+            if job_id is not None:
+                job_completions.forget(job_id)
+            _track_job(-1)
+
+
+class EventLoopThread:
+    """One asyncio loop on a daemon thread, started on first use in each process"""
+
+    def __init__(self, name='opus-event-loop'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+        self._client = None
+
+    def _ensure(self):
+        with self._lock:
+            # A loop thread does not survive fork; gunicorn workers start their own
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True, name=self.name).start()
+                self._loop, self._pid = loop, os.getpid()
+                self._client = None
+            return self._loop
+
+    @property
+    def client(self) -> AsyncOpusClient:
+        """The AsyncOpusClient shared by every job on this loop"""
+        self._ensure()
+        if self._client is None:
+            self._client = AsyncOpusClient()
+        return self._client
+
+    def submit(self, coroutine):
+        """Schedule a coroutine on the loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._ensure())
+
+    def run(self, coroutine, timeout=None):
+        """Run a coroutine on the loop and block the calling thread for its result"""
+        return self.submit(coroutine).result(timeout)
+
+
+opus_loop = EventLoopThread()
+
+
+class SyncOpusClient:
+    """Blocking OpusClient interface backed by AsyncOpusClient on opus_loop"""
+
+    WORKFLOW_ID = OpusClient.WORKFLOW_ID
+    GRADING_WORKFLOW_ID = OpusClient.GRADING_WORKFLOW_ID
+    grading_inputs = staticmethod(OpusClient.grading_inputs)
+
+    def run_workflow(self, inputs: Dict[str, Any], max_wait: int = 300, workflow_id: str = None,
+                     on_phase: Callable[..., None] = None, deadline: float = None,
+                     cancelled: Callable[[], str] = None) -> Dict:
+        return opus_loop.run(opus_loop.client.run_workflow(inputs, max_wait, workflow_id, on_phase, deadline,
+                                                           cancelled))
+
+    def resume_workflow(self, job_id: str, max_wait: int = 300, workflow_id: str = None,
+                        on_phase: Callable[..., None] = None, inputs: Dict[str, Any] = None) -> Dict:
+        return opus_loop.run(opus_loop.client.resume_workflow(job_id, max_wait, workflow_id, on_phase, inputs))
+
+    def grade_test(self, answer_sheet: Dict[str, Any], syllabus_text: str = "", max_wait: int = 300,
+                   on_phase: Callable[..., None] = None, deadline: float = None,
+                   cancelled: Callable[[], str] = None) -> Dict:
+        return opus_loop.run(opus_loop.client.grade_test(answer_sheet, syllabus_text, max_wait, on_phase, deadline,
+                                                         cancelled))
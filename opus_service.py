@@ -1,17 +1,293 @@
 """Opus API Integration - Official Documentation"""
 
+import asyncio
+import contextvars
 import time
+import hashlib
+import hmac
 import logging
+import os
+import threading
 import requests
-from typing import Dict, Any
+from typing import Dict, Any, Callable
+
+from logging_config import Truncated
+from metrics import opus_cancellations, opus_phase_seconds, opus_jobs
 
 logger = logging.getLogger(__name__)
 
 
+# Job statuses after which Opus will not change a job again
+TERMINAL_STATUSES = ('COMPLETED', 'FAILED', 'ERROR', 'CANCELLED')
+
+
+# Longest a single Opus HTTP call may take
+REQUEST_TIMEOUT = 60
+# How often a waiting job checks whether its caller still wants the result
+CANCEL_CHECK_INTERVAL = 1.0
+
+
 class OpusAPIError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class OpusTimeoutError(OpusAPIError):
+    """The job was still running when max_wait ran out"""
     pass
 
 
+class OpusCancelled(OpusAPIError):
+    """The job was abandoned: its deadline passed ('deadline') or its caller went away ('disconnected')"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+def retryable(error):
+    """Whether a failed status or results call is worth repeating: no response, a 429 or a 5xx"""
+    if isinstance(error, (OpusCancelled, OpusTimeoutError)):
+        return False
+    return error.status_code is None or error.status_code == 429 or error.status_code >= 500
+
+
+# Absolute time.time() deadline of the job being driven in the current thread or task
+_job_deadline = contextvars.ContextVar('opus_job_deadline', default=None)
+# Set once Opus answers a cancel with 404/405/501, so later jobs don't ask again
+_cancel_unsupported = False
+
+
+def request_timeout() -> float:
+    """Timeout for the next Opus HTTP call: REQUEST_TIMEOUT, cut short by the current job's deadline"""
+    deadline = _job_deadline.get()
+    if deadline is None:
+        return REQUEST_TIMEOUT
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise OpusCancelled('Deadline passed', 'deadline')
+    return min(REQUEST_TIMEOUT, remaining)
+
+
+def check_cancelled(cancelled: Callable[[], str] = None):
+    """Raise OpusCancelled if the current job's deadline has passed or cancelled() gives a reason"""
+    deadline = _job_deadline.get()
+    if deadline is not None and time.time() >= deadline:
+        raise OpusCancelled('Deadline passed', 'deadline')
+    reason = cancelled() if cancelled else None
+    if reason:
+        raise OpusCancelled(f'Job cancelled: {reason}', reason)
+
+
+def cancel_wait_slices(timeout: float, cancelled: Callable[[], str] = None):
+    """
+    Split a wait of timeout seconds into slices, checking for cancellation
+    before each one; a single slice when nothing can cancel the job.
+    """
+    if cancelled is None and _job_deadline.get() is None:
+        yield timeout
+        return
+    end = time.time() + timeout
+    while True:
+        check_cancelled(cancelled)
+        remaining = end - time.time()
+        slice_ = min(remaining, CANCEL_CHECK_INTERVAL)
+        deadline = _job_deadline.get()
+        if deadline is not None:
+            # Wake at the deadline itself rather than up to a slice after it
+            slice_ = min(slice_, deadline - time.time())
+        yield max(0, slice_)
+        if remaining <= slice_:
+            return
+
+
+def record_cancel(reason: str, result: str):
+    """Count a cancel sent to Opus; result is cancelled, unsupported or error"""
+    global _cancel_unsupported
+    if result == 'unsupported':
+        _cancel_unsupported = True
+    opus_cancellations.inc(reason=reason, result=result)
+
+
+# Opus jobs currently being driven by this process, so shutdown can drain them
+_active_jobs = 0
+_active_jobs_changed = threading.Condition()
+
+
+def active_job_count() -> int:
+    with _active_jobs_changed:
+        return _active_jobs
+
+
+def wait_for_active_jobs(timeout: float) -> int:
+    """Block until no Opus jobs are in flight or timeout expires; returns the remaining count"""
+    deadline = time.time() + timeout
+    with _active_jobs_changed:
+        while _active_jobs and time.time() < deadline:
+            _active_jobs_changed.wait(deadline - time.time())
+        return _active_jobs
+
+
+def _track_job(delta: int):
+    global _active_jobs
+    with _active_jobs_changed:
+        _active_jobs += delta
+        _active_jobs_changed.notify_all()
+
+
+def sign_callback(secret: str, body: bytes) -> str:
+    """X-Opus-Signature value for a completion callback body"""
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+class JobCompletions:
+    """
+    Completion notices delivered by Opus callbacks.
+    
+    A job being driven in this process waits here between status polls and
+    wakes as soon as notify() is called for it, from a thread (wait) or a
+    coroutine (wait_async). With shared=True, terminal notices received by
+    another worker process are also picked up through `lookup(job_id)`,
+    checked every LOOKUP_INTERVAL seconds.
+    """
+    
+    LOOKUP_INTERVAL = 1.0
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # job_id -> [threading.Event, status, [(loop, asyncio.Event), ...]]
+        self._waiting = {}
+        self.lookup: Callable[[str], str] = None
+    
+    def watch(self, job_id: str):
+        """Start accepting notices for job_id"""
+        with self._lock:
+            self._waiting.setdefault(job_id, [threading.Event(), None, []])
+    
+    def forget(self, job_id: str):
+        with self._lock:
+            self._waiting.pop(job_id, None)
+    
+    def notify(self, job_id: str, status: str) -> bool:
+        """Record a job's new status; returns True if a job in this process was waiting on it"""
+        with self._lock:
+            entry = self._waiting.get(job_id)
+            if entry is None:
+                return False
+            entry[1] = status
+            waiters = list(entry[2])
+        entry[0].set()
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+        return True
+    
+    async def wait_async(self, job_id: str, timeout: float, shared: bool = False) -> str:
+        """wait() for coroutines: suspends instead of blocking the event loop thread"""
+        self.watch(job_id)
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            entry = self._waiting[job_id]
+            entry[2].append(waiter)
+        lookup = self.lookup if shared else None
+        deadline = time.time() + timeout
+        try:
+            while True:
+                if entry[0].is_set():
+                    entry[0].clear()
+                    return entry[1]
+                remaining = deadline - time.time()
+                slice_ = min(remaining, self.LOOKUP_INTERVAL) if lookup else remaining
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), max(0, slice_))
+                    waiter[1].clear()
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                if lookup:
+                    try:
+                        # The shared lookup reads SQLite; keep it off the event loop
+                        status = await asyncio.to_thread(lookup, job_id)
+                    except Exception as e:
+                        logger.warning(f"Callback lookup failed: {e}")
+                        status = None
+                    if status in TERMINAL_STATUSES:
+                        return status
+                if remaining <= 0:
+                    return None
+        finally:
+            with self._lock:
+                if waiter in entry[2]:
+                    entry[2].remove(waiter)
+    
+    def wait(self, job_id: str, timeout: float, shared: bool = False) -> str:
+        """Wait up to timeout for a notice; returns the notified status or None"""
+        self.watch(job_id)
+        with self._lock:
+            entry = self._waiting[job_id]
+        lookup = self.lookup if shared else None
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            slice_ = min(remaining, self.LOOKUP_INTERVAL) if lookup else remaining
+            if entry[0].wait(max(0, slice_)):
+                entry[0].clear()
+                return entry[1]
+            if lookup:
+                try:
+                    status = lookup(job_id)
+                except Exception as e:
+                    logger.warning(f"Callback lookup failed: {e}")
+                    status = None
+                if status in TERMINAL_STATUSES:
+                    return status
+            if remaining <= 0:
+                return None
+
+
+job_completions = JobCompletions()
+
+
+def job_title(grading: bool):
+    """Default (title, description) of a new job"""
+    if grading:
+        return "AI Test Grader", "Grade student test submission with AI-powered analysis"
+    return "AI Test Generator", "Generate exam questions using AI"
+
+
+def schema_mapping_from(details: Dict) -> Dict[str, str]:
+    """Map display_name -> variable_name from a workflow details response"""
+    mapping = {}
+    for var_name, info in details.get('jobPayloadSchema', {}).items():
+        display_name = info.get('display_name', '')
+        if display_name:
+            mapping[display_name] = var_name
+    return mapping
+
+
+def job_payload_schema(inputs: Dict[str, Any], schema_mapping: Dict[str, str]) -> Dict[str, Dict]:
+    """Convert inputs to jobPayloadSchemaInstance format"""
+    payload_schema = {}
+    
+    for key, value in inputs.items():
+        # Use schema mapping if available, otherwise use key as-is
+        variable_name = schema_mapping.get(key, key)
+        
+        if isinstance(value, bool):
+            payload_schema[variable_name] = {"value": value, "type": "bool"}
+        elif isinstance(value, int):
+            payload_schema[variable_name] = {"value": value, "type": "int"}
+        elif isinstance(value, float):
+            payload_schema[variable_name] = {"value": value, "type": "float"}
+        elif isinstance(value, list):
+            payload_schema[variable_name] = {"value": value, "type": "array"}
+        elif isinstance(value, dict):
+            payload_schema[variable_name] = {"value": value, "type": "object"}
+        else:
+            payload_schema[variable_name] = {"value": str(value), "type": "str"}
+    return payload_schema
+
+
 class OpusClient:
     """Opus API Client following official documentation"""
     
@@ -20,6 +296,13 @@ class OpusClient:
     WORKFLOW_ID = "vWMUyrVTjwJlfOau"
     GRADING_WORKFLOW_ID = "oBBPtfoqIT9oww5X"
     
+    # When CALLBACK_URL is set, Opus is asked to POST completion there and
+    # status polling drops to a slow safety net for missed callbacks
+    CALLBACK_URL = os.environ.get('MINDCRAFTR_OPUS_CALLBACK_URL', '')
+    CALLBACK_SECRET = os.environ.get('MINDCRAFTR_OPUS_CALLBACK_SECRET', '')
+    POLL_INTERVAL = 5
+    SAFETY_POLL_INTERVAL = float(os.environ.get('MINDCRAFTR_OPUS_SAFETY_POLL_SECONDS', 30))
+    
     def __init__(self):
         self.headers = {
             'x-service-key': self.API_KEY,
@@ -28,23 +311,33 @@ class OpusClient:
     
     def _request(self, method: str, endpoint: str, data: Dict = None) -> Dict:
         url = f"{self.BASE_URL}{endpoint}"
+        timeout = request_timeout()
         try:
             logger.info(f"{method} {url}")
             if data:
-                logger.debug(f"Request body: {data}")
-            response = requests.request(method, url, headers=self.headers, json=data, timeout=60)
+                logger.debug("Request body: %s", Truncated(data))
+            response = requests.request(method, url, headers=self.headers, json=data, timeout=timeout)
             response.raise_for_status()
             result = response.json() if response.content else {}
-            logger.debug(f"Response: {result}")
+            logger.debug("Response: %s", Truncated(result))
             return result
         except Exception as e:
             logger.error(f"API error: {e}")
+            status_code = None
             if hasattr(e, 'response') and e.response is not None:
+                status_code = e.response.status_code
                 try:
-                    logger.error(f"Error response: {e.response.text}")
+                    logger.error("Error response: %s", Truncated(e.response.text))
                 except:
                     pass
-            raise OpusAPIError(str(e))
+            if isinstance(e, requests.Timeout) and timeout < REQUEST_TIMEOUT:
+                # The call was cut short by the job's deadline
+                raise OpusCancelled('Deadline passed', 'deadline')
+            raise OpusAPIError(str(e), status_code)
+    
+    def workflow_name(self) -> str:
+        """Metrics label for the active workflow"""
+        return 'grading' if self.WORKFLOW_ID == self.GRADING_WORKFLOW_ID else 'generation'
     
     def get_workflow_details(self) -> Dict:
         """GET /workflow/{workflowId} - Get workflow details and schema"""
@@ -56,17 +349,9 @@ class OpusClient:
         logger.info("Initiating job...")
         
         # Default titles based on workflow
-        if title is None:
-            if self.WORKFLOW_ID == self.GRADING_WORKFLOW_ID:
-                title = "AI Test Grader"
-            else:
-                title = "AI Test Generator"
-        
-        if description is None:
-            if self.WORKFLOW_ID == self.GRADING_WORKFLOW_ID:
-                description = "Grade student test submission with AI-powered analysis"
-            else:
-                description = "Generate exam questions using AI"
+        default_title, default_description = job_title(self.WORKFLOW_ID == self.GRADING_WORKFLOW_ID)
+        title = title or default_title
+        description = description or default_description
         
         body = {
             "workflowId": self.WORKFLOW_ID,
@@ -81,16 +366,7 @@ class OpusClient:
     def get_workflow_schema_mapping(self) -> Dict[str, str]:
         """Get mapping of display_name to variable_name from workflow schema"""
         try:
-            details = self.get_workflow_details()
-            schema = details.get('jobPayloadSchema', {})
-            
-            # Map display_name -> variable_name
-            mapping = {}
-            for var_name, info in schema.items():
-                display_name = info.get('display_name', '')
-                if display_name:
-                    mapping[display_name] = var_name
-            
+            mapping = schema_mapping_from(self.get_workflow_details())
             logger.info(f"Schema mapping: {mapping}")
             return mapping
         except:
@@ -103,35 +379,19 @@ class OpusClient:
         logger.info(f"Input keys: {list(inputs.keys())}")
         
         # Get schema mapping to find correct variable names
-        schema_mapping = self.get_workflow_schema_mapping()
-        
-        # Convert inputs to jobPayloadSchemaInstance format
-        payload_schema = {}
-        
-        for key, value in inputs.items():
-            # Use schema mapping if available, otherwise use key as-is
-            variable_name = schema_mapping.get(key, key)
-            
-            if isinstance(value, bool):
-                payload_schema[variable_name] = {"value": value, "type": "bool"}
-            elif isinstance(value, int):
-                payload_schema[variable_name] = {"value": value, "type": "int"}
-            elif isinstance(value, float):
-                payload_schema[variable_name] = {"value": value, "type": "float"}
-            elif isinstance(value, list):
-                payload_schema[variable_name] = {"value": value, "type": "array"}
-            elif isinstance(value, dict):
-                payload_schema[variable_name] = {"value": value, "type": "object"}
-            else:
-                payload_schema[variable_name] = {"value": str(value), "type": "str"}
+        with opus_phase_seconds.time(workflow=self.workflow_name(), phase='schema'):
+            schema_mapping = self.get_workflow_schema_mapping()
         
         body = {
             "jobExecutionId": job_id,
-            "jobPayloadSchemaInstance": payload_schema
+            "jobPayloadSchemaInstance": job_payload_schema(inputs, schema_mapping)
         }
+        if self.CALLBACK_URL:
+            body["callbackUrl"] = self.CALLBACK_URL
         
-        logger.info(f"Execute payload: {body}")
-        return self._request('POST', '/job/execute', data=body)
+        logger.debug("Execute payload: %s", Truncated(body))
+        with opus_phase_seconds.time(workflow=self.workflow_name(), phase='execute'):
+            return self._request('POST', '/job/execute', data=body)
     
     def get_status(self, job_id: str) -> str:
         """GET /job/{jobExecutionId}/status - Get job status"""
@@ -145,56 +405,170 @@ class OpusClient:
         logger.info(f"Getting results for job: {job_id}")
         return self._request('GET', f'/job/{job_id}/results')
     
-    def run_workflow(self, inputs: Dict[str, Any], max_wait: int = 300, workflow_id: str = None) -> Dict:
+    def cancel_job(self, job_id: str, reason: str) -> bool:
+        """POST /job/{jobExecutionId}/cancel - Stop a job nobody will read; False if it could not be cancelled"""
+        if _cancel_unsupported:
+            return False
+        try:
+            self._request('POST', f'/job/{job_id}/cancel')
+        except OpusAPIError as e:
+            record_cancel(reason, 'unsupported' if e.status_code in (404, 405, 501) else 'error')
+            logger.warning(f"Could not cancel job {job_id}: {e}")
+            return False
+        record_cancel(reason, 'cancelled')
+        logger.info(f"🛑 Cancelled job {job_id} ({reason})")
+        return True
+    
+    def run_workflow(self, inputs: Dict[str, Any], max_wait: int = 300, workflow_id: str = None,
+                     on_phase: Callable[..., None] = None, deadline: float = None,
+                     cancelled: Callable[[], str] = None) -> Dict:
         """
         Complete workflow execution:
         1. Initiate job
         2. Execute with inputs
         3. Poll status until COMPLETED
         4. Get results
+        
+        If given, on_phase(phase, **details) is called as the job moves through
+        "initiated", "executing", "polling" and "completed".
+        
+        deadline (a time.time() value) bounds the whole job including each
+        HTTP call, and cancelled() is checked about every
+        CANCEL_CHECK_INTERVAL seconds while waiting; it returns a reason
+        (e.g. "disconnected") once nobody wants the result. Either raises
+        OpusCancelled. A job abandoned this way, or after max_wait, is
+        cancelled in Opus where Opus supports it.
+        """
+        return self._drive_job(None, inputs, max_wait, workflow_id, on_phase, deadline, cancelled)
+    
+    def resume_workflow(self, job_id: str, max_wait: int = 300, workflow_id: str = None,
+                        on_phase: Callable[..., None] = None, inputs: Dict[str, Any] = None) -> Dict:
         """
+        Pick up a job started earlier (e.g. before a restart) by its jobExecutionId.
+        
+        Pass inputs if the job was initiated but never executed; otherwise it
+        is only polled until COMPLETED and its results fetched.
+        """
+        return self._drive_job(job_id, inputs, max_wait, workflow_id, on_phase)
+    
+    def _wait(self, job_id: str, timeout: float, cancelled: Callable[[], str] = None) -> str:
+        """job_completions.wait, giving up early with OpusCancelled"""
+        for slice_ in cancel_wait_slices(timeout, cancelled):
+            notified = job_completions.wait(job_id, slice_, shared=bool(self.CALLBACK_URL))
+            if notified:
+                return notified
+        return None
+    
+    def _drive_job(self, job_id, inputs, max_wait, workflow_id, on_phase, deadline=None, cancelled=None) -> Dict:
         # Use custom workflow_id if provided, otherwise use default
         original_workflow = self.WORKFLOW_ID
         if workflow_id:
             self.WORKFLOW_ID = workflow_id
         
+        def report(phase, **details):
+            if on_phase:
+                try:
+                    on_phase(phase, **details)
+                except Exception as e:
+                    logger.warning(f"Phase callback failed: {e}")
+        
+        workflow = self.workflow_name()
+        outcome = 'error'
+        job_started = time.perf_counter()
+        deadline_token = _job_deadline.set(deadline)
+        
+        _track_job(1)
         try:
+            check_cancelled(cancelled)
             # Step 1: Initiate
-            job_id = self.initiate_job()
+            if job_id is None:
+                with opus_phase_seconds.time(workflow=workflow, phase='initiate'):
+                    job_id = self.initiate_job()
+                report('initiated', jobId=job_id)
+            job_completions.watch(job_id)
             
             # Step 2: Execute
-            self.execute_job(job_id, inputs)
+            if inputs is not None:
+                self.execute_job(job_id, inputs)
+                report('executing', jobId=job_id)
             
-            # Step 3: Poll status
+            # Step 3: Wait for a completion callback, polling status as a fallback
             start = time.time()
-            poll_interval = 5
+            poll_interval = self.SAFETY_POLL_INTERVAL if self.CALLBACK_URL else self.POLL_INTERVAL
+            notified = None
             
             while time.time() - start < max_wait:
                 try:
-                    status = self.get_status(job_id)
+                    if notified:
+                        # Callbacks may be unsigned, so one only cuts the wait short; Opus has the final word
+                        logger.info(f"Job {job_id} callback: {notified}, confirming")
+                    source = 'callback' if notified else 'poll'
+                    with opus_phase_seconds.time(workflow=workflow, phase='poll'):
+                        status = self.get_status(job_id)
+                    report('polling', jobId=job_id, status=status, source=source,
+                           elapsedSeconds=round(time.time() - start, 1))
                     
                     if status == 'COMPLETED':
                         # Step 4: Get results
-                        return self.get_results(job_id)
+                        with opus_phase_seconds.time(workflow=workflow, phase='results'):
+                            results = self.get_results(job_id)
+                        outcome = 'completed'
+                        report('completed', jobId=job_id)
+                        return results
                     
-                    if status in ['FAILED', 'ERROR', 'CANCELLED']:
+                    if status in TERMINAL_STATUSES:
+                        outcome = 'failed'
                         raise OpusAPIError(f"Job failed with status: {status}")
                     
                     # Still in progress
-                    time.sleep(poll_interval)
+                    notified = self._wait(job_id, min(poll_interval, max(0, max_wait - (time.time() - start))),
+                                          cancelled)
                     
-                except OpusAPIError:
-                    raise
-                except Exception as e:
+                except OpusAPIError as e:
+                    # A transient status or results failure doesn't mean the job failed; poll again
+                    if outcome == 'failed' or not retryable(e):
+                        raise
                     logger.warning(f"Status check error: {e}, retrying...")
-                    time.sleep(poll_interval)
+                    notified = self._wait(job_id, poll_interval, cancelled)
             
-            raise OpusAPIError(f"Job timeout after {max_wait}s")
+            check_cancelled(cancelled)
+            raise OpusTimeoutError(f"Job timeout after {max_wait}s")
+        except (OpusCancelled, OpusTimeoutError) as e:
+            reason = e.reason if isinstance(e, OpusCancelled) else 'timeout'
+            outcome = 'cancelled' if isinstance(e, OpusCancelled) else 'timeout'
+            logger.warning(f"Abandoning job {job_id}: {e}")
+            # The cancel itself must not be cut short by the deadline that just passed
+            _job_deadline.reset(deadline_token)
+            deadline_token = None
+            if job_id is not None:
+                self.cancel_job(job_id, reason)
+            raise
         finally:
+            if deadline_token is not None:
+                _job_deadline.reset(deadline_token)
+            opus_phase_seconds.observe(time.perf_counter() - job_started, workflow=workflow, phase='total')
+            opus_jobs.inc(workflow=workflow, outcome=outcome)
             # Restore original workflow ID
             self.WORKFLOW_ID = original_workflow
+            if job_id is not None:
+                job_completions.forget(job_id)
+            _track_job(-1)
+    
+    @staticmethod
+    def grading_inputs(answer_sheet: Dict[str, Any], syllabus_text: str = "") -> Dict[str, str]:
+        """Grading workflow inputs for a submission"""
+        import json
+        
+        # Grading workflow expects JSON string for answer sheet (type: "str" in schema)
+        # Use exact display names from schema
+        return {
+            "Answer sheet and grading reference": json.dumps(answer_sheet),
+            "Syllabus Texts": syllabus_text or "General knowledge assessment"
+        }
     
-    def grade_test(self, answer_sheet: Dict[str, Any], syllabus_text: str = "", max_wait: int = 300) -> Dict:
+    def grade_test(self, answer_sheet: Dict[str, Any], syllabus_text: str = "", max_wait: int = 300,
+                   on_phase: Callable[..., None] = None, deadline: float = None,
+                   cancelled: Callable[[], str] = None) -> Dict:
         """
         Grade test using Opus grading workflow
         
@@ -202,28 +576,20 @@ class OpusClient:
             answer_sheet: Full test submission with answers and questions
             syllabus_text: Optional syllabus content
             max_wait: Maximum wait time in seconds
+            on_phase: Optional progress callback, see run_workflow
+            deadline, cancelled: Optional, see run_workflow
         
         Returns:
             Grading results with score, strengths, weaknesses, etc.
         """
-        import json
-        
         logger.info("Grading test with Opus...")
         
-        # Grading workflow expects JSON string for answer sheet (type: "str" in schema)
-        # Convert answer_sheet dict to JSON string
-        answer_sheet_str = json.dumps(answer_sheet)
-        
-        # Use exact display names from schema
-        inputs = {
-            "Answer sheet and grading reference": answer_sheet_str,
-            "Syllabus Texts": syllabus_text or "General knowledge assessment"
-        }
-        
+        inputs = self.grading_inputs(answer_sheet, syllabus_text)
         logger.info(f"Grading inputs prepared (answer_sheet as JSON string)")
         
         # Run grading workflow
-        result = self.run_workflow(inputs, max_wait=max_wait, workflow_id=self.GRADING_WORKFLOW_ID)
+        result = self.run_workflow(inputs, max_wait=max_wait, workflow_id=self.GRADING_WORKFLOW_ID,
+                                   on_phase=on_phase, deadline=deadline, cancelled=cancelled)
         
         logger.info("Grading completed")
         return result
@@ -0,0 +1,182 @@
+"""
+Percentile ranks of scores across users.
+
+Each test name has a histogram of its scores (0-100, one bucket per
+point), so a percentile lookup is a fixed 101-bucket walk no matter how
+many results exist. Gradings are counted in memory as they are saved and
+flushed into the score_histograms table of the main database every
+FLUSH_SECONDS, when the latest totals from every worker are also read back.
+Up to FLUSH_SECONDS of counts can be lost if a process dies; the rebuild
+job recounts everything from test_results (run it with the server stopped,
+or unflushed counts are added on top):
+
+    python percentiles.py rebuild
+"""
+
+import argparse
+import json
+import threading
+import time
+
+import database
+
+BUCKETS = 101
+FLUSH_SECONDS = 30
+
+
+def cohort(test_name):
+    """Histogram key for a test name"""
+    return ' '.join(str(test_name or '').split()).lower()
+
+
+def _bucket(score):
+    return max(0, min(BUCKETS - 1, int(round(score or 0))))
+
+
+def _connect():
+    conn = database.get_db_connection()
+    database.ensure_table(conn, database.create_score_histograms_table)
+    return conn
+
+
+class ScoreHistograms:
+    """Persisted per-test-name histograms plus this process's unflushed counts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._persisted = {}
+        self._pending = {}
+        self._flushing = {}
+        self._flush_lock = threading.Lock()
+        self._loaded_at = None
+
+    def record(self, test_name, score):
+        key = cohort(test_name)
+        with self._lock:
+            self._pending.setdefault(key, [0] * BUCKETS)[_bucket(score)] += 1
+
+    def counts(self, test_name):
+        """Current counts for a test name, including unflushed ones"""
+        if self._loaded_at is None:
+            self.refresh()
+        key = cohort(test_name)
+        with self._lock:
+            parts = [d[key] for d in (self._persisted, self._flushing, self._pending) if key in d]
+        return [sum(bucket) for bucket in zip(*parts)] if parts else [0] * BUCKETS
+
+    def rank(self, test_name, score):
+        """
+        (percentile, sample size) for a score: the share of results below it,
+        counting ties as half. Percentile is None for an empty histogram.
+        """
+        counts = self.counts(test_name)
+        total = sum(counts)
+        if not total:
+            return None, 0
+        bucket = _bucket(score)
+        below = sum(counts[:bucket])
+        return round(100 * (below + counts[bucket] / 2) / total, 1), total
+
+    def quantiles(self, test_name, points=(25, 50, 75, 90)):
+        """Score at each percentile point, or None per point for an empty histogram"""
+        counts = self.counts(test_name)
+        total = sum(counts)
+        result = {}
+        for point in points:
+            if not total:
+                result[point] = None
+                continue
+            target, running = total * point / 100, 0
+            for score, count in enumerate(counts):
+                running += count
+                if running >= target:
+                    result[point] = score
+                    break
+        return result, total
+
+    @staticmethod
+    def _read_all():
+        conn = _connect()
+        rows = conn.execute('SELECT cohort, counts FROM score_histograms').fetchall()
+        conn.close()
+        return {row['cohort']: json.loads(row['counts']) for row in rows}
+
+    def refresh(self):
+        """Reload the persisted histograms written by every process"""
+        persisted = self._read_all()
+        with self._lock:
+            self._persisted = persisted
+            self._loaded_at = time.time()
+
+    def flush(self):
+        """Add this process's counts to the stored histograms, then reload them"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            self._flushing, self._pending = self._pending, {}
+            flushing = self._flushing
+        if flushing:
+            conn = _connect()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for key, delta in flushing.items():
+                    row = conn.execute('SELECT counts FROM score_histograms WHERE cohort = ?', (key,)).fetchone()
+                    counts = [a + b for a, b in zip(json.loads(row['counts']), delta)] if row else delta
+                    conn.execute('''
+                        INSERT OR REPLACE INTO score_histograms (cohort, counts, total, updated_at)
+                        VALUES (?, ?, ?, ?)
+                    ''', (key, json.dumps(counts), sum(counts), time.time()))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                # Keep the counts for the next attempt
+                with self._lock:
+                    for key, delta in flushing.items():
+                        pending = self._pending.setdefault(key, [0] * BUCKETS)
+                        self._pending[key] = [a + b for a, b in zip(pending, delta)]
+                    self._flushing = {}
+                raise
+            finally:
+                conn.close()
+        persisted = self._read_all()
+        with self._lock:
+            self._persisted = persisted
+            self._flushing = {}
+            self._loaded_at = time.time()
+        return len(flushing)
+
+
+score_histograms = ScoreHistograms()
+
+
+def rebuild():
+    """Recount every histogram from test_results in all shards; returns the number of test names"""
+    totals = {}
+    for index in range(database.SHARD_COUNT):
+        conn = database.get_shard_connection(index)
+        rows = conn.execute('SELECT test_name, score, COUNT(*) AS n FROM test_results GROUP BY test_name, score')
+        for row in rows.fetchall():
+            totals.setdefault(cohort(row['test_name']), [0] * BUCKETS)[_bucket(row['score'])] += row['n']
+        conn.close()
+    conn = _connect()
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('DELETE FROM score_histograms')
+    conn.executemany('INSERT INTO score_histograms (cohort, counts, total, updated_at) VALUES (?, ?, ?, ?)',
+                     [(key, json.dumps(counts), sum(counts), time.time()) for key, counts in totals.items()])
+    conn.commit()
+    conn.close()
+    return len(totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain MindCraftr score histograms')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('rebuild', help='Recount all histograms from test_results')
+    parser.parse_args()
+    print(f"✅ Rebuilt score histograms for {rebuild()} test names")
+
+
+if __name__ == '__main__':
+    main()
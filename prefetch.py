@@ -0,0 +1,137 @@
+"""
+Speculative follow-up tests.
+
+After a test is graded, a background job may generate the user's likely
+next test ahead of time. Entries are keyed by the hash of the graded test's
+Opus inputs, so the next generate request with the same settings can take
+the ready test instead of waiting for Opus.
+
+Statuses: pending -> ready -> served, or failed / expired. Ready tests are
+kept until their TTL runs out; the share of finished prefetches that were
+served is the hit rate.
+"""
+
+import json
+import time
+
+import database
+
+# Rows older than this are deleted; they only matter for recent hit rates
+HISTORY_SECONDS = 7 * 24 * 3600
+
+
+def _connect():
+    conn = database.get_db_connection()
+    database.ensure_table(conn, database.create_prefetched_tests_table)
+    return conn
+
+
+def _expire(conn, now):
+    conn.execute("UPDATE prefetched_tests SET status = 'expired' WHERE status IN ('pending', 'ready') AND expires_at < ?",
+                 (now,))
+    conn.execute('DELETE FROM prefetched_tests WHERE created_at < ?', (now - HISTORY_SECONDS,))
+
+
+def reserve(user_id, request_hash, source_test_id, pending_seconds, daily_limit, max_in_flight):
+    """
+    Record a prefetch about to start.
+
+    Returns (prefetch_id, None), or (None, reason) when it should be skipped:
+    "duplicate" (one is already pending or ready for this request),
+    "user_limit" (the user had daily_limit prefetches in the last 24h) or
+    "in_flight_limit" (max_in_flight are already running server-wide).
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        _expire(conn, now)
+        if conn.execute('''
+            SELECT 1 FROM prefetched_tests
+            WHERE user_id = ? AND request_hash = ? AND status IN ('pending', 'ready')
+        ''', (user_id, request_hash)).fetchone():
+            return None, 'duplicate'
+        used = conn.execute('SELECT COUNT(*) FROM prefetched_tests WHERE user_id = ? AND created_at >= ?',
+                            (user_id, now - 24 * 3600)).fetchone()[0]
+        if used >= daily_limit:
+            return None, 'user_limit'
+        running = conn.execute("SELECT COUNT(*) FROM prefetched_tests WHERE status = 'pending'").fetchone()[0]
+        if running >= max_in_flight:
+            return None, 'in_flight_limit'
+        cursor = conn.execute('''
+            INSERT INTO prefetched_tests (user_id, request_hash, source_test_id, status, created_at, expires_at)
+            VALUES (?, ?, ?, 'pending', ?, ?)
+        ''', (user_id, request_hash, source_test_id, now, now + pending_seconds))
+        conn.commit()
+        return cursor.lastrowid, None
+    finally:
+        conn.close()
+
+
+def fulfil(prefetch_id, test_data, ttl):
+    """Store a finished prefetch, servable for ttl seconds"""
+    now = time.time()
+    conn = _connect()
+    conn.execute("UPDATE prefetched_tests SET status = 'ready', test_data = ?, expires_at = ? WHERE id = ?",
+                 (json.dumps(test_data), now + ttl, prefetch_id))
+    conn.commit()
+    conn.close()
+
+
+def fail(prefetch_id, error):
+    conn = _connect()
+    conn.execute("UPDATE prefetched_tests SET status = 'failed', error = ? WHERE id = ?", (error, prefetch_id))
+    conn.commit()
+    conn.close()
+
+
+def claim(user_id, request_hash, wait_seconds, interval=0.5):
+    """
+    Take the ready prefetched test for a request, or None.
+
+    If one is still being generated, wait up to wait_seconds for it rather
+    than starting the same work again.
+    """
+    deadline = time.time() + wait_seconds
+    while True:
+        now = time.time()
+        conn = _connect()
+        try:
+            _expire(conn, now)
+            conn.commit()
+            row = conn.execute('''
+                SELECT id, status, test_data FROM prefetched_tests
+                WHERE user_id = ? AND request_hash = ? AND status IN ('pending', 'ready')
+                ORDER BY status = 'ready' DESC, id DESC LIMIT 1
+            ''', (user_id, request_hash)).fetchone()
+            if row is None:
+                return None
+            if row['status'] == 'ready':
+                cursor = conn.execute('''
+                    UPDATE prefetched_tests SET status = 'served', served_at = ?
+                    WHERE id = ? AND status = 'ready'
+                ''', (now, row['id']))
+                conn.commit()
+                if cursor.rowcount == 1:
+                    return json.loads(row['test_data'])
+                continue
+        finally:
+            conn.close()
+        if now >= deadline:
+            return None
+        time.sleep(interval)
+
+
+def stats(window_seconds=HISTORY_SECONDS):
+    """Prefetch counts by status and the hit rate over the window"""
+    conn = _connect()
+    rows = conn.execute('SELECT status, COUNT(*) AS n FROM prefetched_tests WHERE created_at >= ? GROUP BY status',
+                        (time.time() - window_seconds,)).fetchall()
+    conn.close()
+    counts = {status: 0 for status in ('pending', 'ready', 'served', 'expired', 'failed')}
+    counts.update({row['status']: row['n'] for row in rows})
+    finished = counts['served'] + counts['expired']
+    return {
+        **counts,
+        "hitRate": round(counts['served'] / finished, 4) if finished else 0.0,
+        "windowSeconds": window_seconds
+    }
@@ -0,0 +1,205 @@
+"""
+Opt-in request profiling for the Flask app.
+
+Profiling is off unless MINDCRAFTR_PROFILE_SAMPLE_RATE is above zero or
+MINDCRAFTR_PROFILE_TOKEN is set; when off, init_profiling() registers no
+hooks at all. Settings:
+
+    MINDCRAFTR_PROFILE_MODE         "cprofile" (default) or "sampler" (wall-clock stack sampling)
+    MINDCRAFTR_PROFILE_SAMPLE_RATE  fraction of requests to profile (default 0)
+    MINDCRAFTR_PROFILE_TOKEN        requests sending this value in X-MindCraftr-Profile are always profiled
+    MINDCRAFTR_PROFILE_DIR          output directory (default "profiles")
+    MINDCRAFTR_PROFILE_KEEP         newest profiles kept on disk (default 200)
+    MINDCRAFTR_PROFILE_INTERVAL_MS  sampler interval (default 5)
+
+cProfile output is a .prof file for pstats/snakeviz; sampler output is a
+.folded file of collapsed stacks for flamegraph tools. File names carry the
+route and latency, e.g. 1731580245123_GET_api-v1-dashboard-stats_42ms.prof
+"""
+
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, jsonify, request, send_from_directory
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODE = os.environ.get('MINDCRAFTR_PROFILE_MODE', 'cprofile').lower()
+PROFILE_SAMPLE_RATE = float(os.environ.get('MINDCRAFTR_PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('MINDCRAFTR_PROFILE_TOKEN', '')
+PROFILE_DIR = os.environ.get('MINDCRAFTR_PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.environ.get('MINDCRAFTR_PROFILE_KEEP', 200))
+PROFILE_INTERVAL_MS = float(os.environ.get('MINDCRAFTR_PROFILE_INTERVAL_MS', 5))
+
+PROFILE_HEADER = 'X-MindCraftr-Profile'
+
+# Python 3.12+ allows only one active cProfile per process (enable() raises
+# ValueError otherwise), so overlapping sampled requests take turns
+_cprofile_lock = threading.Lock()
+
+_FILENAME = re.compile(r'^(?P<ts>\d+)_(?P<method>[A-Z]+)_(?P<route>.+)_(?P<ms>\d+)ms\.(?P<ext>prof|folded)$')
+
+
+class StackSampler:
+    """Samples one thread's stack on a timer and counts collapsed stacks"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _route_slug(rule):
+    return re.sub(r'[^A-Za-z0-9]+', '-', rule).strip('-') or 'root'
+
+
+def _trusted_header():
+    sent = request.headers.get(PROFILE_HEADER)
+    return bool(PROFILE_TOKEN and sent and hmac.compare_digest(sent, PROFILE_TOKEN))
+
+
+def _rotate():
+    files = sorted(f for f in os.listdir(PROFILE_DIR) if _FILENAME.match(f))
+    for name in files[:max(0, len(files) - PROFILE_KEEP)]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass
+
+
+def list_profiles(limit=20):
+    """Return the slowest profiles currently on disk"""
+    entries = []
+    for name in os.listdir(PROFILE_DIR):
+        match = _FILENAME.match(name)
+        if match:
+            entries.append({
+                "file": name,
+                "timestamp": int(match['ts']) / 1000,
+                "method": match['method'],
+                "route": match['route'],
+                "latencyMs": int(match['ms']),
+                "format": match['ext']
+            })
+    entries.sort(key=lambda e: e['latencyMs'], reverse=True)
+    return entries[:limit]
+
+
+def init_profiling(app):
+    """Register profiling hooks and endpoints on app, if profiling is enabled"""
+    if PROFILE_SAMPLE_RATE <= 0 and not PROFILE_TOKEN:
+        return
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    logger.info(f'🔬 Request profiling enabled: mode={PROFILE_MODE}, sample_rate={PROFILE_SAMPLE_RATE}, dir={PROFILE_DIR}')
+
+    @app.before_request
+    def start_profile():
+        if request.path.startswith('/api/v1/admin/profiles'):
+            return
+        if not (_trusted_header() or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)):
+            return
+        if PROFILE_MODE == 'sampler':
+            profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+            profiler.start()
+        else:
+            if not _cprofile_lock.acquire(blocking=False):
+                logger.debug(f'⏭️  Not profiling {request.path}: another request is being profiled')
+                return
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Some other profiler (e.g. the whole process run under cProfile) is active
+                _cprofile_lock.release()
+                logger.debug(f'⏭️  Not profiling {request.path}: {e}')
+                return
+        g.profiler = profiler
+        g.profile_started = time.perf_counter()
+
+    @app.teardown_request
+    def stop_profile(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        latency_ms = int((time.perf_counter() - g.pop('profile_started')) * 1000)
+        if isinstance(profiler, StackSampler):
+            profiler.stop()
+            ext = 'folded'
+        else:
+            profiler.disable()
+            _cprofile_lock.release()
+            ext = 'prof'
+
+        rule = request.url_rule.rule if request.url_rule is not None else request.path
+        name = f"{int(time.time() * 1000)}_{request.method}_{_route_slug(rule)}_{latency_ms}ms.{ext}"
+        try:
+            path = os.path.join(PROFILE_DIR, name)
+            if ext == 'prof':
+                profiler.dump_stats(path)
+            else:
+                profiler.dump(path)
+            _rotate()
+        except OSError as e:
+            logger.error(f'❌ Failed to write profile {name}: {e}')
+
+    # Profiles expose code paths and timings, so they are only served to holders of
+    # the profiling token; with none configured these endpoints always refuse
+    def forbidden():
+        if not PROFILE_TOKEN:
+            return jsonify({"error": "Forbidden", "message": "Set MINDCRAFTR_PROFILE_TOKEN to serve profiles"}), 403
+        return jsonify({"error": "Forbidden", "message": f"Send the profiling token in {PROFILE_HEADER}"}), 403
+
+    @app.route('/api/v1/admin/profiles', methods=['GET'])
+    def get_profiles():
+        """
+        Lists the slowest recent profiles (?limit=N, default 20).
+        """
+        if not _trusted_header():
+            return forbidden()
+        limit = request.args.get('limit', 20, type=int)
+        return jsonify(list_profiles(limit))
+
+    @app.route('/api/v1/admin/profiles/<path:name>', methods=['GET'])
+    def download_profile(name):
+        """
+        Downloads one profile file.
+        """
+        if not _trusted_header():
+            return forbidden()
+        if not _FILENAME.match(name) or not os.path.exists(os.path.join(PROFILE_DIR, name)):
+            return jsonify({"error": "Profile not found"}), 404
+        return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
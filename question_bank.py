@@ -0,0 +1,104 @@
+"""
+Question bank built from past generations.
+
+Questions mapped from Opus output are stored once each, deduplicated by a
+hash of their content, under a match key of topic (exam name), syllabus,
+difficulty and question format taken from the generation inputs. New tests
+are assembled from questions the user hasn't been served yet, and Opus is
+only asked for the shortfall.
+
+Questions handed out carry a fresh per-test "id" (as before) plus "bankId".
+"""
+
+import hashlib
+import json
+import uuid
+
+import database
+
+
+def _connect():
+    conn = database.get_db_connection()
+    database.ensure_table(conn, database.create_question_bank_tables)
+    return conn
+
+
+def match_key(opus_inputs):
+    """Bank match key for a generation request's Opus inputs"""
+    syllabus = ' '.join(str(opus_inputs.get('SYLLABUS_CONTENT', '')).split()).lower()
+    return {
+        "topic": ' '.join(str(opus_inputs.get('EXAM_NAME', '')).split()).lower(),
+        "syllabus_hash": hashlib.sha256(syllabus.encode()).hexdigest(),
+        "difficulty": opus_inputs.get('EXAM_DIFFICULTY', 'Standard'),
+        "question_format": opus_inputs.get('EXAM_TYPE', 'objective')
+    }
+
+
+def content_hash(question):
+    """Hash of what makes a question the same question, ignoring ids and whitespace/case"""
+    def norm(text):
+        return ' '.join(str(text).split()).lower()
+
+    options = {opt.get('id'): norm(opt.get('text', '')) for opt in question.get('options') or []}
+    correct = question.get('correctAnswer', '')
+    canonical = json.dumps({
+        "type": question.get('type'),
+        "text": norm(question.get('text', '')),
+        "options": sorted(options.values()),
+        "correct": options.get(correct, norm(correct))
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def pick(user_id, key, limit):
+    """Up to `limit` random matching questions the user hasn't been served, ready to put in a test"""
+    if limit <= 0:
+        return []
+    conn = _connect()
+    rows = conn.execute('''
+        SELECT q.id, q.question_data FROM questions q
+        WHERE q.topic = ? AND q.syllabus_hash = ? AND q.difficulty = ? AND q.question_format = ?
+          AND NOT EXISTS (
+              SELECT 1 FROM user_seen_questions s WHERE s.user_id = ? AND s.question_id = q.id
+          )
+        ORDER BY RANDOM()
+        LIMIT ?
+    ''', (key['topic'], key['syllabus_hash'], key['difficulty'], key['question_format'],
+          user_id, limit)).fetchall()
+    conn.close()
+    return [{**json.loads(row['question_data']), "id": str(uuid.uuid4()), "bankId": row['id']} for row in rows]
+
+
+def add(questions, key, source_test_id=None):
+    """
+    Store newly generated questions, skipping ones already in the bank, and
+    set "bankId" on each question dict.
+    """
+    conn = _connect()
+    for question in questions:
+        digest = content_hash(question)
+        data = {k: v for k, v in question.items() if k not in ('id', 'bankId')}
+        conn.execute('''
+            INSERT OR IGNORE INTO questions
+            (content_hash, topic, syllabus_hash, difficulty, question_format, question_type,
+             question_data, source_test_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (digest, key['topic'], key['syllabus_hash'], key['difficulty'], key['question_format'],
+              question.get('type', ''), json.dumps(data), source_test_id))
+        question['bankId'] = conn.execute('SELECT id FROM questions WHERE content_hash = ?',
+                                          (digest,)).fetchone()['id']
+    conn.commit()
+    conn.close()
+    return questions
+
+
+def mark_seen(user_id, questions):
+    """Record that the user has been served these bank questions"""
+    bank_ids = [(user_id, q['bankId']) for q in questions if q.get('bankId') is not None]
+    if not bank_ids:
+        return
+    conn = _connect()
+    conn.executemany('INSERT OR IGNORE INTO user_seen_questions (user_id, question_id) VALUES (?, ?)', bank_ids)
+    conn.commit()
+    conn.close()
+
@@ -0,0 +1,133 @@
+"""
+Daily score rollups for trend charts.
+
+Every test_results insert also adds to the user's daily_scores row for that
+(UTC) day, in the same transaction, so trends read at most one row per day
+instead of scanning the raw results. Weekly and monthly views are summed
+from the daily rows.
+
+Results saved before rollups existed are folded in by the backfill job:
+
+    python rollups.py backfill            # every user in every shard
+    python rollups.py backfill --user 2
+"""
+
+import argparse
+
+import database
+
+PERIODS = {
+    'day': "day",
+    # Monday of the day's week
+    'week': "date(day, 'weekday 0', '-6 days')",
+    'month': "strftime('%Y-%m-01', day)",
+}
+
+
+def ensure(conn):
+    database.ensure_table(conn, database.create_daily_scores_table)
+
+
+def record(conn, user_id, score, duration_seconds, questions_answered, total_questions):
+    """Add one result to today's rollup; the caller ensures the table and commits"""
+    conn.execute('''
+        INSERT INTO daily_scores
+        (user_id, day, tests_taken, score_sum, score_min, score_max, duration_seconds, questions_answered,
+         total_questions)
+        VALUES (?, date('now'), 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            tests_taken = tests_taken + 1,
+            score_sum = score_sum + excluded.score_sum,
+            score_min = MIN(score_min, excluded.score_min),
+            score_max = MAX(score_max, excluded.score_max),
+            duration_seconds = duration_seconds + excluded.duration_seconds,
+            questions_answered = questions_answered + excluded.questions_answered,
+            total_questions = total_questions + excluded.total_questions
+    ''', (user_id, score, score, score, duration_seconds or 0, questions_answered or 0, total_questions or 0))
+
+
+def trends(user_id, period, since):
+    """Rollup points for user_id from the `since` date (YYYY-MM-DD) on, grouped by period"""
+    bucket = PERIODS[period]
+    conn = database.get_db_connection(user_id)
+    ensure(conn)
+    rows = conn.execute(f'''
+        SELECT {bucket} AS start,
+               SUM(tests_taken) AS tests_taken,
+               SUM(score_sum) AS score_sum,
+               MIN(score_min) AS score_min,
+               MAX(score_max) AS score_max,
+               SUM(duration_seconds) AS duration_seconds,
+               SUM(questions_answered) AS questions_answered
+        FROM daily_scores
+        WHERE user_id = ? AND day >= ?
+        GROUP BY start
+        ORDER BY start
+    ''', (user_id, since)).fetchall()
+    conn.close()
+    return [{
+        "start": row['start'],
+        "testsTaken": row['tests_taken'],
+        "averageScore": round(row['score_sum'] / row['tests_taken'], 1),
+        "highestScore": row['score_max'],
+        "lowestScore": row['score_min'],
+        "studyMinutes": round(row['duration_seconds'] / 60),
+        "questionsAnswered": row['questions_answered']
+    } for row in rows]
+
+
+def _rebuild(conn, user_id=None):
+    ensure(conn)
+    where, params = ('WHERE user_id = ?', (user_id,)) if user_id is not None else ('', ())
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(f'DELETE FROM daily_scores {where}', params)
+        cursor = conn.execute(f'''
+            INSERT INTO daily_scores
+            (user_id, day, tests_taken, score_sum, score_min, score_max, duration_seconds, questions_answered,
+             total_questions)
+            SELECT user_id, date(completed_at), COUNT(*), SUM(score), MIN(score), MAX(score),
+                   SUM(duration_seconds), SUM(questions_answered), SUM(total_questions)
+            FROM test_results {where}
+            GROUP BY user_id, date(completed_at)
+        ''', params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return cursor.rowcount
+
+
+def backfill(user_id=None):
+    """
+    Rebuild rollups from test_results, for one user or everyone. Runs in one
+    write transaction per shard, so inserts made meanwhile are not lost.
+    Returns the number of daily rows written.
+    """
+    if user_id is not None:
+        conn = database.get_db_connection(user_id)
+        try:
+            return _rebuild(conn, user_id)
+        finally:
+            conn.close()
+    written = 0
+    for index in range(database.SHARD_COUNT):
+        conn = database.get_shard_connection(index)
+        try:
+            written += _rebuild(conn)
+        finally:
+            conn.close()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain MindCraftr daily score rollups')
+    commands = parser.add_subparsers(dest='command', required=True)
+    rebuild = commands.add_parser('backfill', help='Rebuild rollups from test_results')
+    rebuild.add_argument('--user', type=int, help='Only this user (default: everyone)')
+    args = parser.parse_args()
+    print(f"✅ Wrote {backfill(args.user)} daily rollup rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+Admission control for Opus jobs.
+
+Every Opus job runs inside opus_scheduler.slot(user_id, priority). At most
+MINDCRAFTR_OPUS_MAX_CONCURRENT jobs run at once, and at most
+MINDCRAFTR_OPUS_MAX_PER_USER of them for one user. Jobs that cannot start
+wait in a bounded priority queue (grading before generation, live requests
+before pre-generation); when the queue is full, or a job has waited
+MINDCRAFTR_OPUS_QUEUE_TIMEOUT seconds, OpusQueueFull is raised with a
+Retry-After estimate.
+
+Under gunicorn, use_shared_memory() in the master makes the running-job
+limits server-wide; queue order is kept per worker process.
+"""
+
+import heapq
+import itertools
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from metrics import opus_queue_depth, opus_queue_wait_seconds, opus_admission_rejected
+
+MAX_CONCURRENT = int(os.environ.get('MINDCRAFTR_OPUS_MAX_CONCURRENT', 8))
+MAX_PER_USER = int(os.environ.get('MINDCRAFTR_OPUS_MAX_PER_USER', 2))
+QUEUE_SIZE = int(os.environ.get('MINDCRAFTR_OPUS_QUEUE_SIZE', 32))
+QUEUE_TIMEOUT = float(os.environ.get('MINDCRAFTR_OPUS_QUEUE_TIMEOUT', 120))
+
+PRIORITY_GRADING = 0
+PRIORITY_GENERATION = 1
+PRIORITY_PREFETCH = 2
+PRIORITY_NAMES = {PRIORITY_GRADING: 'grading', PRIORITY_GENERATION: 'generation', PRIORITY_PREFETCH: 'prefetch'}
+
+_COUNT = struct.Struct('<q')
+
+
+class OpusQueueFull(Exception):
+    """No Opus slot could be granted; retry after `retry_after` seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _LocalSlots:
+    """Running-job counters for a single process"""
+
+    def __init__(self):
+        self._running = 0
+        self._by_user = {}
+
+    def running(self):
+        return self._running
+
+    def user_running(self, user_id):
+        return self._by_user.get(user_id, 0)
+
+    def try_take(self, user_id, max_total, max_user):
+        if self._running >= max_total or self._by_user.get(user_id, 0) >= max_user:
+            return False
+        self._running += 1
+        self._by_user[user_id] = self._by_user.get(user_id, 0) + 1
+        return True
+
+    def give_back(self, user_id):
+        self._running -= 1
+        self._by_user[user_id] -= 1
+        if not self._by_user[user_id]:
+            del self._by_user[user_id]
+
+
+class _SharedSlots:
+    """
+    Running-job counters in an anonymous shared mapping inherited by forked
+    workers. Each process owns one row (pid, running, per-user buckets) and
+    totals are summed across rows, so the master can zero a dead worker's
+    row and get its slots back. Users sharing a bucket only make each
+    other's per-user limit stricter.
+    """
+
+    def __init__(self, rows, buckets):
+        self._rows = rows
+        self._buckets = buckets
+        self._row_size = (2 + buckets) * _COUNT.size
+        self._map = mmap.mmap(-1, rows * self._row_size)
+        self._lock = multiprocessing.Lock()
+        self._row = None
+        self._row_pid = None
+
+    def _field(self, row, index):
+        return row * self._row_size + index * _COUNT.size
+
+    def _read(self, row, index):
+        return _COUNT.unpack_from(self._map, self._field(row, index))[0]
+
+    def _add(self, row, index, delta):
+        offset = self._field(row, index)
+        _COUNT.pack_into(self._map, offset, _COUNT.unpack_from(self._map, offset)[0] + delta)
+
+    def _bucket(self, user_id):
+        return 2 + zlib.crc32(str(user_id).encode()) % self._buckets
+
+    def _own_row(self):
+        # Called with the lock held; claims a free row the first time this process needs one
+        pid = os.getpid()
+        if self._row_pid != pid:
+            for row in range(self._rows):
+                if self._read(row, 0) == 0:
+                    self._map[row * self._row_size:(row + 1) * self._row_size] = bytes(self._row_size)
+                    _COUNT.pack_into(self._map, self._field(row, 0), pid)
+                    self._row, self._row_pid = row, pid
+                    break
+            else:
+                raise RuntimeError('No free Opus scheduler rows; raise the row count')
+        return self._row
+
+    def _sum(self, index):
+        return sum(self._read(row, index) for row in range(self._rows) if self._read(row, 0))
+
+    def running(self):
+        with self._lock:
+            return self._sum(1)
+
+    def user_running(self, user_id):
+        with self._lock:
+            return self._sum(self._bucket(user_id))
+
+    def try_take(self, user_id, max_total, max_user):
+        bucket = self._bucket(user_id)
+        with self._lock:
+            if self._sum(1) >= max_total or self._sum(bucket) >= max_user:
+                return False
+            row = self._own_row()
+            self._add(row, 1, 1)
+            self._add(row, bucket, 1)
+            return True
+
+    def give_back(self, user_id):
+        with self._lock:
+            row = self._own_row()
+            self._add(row, 1, -1)
+            self._add(row, self._bucket(user_id), -1)
+
+    def release_process(self, pid):
+        with self._lock:
+            for row in range(self._rows):
+                if self._read(row, 0) == pid:
+                    self._map[row * self._row_size:(row + 1) * self._row_size] = bytes(self._row_size)
+
+
+class OpusScheduler:
+    """Concurrency limits plus a bounded priority queue for Opus jobs"""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_per_user=MAX_PER_USER,
+                 queue_size=QUEUE_SIZE, queue_timeout=QUEUE_TIMEOUT):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_per_user = max(1, max_per_user)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._slots = _LocalSlots()
+        self._shared = False
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        # Moving average of how long a job holds its slot, for Retry-After
+        self._hold_seconds = 30.0
+
+    def use_shared_memory(self, rows=256, buckets=1024):
+        """Share running-job counters with forked workers (call in the master before forking)"""
+        self._slots = _SharedSlots(rows, buckets)
+        self._shared = True
+
+    def release_process(self, pid):
+        """Return the slots held by a worker that exited (call in the master)"""
+        if self._shared:
+            self._slots.release_process(pid)
+
+    def running(self):
+        return self._slots.running()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def retry_after(self):
+        """Rough seconds until a queued job would start"""
+        with self._cond:
+            waiting = len(self._queue)
+        estimate = self._hold_seconds * (waiting + 1) / self.max_concurrent
+        return max(1, min(300, math.ceil(estimate)))
+
+    def _update_depth(self):
+        depths = dict.fromkeys(PRIORITY_NAMES, 0)
+        for priority, _, _ in self._queue:
+            depths[priority] += 1
+        for priority, depth in depths.items():
+            opus_queue_depth.set(depth, priority=PRIORITY_NAMES[priority])
+
+    def _is_next(self, entry):
+        # First queued job whose user is under the per-user limit goes next
+        for queued in sorted(self._queue):
+            if self._slots.user_running(queued[2]) < self.max_per_user:
+                return queued is entry
+        return False
+
+    def _reject(self, entry, reason, message):
+        opus_admission_rejected.inc(priority=PRIORITY_NAMES[entry[0]], reason=reason)
+        raise OpusQueueFull(message, self.retry_after())
+
+    def _admit(self, user_id, priority, timeout):
+        entry = [priority, next(self._seq), user_id]
+        started = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    if self._is_next(entry) and self._slots.try_take(user_id, self.max_concurrent, self.max_per_user):
+                        break
+                    if len(self._queue) > self.queue_size:
+                        self._reject(entry, 'queue_full', 'Too many Opus jobs are queued')
+                    self._update_depth()
+                    remaining = timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self._reject(entry, 'timeout', 'Timed out waiting for an Opus slot')
+                    # Other workers don't notify this condition, so poll when counters are shared
+                    self._cond.wait(min(remaining, 0.25) if self._shared else remaining)
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._update_depth()
+                self._cond.notify_all()
+        opus_queue_wait_seconds.observe(time.monotonic() - started, priority=PRIORITY_NAMES[priority])
+
+    def _release(self, user_id, held):
+        with self._cond:
+            self._slots.give_back(user_id)
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, user_id, priority=PRIORITY_GENERATION, timeout=None):
+        """Hold an Opus slot for the with-block, queueing at most timeout (default queue_timeout) seconds"""
+        self._admit(user_id, priority, self.queue_timeout if timeout is None else min(timeout, self.queue_timeout))
+        acquired = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(user_id, time.monotonic() - acquired)
+
+
+opus_scheduler = OpusScheduler()
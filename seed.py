@@ -1,35 +1,51 @@
+import os
 import sqlite3
-from database import DATABASE_NAME, create_tables, seed_data
+from database import DATABASE_NAME, SHARD_COUNT, create_storage, shard_paths
+import archive
+import percentiles
+import rollups
 
 def initialize_database():
     """
     Initializes the database by dropping existing tables, creating new ones,
     and seeding with initial data. This script is re-runnable.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    
     # Drop all tables if they exist to ensure script is re-runnable
     print("Dropping existing tables...")
-    cursor.execute('DROP TABLE IF EXISTS generated_tests')
-    cursor.execute('DROP TABLE IF EXISTS topic_mastery')
-    cursor.execute('DROP TABLE IF EXISTS flashcards')
-    cursor.execute('DROP TABLE IF EXISTS recommended_topics')
-    cursor.execute('DROP TABLE IF EXISTS test_results')
-    cursor.execute('DROP TABLE IF EXISTS users')
-    
-    conn.commit()
-    
-    # Create tables
-    print("Creating tables...")
-    create_tables(conn)
-    
-    # Seed data
-    print("Seeding data...")
-    seed_data(conn)
+    paths = [DATABASE_NAME] + (shard_paths() if SHARD_COUNT > 1 else [])
+    for path in paths:
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('DROP TABLE IF EXISTS item_responses')
+        cursor.execute('DROP TABLE IF EXISTS user_syllabi')
+        cursor.execute('DROP TABLE IF EXISTS syllabus_chunks')
+        cursor.execute('DROP TABLE IF EXISTS syllabi')
+        cursor.execute('DROP TABLE IF EXISTS score_histograms')
+        cursor.execute('DROP TABLE IF EXISTS daily_scores')
+        cursor.execute('DROP TABLE IF EXISTS api_tokens')
+        cursor.execute('DROP TABLE IF EXISTS prefetched_tests')
+        cursor.execute('DROP TABLE IF EXISTS user_seen_questions')
+        cursor.execute('DROP TABLE IF EXISTS questions')
+        cursor.execute('DROP TABLE IF EXISTS idempotency_keys')
+        cursor.execute('DROP TABLE IF EXISTS opus_callbacks')
+        cursor.execute('DROP TABLE IF EXISTS opus_jobs')
+        cursor.execute('DROP TABLE IF EXISTS generated_tests')
+        cursor.execute('DROP TABLE IF EXISTS topic_mastery')
+        cursor.execute('DROP TABLE IF EXISTS flashcards')
+        cursor.execute('DROP TABLE IF EXISTS recommended_topics')
+        cursor.execute('DROP TABLE IF EXISTS test_results')
+        cursor.execute('DROP TABLE IF EXISTS users')
+        conn.commit()
+        conn.close()
+        # Archived tests belong to the dropped generated_tests rows
+        if os.path.exists(archive.archive_path(path)):
+            os.remove(archive.archive_path(path))
     
-    # Close connection
-    conn.close()
+    # Create tables and seed data
+    print(f"Creating tables and seeding data ({SHARD_COUNT} shard(s))...")
+    create_storage()
+    rollups.backfill()
+    percentiles.rebuild()
     
     print("✅ Database initialized successfully!")
 
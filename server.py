@@ -1,53 +1,587 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, has_request_context, jsonify, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import hmac
 import json
 import logging
+import os
+import queue
+import select
+import socket
+import threading
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+import database
 from database import get_db_connection
-from opus_service import OpusClient, OpusAPIError
+from opus_async import SyncOpusClient
+from opus_service import OpusClient, OpusAPIError, OpusCancelled, OpusTimeoutError, active_job_count, job_completions, sign_callback
+import job_ledger
+import idempotency
+import auth
+import question_bank
+import prefetch
+import rollups
+import percentiles
+import archive
+import compression
+import item_analysis
+import syllabi
+from percentiles import score_histograms
+from scheduler import opus_scheduler, OpusQueueFull, PRIORITY_GRADING, PRIORITY_GENERATION, PRIORITY_PREFETCH
+import metrics
+from versions import resource_versions
+from cache import response_cache
+from logging_config import configure_logging, sample_request, Truncated
+from profiling import init_profiling
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging (levels, format and sampling come from MINDCRAFTR_LOG_* variables)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider that records how long jsonify() spends serializing"""
+
+    def response(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            metrics.json_serialize_seconds.observe(time.perf_counter() - started, route=current_route())
+
+
+def current_route():
+    """URL rule of the current request, used as the metrics route label"""
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched'
+
+
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 CORS(app)  # Enable CORS for all origins
+init_profiling(app)  # No-op unless MINDCRAFTR_PROFILE_* is configured
+compression.init_compression(app)
+
+# Requests without an Authorization header act as DEFAULT_USER_ID unless
+# MINDCRAFTR_AUTH_REQUIRED=1, in which case they get 401
+AUTH_REQUIRED = os.environ.get('MINDCRAFTR_AUTH_REQUIRED', '0') == '1'
+DEFAULT_USER_ID = int(os.environ.get('MINDCRAFTR_DEFAULT_USER_ID', 1))
+
+# Paths served without resolving a user (probes, metrics, signed Opus callbacks)
+PUBLIC_PATHS = ('/', '/metrics', '/health/live', '/health/ready', '/api/v1/opus/callback')
+
+# Set once the worker has been asked to shut down; readiness then fails so
+# the load balancer stops routing new requests while in-flight ones drain
+draining = threading.Event()
+
+# Per-process cap on concurrent Opus-backed requests, set by the production
+# server so long generate/submit calls can't occupy every worker thread
+opus_request_slots = None
+
+
+# Opus job ledger settings: a job whose driving process has not written a
+# heartbeat for JOB_STALE_SECONDS is considered orphaned and resumed by
+# another process, as long as it was created within JOB_RESUME_WINDOW.
+# Running jobs renew their heartbeat every JOB_HEARTBEAT_SECONDS.
+# Identical gradings completed within GRADING_REUSE_SECONDS are answered
+# from the ledger instead of starting another Opus job.
+OPUS_MAX_WAIT = 300
+# Longest a request can spend on one Opus job: queued for a scheduler slot,
+# then driving the job, plus a margin for saving its results. Claims that
+# must outlive the request (idempotency keys, pending prefetches) last this long.
+OPUS_JOB_LEASE = opus_scheduler.queue_timeout + OPUS_MAX_WAIT + 60
+JOB_RESUME = os.environ.get('MINDCRAFTR_JOB_RESUME', '1') != '0'
+JOB_STALE_SECONDS = float(os.environ.get('MINDCRAFTR_JOB_STALE_SECONDS', 60))
+JOB_HEARTBEAT_SECONDS = JOB_STALE_SECONDS / 4
+JOB_RESUME_WINDOW = float(os.environ.get('MINDCRAFTR_JOB_RESUME_WINDOW', 3600))
+GRADING_REUSE_SECONDS = float(os.environ.get('MINDCRAFTR_GRADING_REUSE_SECONDS', 600))
+
+# Drive Opus jobs as coroutines on one event loop thread instead of one
+# blocked worker thread per job (see opus_async.py)
+OPUS_ASYNC = os.environ.get('MINDCRAFTR_OPUS_ASYNC', '0') == '1'
+
+
+
+def opus_client():
+    """The Opus client for a job: OpusClient, or its event-loop-backed equivalent"""
+    return SyncOpusClient() if OPUS_ASYNC else OpusClient()
+
+
+def request_deadline():
+    """
+    time.time() by which the client wants its answer, from an X-Request-Timeout
+    header or ?timeout= parameter in seconds (capped at OPUS_MAX_WAIT), or
+    None. Raises ValueError if the value is not a positive number.
+    """
+    value = request.headers.get('X-Request-Timeout') or request.args.get('timeout')
+    if not value:
+        return None
+    seconds = float(value)
+    if not 0 < seconds < float('inf'):
+        raise ValueError('Request timeout must be a positive number of seconds')
+    return time.time() + min(seconds, OPUS_MAX_WAIT)
+
+
+def client_disconnected(environ):
+    """Whether the client of a request has closed its connection, judged without reading from it"""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A closed connection reads as end of file; anything else is a pipelined request
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except ConnectionError:
+        return True
+    except (OSError, ValueError):
+        # Nothing to read after all, or a socket that can't be peeked (TLS)
+        return False
+
+
+def disconnect_check(environ=None):
+    """A `cancelled` callable for OpusClient.run_workflow that reports the current client going away"""
+    environ = environ if environ is not None else request.environ
+    return lambda: 'disconnected' if client_disconnected(environ) else None
+
 
-# Default user_id for all queries
-USER_ID = 1
+# Completion callbacks received by any worker are shared through the database
+job_completions.lookup = job_ledger.callback_status
+
+# Assemble tests from the question bank before asking Opus
+QUESTION_BANK = os.environ.get('MINDCRAFTR_QUESTION_BANK', '1') != '0'
+
+# Speculative follow-up tests: after a graded test, generate the next one on
+# its weak areas at low priority and hold it for PREFETCH_TTL seconds. Each
+# user gets at most PREFETCH_DAILY_LIMIT per 24h and at most
+# PREFETCH_MAX_IN_FLIGHT run at once server-wide. A generate request waits at
+# most PREFETCH_CLAIM_WAIT seconds for one that is still running; the
+# prefetch sits at the lowest priority, so waiting longer would hold a
+# foreground request behind the work the scheduler starves first.
+PREFETCH = os.environ.get('MINDCRAFTR_PREFETCH', '0') == '1'
+PREFETCH_CLAIM_WAIT = float(os.environ.get('MINDCRAFTR_PREFETCH_CLAIM_WAIT', 2))
+PREFETCH_TTL = float(os.environ.get('MINDCRAFTR_PREFETCH_TTL', 1800))
+PREFETCH_DAILY_LIMIT = int(os.environ.get('MINDCRAFTR_PREFETCH_DAILY_LIMIT', 5))
+PREFETCH_MAX_IN_FLIGHT = int(os.environ.get('MINDCRAFTR_PREFETCH_MAX_IN_FLIGHT', 2))
+
+# Percentile ranks are only reported once a test name has this many results
+PERCENTILE_MIN_SAMPLE = int(os.environ.get('MINDCRAFTR_PERCENTILE_MIN_SAMPLE', 10))
+# Seconds between archival compaction runs; 0 leaves it to `python archive.py compact`
+ARCHIVE_INTERVAL = float(os.environ.get('MINDCRAFTR_ARCHIVE_INTERVAL', 3600))
+
+# How long a response stored under an Idempotency-Key is replayed to retries
+IDEMPOTENCY_TTL = float(os.environ.get('MINDCRAFTR_IDEMPOTENCY_TTL', 24 * 3600))
+# How long a retry waits for the first request with its key before getting a
+# 409; a longer wait would park a worker thread the Opus scheduler can't see
+IDEMPOTENCY_WAIT = float(os.environ.get('MINDCRAFTR_IDEMPOTENCY_WAIT', 2))
+
+
+def begin_draining():
+    """Fail readiness checks from now on"""
+    draining.set()
+
+
+def limit_opus_requests(max_concurrent):
+    """Allow at most max_concurrent Opus-backed requests at once in this process"""
+    global opus_request_slots
+    opus_request_slots = threading.BoundedSemaphore(max(1, max_concurrent))
 
 
 @app.before_request
 def log_request_info():
-    """Log information about each incoming request"""
-    logger.info('=' * 80)
-    logger.info(f'📥 Incoming Request: {request.method} {request.path}')
-    logger.info(f'   Origin: {request.headers.get("Origin", "No origin header")}')
-    logger.info(f'   User-Agent: {request.headers.get("User-Agent", "Unknown")}')
-    if request.args:
-        logger.info(f'   Query Params: {dict(request.args)}')
+    """Log one line per sampled incoming request"""
+    g.request_started = time.perf_counter()
+    g.log_request = sample_request()
+    if g.log_request and logger.isEnabledFor(logging.INFO):
+        logger.info(
+            '📥 %s %s origin=%s',
+            request.method, request.full_path if request.args else request.path,
+            request.headers.get('Origin', '-'),
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "origin": request.headers.get('Origin'),
+                "userAgent": Truncated(request.headers.get('User-Agent', ''), 120)
+            }
+        )
+
+
+@app.before_request
+def resolve_user():
+    """Work out which user the request acts for from its bearer token"""
+    if request.method == 'OPTIONS' or request.path in PUBLIC_PATHS:
+        return None
+    header = request.headers.get('Authorization', '')
+    if header:
+        scheme, _, token = header.partition(' ')
+        user_id = auth.user_for_token(token.strip()) if scheme.lower() == 'bearer' else None
+        if user_id is None:
+            return unauthorized('Invalid or revoked API token')
+        g.user_id = user_id
+    elif AUTH_REQUIRED:
+        return unauthorized('An API token is required')
+    else:
+        g.user_id = DEFAULT_USER_ID
+
+
+def unauthorized(message):
+    logger.warning(f'   🔒 Unauthorized: {message}')
+    response = jsonify({"error": "Unauthorized", "message": message})
+    response.status_code = 401
+    response.headers['WWW-Authenticate'] = 'Bearer'
+    return response
+
+
+def current_user():
+    """Id of the user the current request acts for"""
+    return g.user_id
 
 
 @app.after_request
 def log_response_info(response):
-    """Log information about each outgoing response"""
-    logger.info(f'📤 Response Status: {response.status_code}')
-    logger.info(f'   CORS Headers: Access-Control-Allow-Origin = {response.headers.get("Access-Control-Allow-Origin", "NOT SET")}')
-    logger.info('=' * 80)
+    """Log one line per sampled response; errors are always logged"""
+    if response.status_code >= 500 or g.get('log_request'):
+        elapsed_ms = (time.perf_counter() - g.get('request_started', time.perf_counter())) * 1000
+        level = logging.WARNING if response.status_code >= 500 else logging.INFO
+        if logger.isEnabledFor(level):
+            logger.log(
+                level, '📤 %s %s %s %.1fms cors=%s',
+                response.status_code, request.method, request.path, elapsed_ms,
+                response.headers.get('Access-Control-Allow-Origin', 'NOT SET'),
+                extra={
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "durationMs": round(elapsed_ms, 2),
+                    "corsOrigin": response.headers.get('Access-Control-Allow-Origin')
+                }
+            )
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request and observe its latency per route"""
+    route = current_route()
+    metrics.http_requests.inc(route=route, method=request.method, status=response.status_code)
+    started = g.get('request_started')
+    if started is not None:
+        metrics.http_request_seconds.observe(time.perf_counter() - started, route=route, method=request.method)
     return response
 
 
+def json_response(body, status=200):
+    """Response for an already serialized JSON body, skipping a parse/re-dump cycle"""
+    return app.response_class(body, status=status, mimetype=app.json.mimetype)
+
+
+def conditional_get(*resources):
+    """
+    Serve a GET route with an ETag derived from the user's resource versions.
+
+    A matching If-None-Match is answered with 304 before the view runs, so
+    no database work or JSON serialization happens for unchanged data.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = resource_versions.etag(current_user(), *resources)
+            if request.if_none_match.contains_weak(etag):
+                logger.debug(f'   ♻️  Not modified (ETag {etag})')
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_response(*tables):
+    """
+    Serve a GET route from the in-process response cache.
+
+    Entries are keyed by user, path and the current versions of `tables`,
+    and are dropped by record_write() when any of those tables change.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = current_user()
+            version_tag, _ = resource_versions.etag(user_id, *tables)
+            key = (user_id, request.full_path, version_tag)
+            cached = response_cache.get(key)
+            if cached is not None:
+                body, mimetype, encoded = cached
+                logger.debug(f'   ⚡ Served from cache ({len(body)} bytes)')
+                # Compressed copies are kept with the entry, so hits skip recompressing
+                return compression.encode_cached(app.response_class(body, status=200, mimetype=mimetype), encoded)
+
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                body = response.get_data()
+                response_cache.set(key, (body, response.mimetype, {}), len(body), user_id, tables)
+            return response
+        return wrapper
+    return decorator
+
+
+def opus_backed(view):
+    """
+    Hold an Opus request slot for the lifetime of the response.
+    
+    When every slot is taken, answer 503 with Retry-After instead of tying up
+    another worker thread that fast read endpoints need.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        slots = opus_request_slots
+        if slots is None:
+            return view(*args, **kwargs)
+        if not slots.acquire(blocking=False):
+            logger.warning('   ⚠️  All Opus request slots busy, rejecting')
+            response = jsonify({
+                "error": "Server busy",
+                "message": "Too many tests are being generated or graded, please retry shortly"
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            slots.release()
+            raise
+        # Streamed responses keep the slot until the client has read them
+        if response.is_streamed:
+            response.call_on_close(slots.release)
+        else:
+            slots.release()
+        return response
+    return wrapper
+
+
+def idempotent(view):
+    """
+    Honour an Idempotency-Key header on a POST endpoint.
+    
+    The first request with a key runs normally and its response is stored;
+    retries with the same key get the stored response (marked with
+    Idempotent-Replayed: true). A retry that arrives while the first is
+    still running waits up to IDEMPOTENCY_WAIT seconds for it, then gets a
+    409 with Retry-After. 5xx responses are not stored, so those can be
+    retried, and neither are 429s or 499s (abandoned by the client). Reusing
+    a key with a different body is a 422.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > 255:
+            return jsonify({"error": "Invalid Idempotency-Key", "message": "Must be 1-255 characters"}), 400
+        
+        user_id = current_user()
+        request_hash = idempotency.request_hash(request.method, request.path, request.get_data())
+        lease = OPUS_JOB_LEASE
+        deadline = time.time() + IDEMPOTENCY_WAIT
+        while True:
+            existing = idempotency.claim(user_id, key, request_hash, lease, IDEMPOTENCY_TTL)
+            if existing is None:
+                break
+            if existing['request_hash'] != request_hash:
+                return jsonify({
+                    "error": "Idempotency-Key reused",
+                    "message": "This key was already used with a different request"
+                }), 422
+            if existing['status'] == idempotency.COMPLETED:
+                logger.info(f'🔁 Replaying stored response for Idempotency-Key {key}')
+                response = Response(existing['response_body'], status=existing['response_status'],
+                                    content_type=existing['content_type'])
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            if time.time() >= deadline:
+                response = jsonify({
+                    "error": "Request in progress",
+                    "message": "A request with this Idempotency-Key is still being processed"
+                })
+                response.status_code = 409
+                response.headers['Retry-After'] = '5'
+                return response
+            # Same request still running elsewhere; give it a moment to finish
+            time.sleep(min(0.25, max(deadline - time.time(), 0)))
+        
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency.release(user_id, key)
+            raise
+        if response.status_code >= 500 or response.status_code in (429, 499) or response.is_streamed:
+            idempotency.release(user_id, key)
+        else:
+            idempotency.complete(user_id, key, response.status_code, response.get_data(),
+                                 response.content_type, IDEMPOTENCY_TTL)
+        return response
+    return wrapper
+
+
+def record_write(user_id, *tables):
+    """Invalidate cached reads and bump ETag versions after a committed write"""
+    resource_versions.bump(user_id, *tables)
+    response_cache.invalidate(user_id, *tables)
+
+
+def format_dashboard_stats(result):
+    """Format a test_results aggregate row for the dashboard stats widget"""
+    # Handle case where there are no test results
+    if result['tests_taken'] == 0:
+        logger.warning('   ⚠️  No test results found, returning N/A values')
+        return {
+            "testsTaken": "N/A",
+            "averageScore": "N/A",
+            "highestScore": "N/A",
+            "questionsAnswered": "N/A"
+        }
+    
+    return {
+        "testsTaken": result['tests_taken'],
+        "averageScore": int(result['average_score']),
+        "highestScore": result['highest_score'],
+        "questionsAnswered": result['questions_answered']
+    }
+
+
+def format_profile_stats(result):
+    """Format a test_results aggregate row for the profile stats widget"""
+    # Format study time as "Xh Ym"
+    total_seconds = result['total_study_time'] or 0
+    hours = total_seconds // 3600
+    minutes = (total_seconds % 3600) // 60
+    study_time_formatted = f"{hours}h {minutes}m"
+    
+    return {
+        "totalStudyTime": study_time_formatted,
+        "testsCompleted": result['tests_taken'],
+        "highestScore": result['highest_score'] or 0,
+        "achievementsUnlocked": 6,
+        "totalAchievements": 9
+    }
+
+
+DASHBOARD_WIDGETS = ('stats', 'recommendations', 'profileStats', 'mastery', 'flashcards')
+
+
+@app.route('/api/v1/dashboard', methods=['GET'])
+@conditional_get('test_results', 'recommended_topics', 'topic_mastery', 'flashcards')
+@cached_response('test_results', 'recommended_topics', 'topic_mastery', 'flashcards')
+def get_dashboard():
+    """
+    Returns every dashboard widget in one response.
+    
+    Query params:
+      fields: optional comma-separated subset of
+              stats, recommendations, profileStats, mastery, flashcards
+    
+    All queries run on one connection inside a single read transaction, and
+    the dashboard and profile stats share one test_results aggregate.
+    """
+    fields_param = request.args.get('fields')
+    if fields_param:
+        fields = [f.strip() for f in fields_param.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in DASHBOARD_WIDGETS]
+        if unknown:
+            return jsonify({
+                "error": "Unknown fields",
+                "message": f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(DASHBOARD_WIDGETS)}"
+            }), 400
+    else:
+        fields = list(DASHBOARD_WIDGETS)
+    
+    user_id = current_user()
+    logger.debug(f'🔍 Fetching dashboard {fields} for user_id: {user_id}')
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    response_data = {}
+    
+    try:
+        cursor.execute('BEGIN')
+        
+        if 'stats' in fields or 'profileStats' in fields:
+            cursor.execute('''
+                SELECT 
+                    COUNT(id) as tests_taken,
+                    AVG(score) as average_score,
+                    MAX(score) as highest_score,
+                    SUM(questions_answered) as questions_answered,
+                    SUM(duration_seconds) as total_study_time
+                FROM test_results
+                WHERE user_id = ?
+            ''', (user_id,))
+            result = cursor.fetchone()
+            if 'stats' in fields:
+                response_data['stats'] = format_dashboard_stats(result)
+            if 'profileStats' in fields:
+                response_data['profileStats'] = format_profile_stats(result)
+        
+        if 'recommendations' in fields:
+            cursor.execute('''
+                SELECT id, title, summary
+                FROM recommended_topics
+                WHERE user_id = ?
+            ''', (user_id,))
+            response_data['recommendations'] = [
+                {"id": str(topic['id']), "title": topic['title'], "summary": topic['summary']}
+                for topic in cursor.fetchall()
+            ]
+        
+        if 'mastery' in fields:
+            cursor.execute('''
+                SELECT topic_name, mastery_score
+                FROM topic_mastery
+                WHERE user_id = ?
+            ''', (user_id,))
+            response_data['mastery'] = [
+                {"topic": row['topic_name'], "mastery": row['mastery_score']}
+                for row in cursor.fetchall()
+            ]
+        
+        if 'flashcards' in fields:
+            cursor.execute('''
+                SELECT id, front_content, back_content
+                FROM flashcards
+                WHERE user_id = ?
+            ''', (user_id,))
+            response_data['flashcards'] = [
+                {"id": str(card['id']), "front": card['front_content'], "back": card['back_content']}
+                for card in cursor.fetchall()
+            ]
+        
+        conn.commit()
+    finally:
+        conn.close()
+    
+    logger.debug(f'   ✅ Returning dashboard with {len(response_data)} widgets')
+    return jsonify(response_data)
+
+
 @app.route('/api/v1/dashboard/stats', methods=['GET'])
+@conditional_get('test_results')
+@cached_response('test_results')
 def get_dashboard_stats():
     """
     Returns aggregate statistics from test results.
     """
-    logger.info(f'🔍 Fetching dashboard stats for user_id: {USER_ID}')
-    conn = get_db_connection()
+    user_id = current_user()
+    logger.debug(f'🔍 Fetching dashboard stats for user_id: {user_id}')
+    conn = get_db_connection(user_id)
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -58,49 +592,37 @@ def get_dashboard_stats():
             SUM(questions_answered) as questions_answered
         FROM test_results
         WHERE user_id = ?
-    ''', (USER_ID,))
+    ''', (user_id,))
     
     result = cursor.fetchone()
-    logger.info(f'   DB Result: tests_taken={result["tests_taken"]}, avg_score={result["average_score"]}, high_score={result["highest_score"]}, questions={result["questions_answered"]}')
+    logger.debug(f'   DB Result: tests_taken={result["tests_taken"]}, avg_score={result["average_score"]}, high_score={result["highest_score"]}, questions={result["questions_answered"]}')
     conn.close()
     
-    # Handle case where there are no test results
-    if result['tests_taken'] == 0:
-        logger.warning('   ⚠️  No test results found, returning N/A values')
-        return jsonify({
-            "testsTaken": "N/A",
-            "averageScore": "N/A",
-            "highestScore": "N/A",
-            "questionsAnswered": "N/A"
-        })
-    
-    response_data = {
-        "testsTaken": result['tests_taken'],
-        "averageScore": int(result['average_score']),
-        "highestScore": result['highest_score'],
-        "questionsAnswered": result['questions_answered']
-    }
-    logger.info(f'   ✅ Returning stats: {response_data}')
+    response_data = format_dashboard_stats(result)
+    logger.debug(f'   ✅ Returning stats: {response_data}')
     return jsonify(response_data)
 
 
 @app.route('/api/v1/dashboard/recommendations', methods=['GET'])
+@conditional_get('recommended_topics')
+@cached_response('recommended_topics')
 def get_recommendations():
     """
     Returns a list of recommended topics for the user.
     """
-    logger.info(f'🔍 Fetching recommendations for user_id: {USER_ID}')
-    conn = get_db_connection()
+    user_id = current_user()
+    logger.debug(f'🔍 Fetching recommendations for user_id: {user_id}')
+    conn = get_db_connection(user_id)
     cursor = conn.cursor()
     
     cursor.execute('''
         SELECT id, title, summary
         FROM recommended_topics
         WHERE user_id = ?
-    ''', (USER_ID,))
+    ''', (user_id,))
     
     topics = cursor.fetchall()
-    logger.info(f'   DB Result: Found {len(topics)} recommended topics')
+    logger.debug(f'   DB Result: Found {len(topics)} recommended topics')
     conn.close()
     
     # Format response with id as string
@@ -113,24 +635,26 @@ def get_recommendations():
         for topic in topics
     ]
     
-    logger.info(f'   ✅ Returning {len(recommendations)} recommendations')
+    logger.debug(f'   ✅ Returning {len(recommendations)} recommendations')
     return jsonify(recommendations)
 
 
 @app.route('/api/v1/topics/<string:topic_id>/details', methods=['GET'])
+@cached_response('recommended_topics')
 def get_topic_details(topic_id):
     """
     Returns detailed information about a specific topic.
     """
-    logger.info(f'🔍 Fetching topic details for topic_id: {topic_id}, user_id: {USER_ID}')
-    conn = get_db_connection()
+    user_id = current_user()
+    logger.debug(f'🔍 Fetching topic details for topic_id: {topic_id}, user_id: {user_id}')
+    conn = get_db_connection(user_id)
     cursor = conn.cursor()
     
     cursor.execute('''
         SELECT *
         FROM recommended_topics
         WHERE id = ? AND user_id = ?
-    ''', (topic_id, USER_ID))
+    ''', (topic_id, user_id))
     
     topic = cursor.fetchone()
     conn.close()
@@ -139,7 +663,7 @@ def get_topic_details(topic_id):
         logger.warning(f'   ⚠️  Topic {topic_id} not found')
         return jsonify({"error": "Topic not found"}), 404
     
-    logger.info(f'   DB Result: Found topic "{topic["title"]}"')
+    logger.debug(f'   DB Result: Found topic "{topic["title"]}"')
     
     # Deserialize JSON strings
     key_concepts = json.loads(topic['key_concepts'])
@@ -160,27 +684,30 @@ def get_topic_details(topic_id):
         "commonPitfalls": common_pitfalls,
         "example": example
     }
-    logger.info(f'   ✅ Returning topic details with {len(key_concepts)} concepts and {len(common_pitfalls)} pitfalls')
+    logger.debug(f'   ✅ Returning topic details with {len(key_concepts)} concepts and {len(common_pitfalls)} pitfalls')
     return jsonify(response_data)
 
 
 @app.route('/api/v1/flashcards', methods=['GET'])
+@conditional_get('flashcards')
+@cached_response('flashcards')
 def get_flashcards():
     """
     Returns all flashcards for the user.
     """
-    logger.info(f'🔍 Fetching flashcards for user_id: {USER_ID}')
-    conn = get_db_connection()
+    user_id = current_user()
+    logger.debug(f'🔍 Fetching flashcards for user_id: {user_id}')
+    conn = get_db_connection(user_id)
     cursor = conn.cursor()
     
     cursor.execute('''
         SELECT id, front_content, back_content
         FROM flashcards
         WHERE user_id = ?
-    ''', (USER_ID,))
+    ''', (user_id,))
     
     flashcards = cursor.fetchall()
-    logger.info(f'   DB Result: Found {len(flashcards)} flashcards')
+    logger.debug(f'   DB Result: Found {len(flashcards)} flashcards')
     conn.close()
     
     # Format response with id as string
@@ -193,66 +720,60 @@ def get_flashcards():
         for card in flashcards
     ]
     
-    logger.info(f'   ✅ Returning {len(flashcards_list)} flashcards')
+    logger.debug(f'   ✅ Returning {len(flashcards_list)} flashcards')
     return jsonify(flashcards_list)
 
 
 @app.route('/api/v1/profile/stats', methods=['GET'])
+@conditional_get('test_results')
+@cached_response('test_results')
 def get_profile_stats():
     """
     Returns profile statistics including study time and test completion.
     """
-    logger.info(f'🔍 Fetching profile stats for user_id: {USER_ID}')
-    conn = get_db_connection()
+    user_id = current_user()
+    logger.debug(f'🔍 Fetching profile stats for user_id: {user_id}')
+    conn = get_db_connection(user_id)
     cursor = conn.cursor()
     
     cursor.execute('''
         SELECT 
             SUM(duration_seconds) as total_study_time,
-            COUNT(id) as tests_completed,
+            COUNT(id) as tests_taken,
             MAX(score) as highest_score
         FROM test_results
         WHERE user_id = ?
-    ''', (USER_ID,))
+    ''', (user_id,))
     
     result = cursor.fetchone()
-    logger.info(f'   DB Result: total_seconds={result["total_study_time"]}, tests={result["tests_completed"]}, high_score={result["highest_score"]}')
+    logger.debug(f'   DB Result: total_seconds={result["total_study_time"]}, tests={result["tests_taken"]}, high_score={result["highest_score"]}')
     conn.close()
     
-    # Format study time as "Xh Ym"
-    total_seconds = result['total_study_time'] or 0
-    hours = total_seconds // 3600
-    minutes = (total_seconds % 3600) // 60
-    study_time_formatted = f"{hours}h {minutes}m"
-    
-    response_data = {
-        "totalStudyTime": study_time_formatted,
-        "testsCompleted": result['tests_completed'],
-        "highestScore": result['highest_score'] or 0,
-        "achievementsUnlocked": 6,
-        "totalAchievements": 9
-    }
-    logger.info(f'   ✅ Returning profile stats: {response_data}')
+    response_data = format_profile_stats(result)
+    logger.debug(f'   ✅ Returning profile stats: {response_data}')
     return jsonify(response_data)
 
 
 @app.route('/api/v1/profile/mastery', methods=['GET'])
+@conditional_get('topic_mastery')
+@cached_response('topic_mastery')
 def get_profile_mastery():
     """
     Returns topic mastery data for the user's profile.
     """
-    logger.info(f'🔍 Fetching mastery data for user_id: {USER_ID}')
-    conn = get_db_connection()
+    user_id = current_user()
+    logger.debug(f'🔍 Fetching mastery data for user_id: {user_id}')
+    conn = get_db_connection(user_id)
     cursor = conn.cursor()
     
     cursor.execute('''
         SELECT topic_name, mastery_score
         FROM topic_mastery
         WHERE user_id = ?
-    ''', (USER_ID,))
+    ''', (user_id,))
     
     mastery_data = cursor.fetchall()
-    logger.info(f'   DB Result: Found {len(mastery_data)} mastery records')
+    logger.debug(f'   DB Result: Found {len(mastery_data)} mastery records')
     conn.close()
     
     # Rename fields for frontend
@@ -264,16 +785,55 @@ def get_profile_mastery():
         for row in mastery_data
     ]
     
-    logger.info(f'   ✅ Returning {len(mastery_list)} mastery records')
+    logger.debug(f'   ✅ Returning {len(mastery_list)} mastery records')
     return jsonify(mastery_list)
 
 
+# Default and maximum history per trend period, in days
+TREND_WINDOWS = {'day': (90, 366), 'week': (365, 3 * 366), 'month': (3 * 365, 20 * 366)}
+
+
+@app.route('/api/v1/profile/trends', methods=['GET'])
+@conditional_get('test_results')
+@cached_response('test_results')
+def get_profile_trends():
+    """
+    Returns score and study-time trends from the daily rollups.
+    
+    Query: period=day|week|month (default week), days=<history length>.
+    """
+    user_id = current_user()
+    period = request.args.get('period', 'week')
+    if period not in TREND_WINDOWS:
+        return jsonify({"error": "Invalid period", "message": f"Use one of: {', '.join(TREND_WINDOWS)}"}), 400
+    default_days, max_days = TREND_WINDOWS[period]
+    try:
+        days = int(request.args.get('days', default_days))
+    except ValueError:
+        return jsonify({"error": "Invalid days", "message": "days must be an integer"}), 400
+    days = max(1, min(days, max_days))
+    
+    # Rollups bucket by SQLite's date('now'), a UTC date, so count days back from today in UTC
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date()
+    # Start on a Monday / the 1st, matching rollups.PERIODS, so the first point isn't a partial week/month
+    if period == 'week':
+        since -= timedelta(days=since.weekday())
+    elif period == 'month':
+        since = since.replace(day=1)
+    since = since.isoformat()
+    logger.debug(f'🔍 Fetching {period} trends since {since} for user_id: {user_id}')
+    points = rollups.trends(user_id, period, since)
+    logger.debug(f'   ✅ Returning {len(points)} trend points')
+    return jsonify({"period": period, "since": since, "points": points})
+
+
 @app.route('/api/v1/presets', methods=['GET'])
+@cached_response()
 def get_presets():
     """
     Returns hardcoded preset test options.
     """
-    logger.info('🔍 Fetching presets (hardcoded data)')
+    logger.debug('🔍 Fetching presets (hardcoded data)')
     presets = [
         {
             "id": "GRE",
@@ -292,7 +852,7 @@ def get_presets():
         }
     ]
     
-    logger.info(f'   ✅ Returning {len(presets)} presets')
+    logger.debug(f'   ✅ Returning {len(presets)} presets')
     return jsonify(presets)
 
 
@@ -347,14 +907,21 @@ def generate_mock_questions(exam_name, num_questions, question_format, difficult
 
 
 def map_to_opus(payload):
-    """Map frontend format to Opus format"""
+    """
+    Map frontend format to Opus format. A syllabusId takes the place of
+    syllabusContent with the uploaded syllabus's bounded prompt; raises
+    syllabi.UnknownSyllabus if the current user has no such syllabus.
+    """
     exam_type = payload.get('examType', 'custom')
     
     if exam_type == 'custom':
         exam_name = payload.get('examName', 'Custom Test')
         num_questions = payload.get('numQuestions', 10)
         question_format = payload.get('questionFormat', 'objective')
-        syllabus_content = payload.get('syllabusContent', '')
+        if payload.get('syllabusId'):
+            syllabus_content = syllabi.prompt_for(payload['syllabusId'], current_user())
+        else:
+            syllabus_content = payload.get('syllabusContent', '')
         preset_duration = 'Standard'
     else:
         exam_name = f"{exam_type} Practice Test"
@@ -415,7 +982,300 @@ def map_from_opus(opus_questions):
     return frontend_questions
 
 
+def extract_opus_questions(opus_result):
+    """Pull the raw question list out of a generation workflow result"""
+    if not isinstance(opus_result, dict):
+        return []
+    
+    # Extract questions from jobResultsPayloadSchema
+    schema = opus_result.get('jobResultsPayloadSchema', {})
+    # Find the questions field (could be 'quiz_questions' or similar)
+    opus_questions = []
+    for key, value in schema.items():
+        if isinstance(value, dict) and 'value' in value:
+            opus_questions = value['value']
+            break
+    
+    if not opus_questions:
+        opus_questions = opus_result.get('questions', [])
+    return opus_questions
+
+
+def save_generated_test(payload, opus_inputs, test_data, num_questions, user_id=None):
+    """
+    Persist a generated test for user_id (default: the current user) and
+    return its serialized test_data, which can be sent as the response as is.
+    """
+    user_id = user_id or current_user()
+    body = app.json.dumps(test_data)
+    conn = get_db_connection(user_id)
+    database.ensure_table(conn, database.add_generated_tests_columns)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO generated_tests 
+        (user_id, test_id, exam_type, exam_name, num_questions, question_format, 
+         difficulty, preset_duration, syllabus_content, test_data, opus_inputs)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        user_id, test_data['id'], payload.get('examType', 'custom'), test_data['name'],
+        num_questions, 'objective', payload.get('difficulty', 'standard'),
+        None, opus_inputs.get('SYLLABUS_CONTENT', ''), body, json.dumps(opus_inputs)
+    ))
+    conn.commit()
+    conn.close()
+    record_write(user_id, 'generated_tests')
+    return body
+
+
+def plan_generation(opus_inputs, num_questions, user_id=None):
+    """
+    Split a generation request between the question bank and Opus.
+    
+    Returns (bank_questions, opus_inputs for the shortfall), with None in
+    place of the inputs when the bank covers the whole test.
+    """
+    if not QUESTION_BANK:
+        return [], opus_inputs
+    user_id = user_id or current_user()
+    bank_questions = question_bank.pick(user_id, question_bank.match_key(opus_inputs), num_questions)
+    metrics.questions_served.inc(len(bank_questions), source='bank')
+    shortfall = num_questions - len(bank_questions)
+    if shortfall <= 0:
+        logger.info(f'📚 All {num_questions} questions served from the question bank')
+        return bank_questions, None
+    if bank_questions:
+        logger.info(f'📚 {len(bank_questions)} questions from the question bank, asking Opus for {shortfall}')
+    return bank_questions, {**opus_inputs, "NUMBER_OF_QUESTIONS": shortfall}
+
+
+def bank_questions_from(opus_questions, opus_inputs, test_id):
+    """Map Opus questions and add them to the question bank (sets bankId on each)"""
+    questions = map_from_opus(opus_questions)
+    metrics.questions_served.inc(len(questions), source='opus')
+    return question_bank.add(questions, question_bank.match_key(opus_inputs), test_id)
+
+
+def take_prefetched_test(opus_inputs, user_id=None, wait=PREFETCH_CLAIM_WAIT, deadline=None):
+    """
+    The speculative follow-up test held for exactly these generation inputs,
+    or None. Waits up to wait seconds (and not past deadline) for one that is
+    still being generated; after that the caller generates normally.
+    """
+    if not PREFETCH:
+        return None
+    user_id = user_id or current_user()
+    if deadline is not None:
+        wait = min(wait, max(deadline - time.time(), 0))
+    test_data = prefetch.claim(user_id, job_ledger.input_hash(OpusClient.WORKFLOW_ID, opus_inputs), wait)
+    metrics.prefetches.inc(outcome='hit' if test_data else 'miss')
+    if test_data:
+        metrics.questions_served.inc(len(test_data['questions']), source='prefetch')
+        logger.info(f'⚡ Serving prefetched test {test_data["id"]}')
+    return test_data
+
+
+def schedule_prefetch(test_id, opus_inputs, weaknesses, user_id=None):
+    """
+    After a test is graded, start generating its likely follow-up (same
+    settings, focused on the reported weaknesses) in the background.
+    """
+    if not PREFETCH or not opus_inputs or draining.is_set():
+        return
+    if opus_scheduler.queue_depth():
+        # Live requests are already waiting for Opus; don't add speculative work
+        metrics.prefetches.inc(outcome='skipped_busy')
+        return
+    user_id = user_id or current_user()
+    request_hash = job_ledger.input_hash(OpusClient.WORKFLOW_ID, opus_inputs)
+    prefetch_id, reason = prefetch.reserve(user_id, request_hash, test_id, OPUS_JOB_LEASE,
+                                           PREFETCH_DAILY_LIMIT, PREFETCH_MAX_IN_FLIGHT)
+    if prefetch_id is None:
+        metrics.prefetches.inc(outcome=f'skipped_{reason}')
+        logger.debug(f'Prefetch after {test_id} skipped: {reason}')
+        return
+    metrics.prefetches.inc(outcome='started')
+    logger.info(f'🔮 Prefetching follow-up to test {test_id}')
+    threading.Thread(target=run_prefetch, args=(prefetch_id, user_id, opus_inputs, weaknesses),
+                     name=f'prefetch-{prefetch_id}', daemon=True).start()
+
+
+def run_prefetch(prefetch_id, user_id, opus_inputs, weaknesses):
+    """Generate a speculative follow-up test at prefetch priority and hold it for PREFETCH_TTL"""
+    inputs = dict(opus_inputs)
+    if weaknesses:
+        inputs['SYLLABUS_CONTENT'] = (f"{inputs.get('SYLLABUS_CONTENT', '')}\n\n"
+                                      f"Focus on these weak areas: {'; '.join(map(str, weaknesses))}").strip()
+    try:
+        with opus_scheduler.slot(user_id, PRIORITY_PREFETCH):
+            opus_result = opus_client().run_workflow(inputs, max_wait=OPUS_MAX_WAIT)
+        test_id = str(uuid.uuid4())
+        questions = bank_questions_from(extract_opus_questions(opus_result), inputs, test_id)
+        test_data = build_test_data(test_id, inputs['EXAM_NAME'], inputs['NUMBER_OF_QUESTIONS'], questions)
+        prefetch.fulfil(prefetch_id, test_data, PREFETCH_TTL)
+        metrics.prefetches.inc(outcome='ready')
+        logger.info(f'🔮 Prefetched test {test_id} ready ({len(questions)} questions)')
+    except Exception as e:
+        prefetch.fail(prefetch_id, str(e))
+        metrics.prefetches.inc(outcome='failed')
+        logger.warning(f'⚠️ Prefetch {prefetch_id} failed: {e}')
+
+
+def build_test_data(test_id, exam_name, num_questions, questions):
+    """Response body for a generated test"""
+    return {
+        "id": test_id,
+        "name": exam_name,
+        "subject": exam_name,
+        "duration": num_questions * 2,
+        "questions": questions
+    }
+
+
+def run_ledger_workflow(kind, inputs, context, workflow_id=None, on_phase=None, reuse_completed_within=0,
+                        priority=None, user_id=None, deadline=None, cancelled=None):
+    """
+    Run an Opus workflow recorded in the opus_jobs ledger.
+    
+    If a job with identical inputs is already running for this user, wait for
+    it instead of starting another (and, with reuse_completed_within, also
+    reuse one that completed recently). `context` is whatever a restarted
+    process needs to persist the results should this one die mid-job.
+    
+    New jobs wait for a slot from the Opus scheduler at `priority` (by
+    default grading ahead of generation); OpusQueueFull propagates when
+    none can be had.
+    
+    deadline and cancelled are passed on to run_workflow; a job abandoned
+    through them raises OpusCancelled and is recorded as cancelled.
+    
+    Returns (ledger_id, result). ledger_id is None when the result came from
+    another request's job. That job's request (or the resumer) persists
+    it: a generation still saves its own test under its own id, but a
+    grading must not be saved again, since identical grading inputs are the
+    same submission.
+    """
+    user_id = user_id or current_user()
+    workflow_id = workflow_id or OpusClient.WORKFLOW_ID
+    hash_ = job_ledger.input_hash(workflow_id, inputs)
+    
+    duplicate = job_ledger.find_duplicate(user_id, kind, hash_, JOB_STALE_SECONDS, reuse_completed_within)
+    if duplicate is not None:
+        logger.info(f'🔁 Reusing {kind} job {duplicate["id"]} ({duplicate["status"]}) with identical inputs')
+        if on_phase:
+            on_phase('reused', jobId=duplicate['job_execution_id'])
+        row = job_ledger.wait_for(duplicate['id'], OPUS_MAX_WAIT if deadline is None
+                                  else max(0, min(OPUS_MAX_WAIT, deadline - time.time())))
+        if row['status'] == 'completed':
+            return None, json.loads(row['result'])
+        if deadline is not None and time.time() >= deadline:
+            raise OpusCancelled('Deadline passed', 'deadline')
+        raise OpusAPIError(f"Reused job ended with status {row['status']}: {row['error']}")
+    
+    if priority is None:
+        priority = PRIORITY_GRADING if kind == 'grading' else PRIORITY_GENERATION
+    with opus_scheduler.slot(user_id, priority, timeout=deadline - time.time() if deadline else None):
+        ledger_id = job_ledger.create(user_id, kind, workflow_id, hash_, {**context, "inputs": inputs})
+        try:
+            with job_ledger.heartbeat(ledger_id, JOB_HEARTBEAT_SECONDS):
+                result = opus_client().run_workflow(inputs, max_wait=OPUS_MAX_WAIT, workflow_id=workflow_id,
+                                                    on_phase=job_ledger.phase_recorder(ledger_id, on_phase),
+                                                    deadline=deadline, cancelled=cancelled)
+        except OpusTimeoutError as e:
+            job_ledger.update(ledger_id, status='timeout', error=str(e))
+            raise
+        except OpusCancelled as e:
+            job_ledger.update(ledger_id, status='cancelled', error=str(e))
+            raise
+        except Exception as e:
+            job_ledger.update(ledger_id, status='failed', error=str(e))
+            raise
+    job_ledger.update(ledger_id, status='completed', result=result)
+    return ledger_id, result
+
+
+def opus_busy_response(error):
+    """429 for a request whose Opus job could not be admitted"""
+    logger.warning(f'   ⚠️  Opus queue full: {error}')
+    response = jsonify({
+        "error": "Too many requests",
+        "message": f"{error}, please retry shortly",
+        "retryAfter": error.retry_after
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def abandoned_error(error):
+    """(status, body) for an abandoned Opus job: 504 if its deadline passed, 499 (client closed request) otherwise"""
+    if error.reason == 'deadline':
+        return 504, {"error": "Deadline exceeded", "message": "The request timeout passed before Opus finished"}
+    return 499, {"error": "Client closed request", "message": str(error)}
+
+
+def abandoned_response(error):
+    """Error response for a request whose Opus job was abandoned"""
+    logger.warning(f'   🛑 Opus job abandoned: {error}')
+    status, body = abandoned_error(error)
+    return jsonify(body), status
+
+
+@app.route('/api/v1/syllabi', methods=['POST'])
+def upload_syllabus():
+    """
+    Upload a UTF-8 text syllabus, streamed to disk
+    
+    Body: the syllabus itself (text/plain, ?name=...), or multipart/form-data
+    with a `file` part (and optional `name` field).
+    
+    Returns 201 for a new syllabus, 200 if the user already uploaded the same text:
+    {"id": "<sha256>", "name": "...", "sizeBytes": 48213, "chunks": 13, "promptChars": 7950, "uploadedAt": "..."}
+    Pass the id as `syllabusId` to /tests/generate instead of syllabusContent.
+    """
+    if request.content_length is not None and request.content_length > syllabi.MAX_BYTES:
+        return jsonify({"error": "Syllabus too large", "message": f"Limit is {syllabi.MAX_BYTES} bytes"}), 413
+    
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({"error": "No file provided", "message": "Send the syllabus in a `file` part"}), 400
+        stream, name = upload.stream, request.form.get('name') or upload.filename
+    else:
+        stream, name = request.stream, request.args.get('name')
+    
+    try:
+        syllabus, created = syllabi.store(stream, current_user(), name)
+    except syllabi.SyllabusTooLarge as e:
+        metrics.syllabus_uploads.inc(outcome='too_large')
+        return jsonify({"error": "Syllabus too large", "message": str(e)}), 413
+    except ValueError as e:
+        metrics.syllabus_uploads.inc(outcome='invalid')
+        return jsonify({"error": "Invalid syllabus", "message": str(e)}), 400
+    
+    metrics.syllabus_uploads.inc(outcome='stored' if created else 'duplicate')
+    logger.info(f'📚 Syllabus {syllabus["id"][:12]} {"stored" if created else "already uploaded"} '
+                f'({syllabus["sizeBytes"]} bytes, {syllabus["chunks"]} chunks)')
+    return jsonify(syllabus), 201 if created else 200
+
+
+@app.route('/api/v1/syllabi', methods=['GET'])
+def list_syllabi():
+    """Syllabi the current user has uploaded, newest first"""
+    return jsonify({"syllabi": syllabi.list_for(current_user())})
+
+
+@app.route('/api/v1/syllabi/<syllabus_id>', methods=['GET'])
+def get_syllabus(syllabus_id):
+    """One uploaded syllabus, including the prompt sent to Opus for it"""
+    try:
+        return jsonify(syllabi.describe(syllabus_id, current_user()))
+    except syllabi.UnknownSyllabus as e:
+        return jsonify({"error": "Syllabus not found", "message": str(e)}), 404
+
+
 @app.route('/api/v1/tests/generate', methods=['POST'])
+@idempotent
+@opus_backed
 def generate_test():
     """Generate test using Opus AI"""
     logger.info('🎯 Generate Test endpoint called')
@@ -426,68 +1286,64 @@ def generate_test():
             return jsonify({"error": "No payload provided"}), 400
         
         # Map to Opus format
-        opus_inputs, exam_name, num_questions = map_to_opus(payload)
-        logger.info(f'📤 Opus inputs: {opus_inputs}')
+        try:
+            opus_inputs, exam_name, num_questions = map_to_opus(payload)
+        except syllabi.UnknownSyllabus as e:
+            return jsonify({"error": "Syllabus not found", "message": str(e)}), 404
+        logger.debug('📤 Opus inputs: %s', Truncated(opus_inputs))
+        try:
+            deadline = request_deadline()
+        except ValueError as e:
+            return jsonify({"error": "Invalid request timeout", "message": str(e)}), 400
+        user_id = current_user()
+        test_id = str(uuid.uuid4())
+        ledger_id = None
+        
+        prefetched = take_prefetched_test(opus_inputs, deadline=deadline)
+        if prefetched:
+            test_id, questions, opus_request = prefetched['id'], prefetched['questions'], None
+        else:
+            # Reuse unseen questions from the bank; Opus only generates the rest
+            questions, opus_request = plan_generation(opus_inputs, num_questions)
         
         # Call Opus
         try:
-            opus = OpusClient()
-            opus_result = opus.run_workflow(opus_inputs)
-            logger.info(f'✅ Opus completed')
-            logger.info(f'Opus result structure: {list(opus_result.keys()) if isinstance(opus_result, dict) else type(opus_result)}')
-            
-            # Extract questions from jobResultsPayloadSchema
-            if isinstance(opus_result, dict):
-                schema = opus_result.get('jobResultsPayloadSchema', {})
-                # Find the questions field (could be 'quiz_questions' or similar)
-                opus_questions = []
-                for key, value in schema.items():
-                    if isinstance(value, dict) and 'value' in value:
-                        opus_questions = value['value']
-                        break
+            if opus_request is not None:
+                ledger_id, opus_result = run_ledger_workflow('generation', opus_request, {
+                    "payload": payload, "testId": test_id, "examName": exam_name, "numQuestions": num_questions,
+                    "bankQuestions": questions
+                }, deadline=deadline, cancelled=disconnect_check())
+                logger.info(f'✅ Opus completed')
+                logger.debug('Opus result structure: %s', list(opus_result.keys()) if isinstance(opus_result, dict) else type(opus_result))
                 
-                if not opus_questions:
-                    opus_questions = opus_result.get('questions', [])
-            else:
-                opus_questions = []
-            
-            logger.info(f'📝 Extracted {len(opus_questions)} questions from Opus')
-            
-            # Map from Opus
-            questions = map_from_opus(opus_questions)
-            logger.info(f'✅ Mapped {len(questions)} questions')
+                opus_questions = extract_opus_questions(opus_result)
+                logger.info(f'📝 Extracted {len(opus_questions)} questions from Opus')
+                
+                # Map from Opus
+                questions = questions + bank_questions_from(opus_questions, opus_request, test_id)
+                logger.info(f'✅ Mapped {len(questions)} questions')
             
+        except OpusQueueFull as e:
+            return opus_busy_response(e)
+        except OpusCancelled as e:
+            # Nobody is waiting for mock questions either
+            return abandoned_response(e)
         except Exception as e:
             logger.error(f'❌ Opus failed: {e}, using mock')
-            questions = generate_mock_questions(exam_name, num_questions, 'objective', 'standard')
+            metrics.fallbacks.inc(kind='mock_questions')
+            mock = generate_mock_questions(exam_name, num_questions - len(questions), 'objective', 'standard')
+            metrics.questions_served.inc(len(mock), source='mock')
+            questions = questions + mock
         
         # Create response
-        test_id = str(uuid.uuid4())
-        test_data = {
-            "id": test_id,
-            "name": exam_name,
-            "subject": exam_name,
-            "duration": num_questions * 2,
-            "questions": questions
-        }
+        question_bank.mark_seen(user_id, questions)
+        test_data = build_test_data(test_id, exam_name, num_questions, questions)
         
-        # Save to DB
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO generated_tests 
-            (user_id, test_id, exam_type, exam_name, num_questions, question_format, 
-             difficulty, preset_duration, syllabus_content, test_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            USER_ID, test_id, payload.get('examType', 'custom'), exam_name,
-            num_questions, 'objective', payload.get('difficulty', 'standard'),
-            None, opus_inputs.get('SYLLABUS_CONTENT', ''), json.dumps(test_data)
-        ))
-        conn.commit()
-        conn.close()
-        
-        logger.info(f'✅ Test saved: {test_id}')
+        if ledger_id is None or job_ledger.claim_persist(ledger_id):
+            body = save_generated_test(payload, opus_inputs, test_data, num_questions)
+            logger.info(f'✅ Test saved: {test_id}')
+            return json_response(body, 201)
+        logger.warning(f'⚠️ Test {test_id} was already saved by a resumed job')
         return jsonify(test_data), 201
         
     except Exception as e:
@@ -495,7 +1351,244 @@ def generate_test():
         return jsonify({"error": "Failed to generate test", "message": str(e)}), 500
 
 
+# Seconds between SSE keepalive comments while waiting on Opus
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/api/v1/tests/generate/stream', methods=['POST'])
+@opus_backed
+def generate_test_stream():
+    """
+    Generate a test and stream progress as Server-Sent Events.
+    
+    Takes the same body as /tests/generate. Events, in order:
+      test      {"id", "name", "subject", "duration"}        test header
+      phase     {"phase": "initiated" | "executing" | "polling" | "completed" | "reused" | "fallback", ...}
+      question  {"index": 0, "question": {...}}               one per question, as soon as mapped
+      saved     {"id", "numQuestions"}                         test persisted
+      error     {"error", "message"[, "retryAfter"]}             retryAfter when the Opus queue is full
+    
+    Closing the stream early cancels the Opus job, as does an
+    X-Request-Timeout / ?timeout= deadline passing.
+    
+    EventSource only issues GETs, so clients read this with fetch() and a
+    stream reader.
+    """
+    logger.info('🎯 Generate Test (stream) endpoint called')
+    
+    payload = request.get_json(silent=True)
+    if not payload:
+        return jsonify({"error": "No payload provided"}), 400
+    
+    try:
+        opus_inputs, exam_name, num_questions = map_to_opus(payload)
+    except syllabi.UnknownSyllabus as e:
+        return jsonify({"error": "Syllabus not found", "message": str(e)}), 404
+    try:
+        deadline = request_deadline()
+    except ValueError as e:
+        return jsonify({"error": "Invalid request timeout", "message": str(e)}), 400
+    user_id = current_user()
+    test_id = str(uuid.uuid4())
+    # Only a finished prefetch; waiting on a running one would delay the first event
+    prefetched = take_prefetched_test(opus_inputs, wait=0)
+    if prefetched:
+        test_id, bank_questions, opus_request = prefetched['id'], prefetched['questions'], None
+    else:
+        bank_questions, opus_request = plan_generation(opus_inputs, num_questions)
+    events = queue.Queue()
+    # Set when the stream is closed early, i.e. the client went away
+    closed = threading.Event()
+    client_gone = disconnect_check()
+    
+    def on_phase(phase, **details):
+        events.put(('phase', {"phase": phase, **details}))
+    
+    def run():
+        try:
+            events.put(('result', run_ledger_workflow('generation', opus_request, {
+                "payload": payload, "testId": test_id, "examName": exam_name, "numQuestions": num_questions,
+                "bankQuestions": bank_questions
+            }, on_phase=on_phase, user_id=user_id, deadline=deadline,
+                cancelled=lambda: 'disconnected' if closed.is_set() else client_gone())))
+        except OpusQueueFull as e:
+            events.put(('busy', e))
+        except OpusCancelled as e:
+            events.put(('cancelled', e))
+        except Exception as e:
+            events.put(('failed', e))
+    
+    if opus_request is None:
+        events.put(('result', (None, None)))
+    else:
+        threading.Thread(target=run, daemon=True).start()
+    
+    def stream():
+        try:
+            yield from relay()
+        finally:
+            closed.set()
+    
+    def relay():
+        header = {"id": test_id, "name": exam_name, "subject": exam_name, "duration": num_questions * 2}
+        yield sse_event('test', header)
+        
+        # Questions from the bank are ready straight away
+        questions = []
+        for question in bank_questions:
+            yield sse_event('question', {"index": len(questions), "question": question})
+            questions.append(question)
+        
+        # Relay phase changes until Opus finishes
+        while True:
+            try:
+                kind, data = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if kind == 'phase':
+                yield sse_event('phase', data)
+                continue
+            break
+        
+        ledger_id = None
+        if kind == 'busy':
+            logger.warning(f'   ⚠️  Opus queue full: {data}')
+            yield sse_event('error', {"error": "Too many requests", "message": str(data), "retryAfter": data.retry_after})
+            return
+        if kind == 'cancelled':
+            logger.warning(f'   🛑 Opus job abandoned: {data}')
+            yield sse_event('error', abandoned_error(data)[1])
+            return
+        if kind == 'result':
+            ledger_id, opus_result = data
+            source = ((q, True) for q in extract_opus_questions(opus_result)) if opus_result else ()
+        else:
+            logger.error(f'❌ Opus failed: {data}, using mock')
+            metrics.fallbacks.inc(kind='mock_questions')
+            yield sse_event('phase', {"phase": "fallback", "message": str(data)})
+            mock = generate_mock_questions(exam_name, num_questions - len(questions), 'objective', 'standard')
+            metrics.questions_served.inc(len(mock), source='mock')
+            source = ((q, False) for q in mock)
+        
+        # Map and send each question as soon as it is ready
+        for question, from_opus in source:
+            mapped = bank_questions_from([question], opus_request, test_id)[0] if from_opus else question
+            yield sse_event('question', {"index": len(questions), "question": mapped})
+            questions.append(mapped)
+        
+        question_bank.mark_seen(user_id, questions)
+        test_data = {**header, "questions": questions}
+        try:
+            if ledger_id is None or job_ledger.claim_persist(ledger_id):
+                save_generated_test(payload, opus_inputs, test_data, num_questions, user_id=user_id)
+                logger.info(f'✅ Test saved: {test_id}')
+            yield sse_event('saved', {"id": test_id, "numQuestions": len(questions)})
+        except Exception as e:
+            logger.error(f'❌ Error: {e}', exc_info=True)
+            yield sse_event('error', {"error": "Failed to save test", "message": str(e)})
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def grading_response(submission, opus_result):
+    """Build the submit response from a grading workflow result"""
+    # Extract grading results from jobResultsPayloadSchema
+    grading_data = {}
+    if isinstance(opus_result, dict):
+        schema = opus_result.get('jobResultsPayloadSchema', {})
+        
+        logger.info(f'📊 Extracting from {len(schema)} output fields')
+        
+        # Extract by display_name
+        for var_name, info in schema.items():
+            if isinstance(info, dict) and 'value' in info:
+                display_name = info.get('display_name', '').lower()
+                field_value = info['value']
+                
+                logger.debug('  ✓ %s: %s', info.get('display_name'), Truncated(field_value))
+                
+                # Map by exact display_name matching
+                if display_name == 'strength':
+                    grading_data['strengths'] = field_value if isinstance(field_value, list) else [field_value]
+                elif display_name == 'weakness':
+                    grading_data['weaknesses'] = field_value if isinstance(field_value, list) else [field_value]
+                elif 'ai summary' in display_name:
+                    grading_data['aiSummary'] = field_value
+                elif display_name == 'score':
+                    grading_data['score'] = int(field_value)
+                elif 'total questions' in display_name:
+                    grading_data['totalQuestions'] = int(field_value)
+                elif 'correctly answered' in display_name:
+                    grading_data['correctAnswers'] = int(field_value)
+    
+    total_questions = len(submission.get('fullTestContext', {}).get('questions', []))
+    return {
+        "score": grading_data.get('score', 0),
+        "aiSummary": grading_data.get('aiSummary', 'Test completed'),
+        "strengths": grading_data.get('strengths', []),
+        "weaknesses": grading_data.get('weaknesses', []),
+        "correctAnswers": grading_data.get('correctAnswers', 0),
+        "totalQuestions": grading_data.get('totalQuestions', total_questions)
+    }
+
+
+def save_test_result(submission, response, user_id=None):
+    """Insert a graded submission into test_results for user_id (default: the current user)"""
+    user_id = user_id or current_user()
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    
+    database.ensure_table(conn, database.add_test_results_columns)
+    rollups.ensure(conn)
+    item_analysis.ensure(conn)
+    
+    # Insert result
+    cursor.execute('''
+        INSERT INTO test_results 
+        (user_id, test_id, test_name, score, duration_seconds, questions_answered, 
+         total_questions, strengths, weaknesses, ai_summary)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        user_id,
+        submission.get('fullTestContext', {}).get('id'),
+        submission.get('fullTestContext', {}).get('name', 'Test'),
+        response['score'],
+        submission.get('durationSeconds', 0),
+        response['correctAnswers'],
+        response['totalQuestions'],
+        json.dumps(response['strengths']),
+        json.dumps(response['weaknesses']),
+        response['aiSummary']
+    ))
+    rollups.record(conn, user_id, response['score'], submission.get('durationSeconds', 0),
+                   response['correctAnswers'], response['totalQuestions'])
+    item_analysis.record(conn, user_id, submission)
+    
+    conn.commit()
+    conn.close()
+    record_write(user_id, 'test_results')
+    score_histograms.record(submission.get('fullTestContext', {}).get('name', 'Test'), response['score'])
+
+
+def score_percentile(test_name, score):
+    """Percentile rank of a score among all results for the test name, or None below PERCENTILE_MIN_SAMPLE"""
+    percentile, sample_size = score_histograms.rank(test_name, score)
+    return percentile if sample_size >= PERCENTILE_MIN_SAMPLE else None
+
+
 @app.route('/api/v1/tests/submit', methods=['POST'])
+@idempotent
+@opus_backed
 def submit_test():
     """
     Submit test for grading using Opus AI
@@ -518,8 +1611,13 @@ def submit_test():
       "strengths": [...],
       "weaknesses": [...],
       "correctAnswers": 17,
-      "totalQuestions": 20
+      "totalQuestions": 20,
+      "percentile": 82.5
     }
+    
+    percentile is the share of all results for the same test name scoring
+    below this one (ties count half), or null while there are fewer than
+    PERCENTILE_MIN_SAMPLE of them.
     """
     logger.info('📝 Submit Test endpoint called')
     
@@ -529,121 +1627,69 @@ def submit_test():
             return jsonify({"error": "No submission data"}), 400
         
         logger.info(f'📤 Processing test submission')
+        try:
+            deadline = request_deadline()
+        except ValueError as e:
+            return jsonify({"error": "Invalid request timeout", "message": str(e)}), 400
         
         # Extract syllabus from stored test data if available
         syllabus_text = ""
+        test_inputs = None
         test_id = submission.get('fullTestContext', {}).get('id')
         
         if test_id:
             try:
-                conn = get_db_connection()
+                conn = get_db_connection(current_user())
+                database.ensure_table(conn, database.add_generated_tests_columns)
                 cursor = conn.cursor()
-                cursor.execute('SELECT syllabus_content FROM generated_tests WHERE test_id = ?', (test_id,))
+                cursor.execute('SELECT syllabus_content, opus_inputs FROM generated_tests WHERE test_id = ?', (test_id,))
                 row = cursor.fetchone()
                 if row and row[0]:
                     syllabus_text = row[0]
+                if row and row[1]:
+                    test_inputs = json.loads(row[1])
                 conn.close()
             except:
                 pass
         
         # Call Opus grading
         try:
-            opus = OpusClient()
-            opus_result = opus.grade_test(submission, syllabus_text)
+            ledger_id, opus_result = run_ledger_workflow(
+                'grading', OpusClient.grading_inputs(submission, syllabus_text),
+                {"submission": submission, "testId": test_id},
+                workflow_id=OpusClient.GRADING_WORKFLOW_ID, reuse_completed_within=GRADING_REUSE_SECONDS,
+                deadline=deadline, cancelled=disconnect_check())
             logger.info(f'✅ Opus grading completed')
-            logger.info(f'Opus result keys: {list(opus_result.keys()) if isinstance(opus_result, dict) else type(opus_result)}')
-            
-            # Extract grading results from jobResultsPayloadSchema
-            grading_data = {}
-            if isinstance(opus_result, dict):
-                schema = opus_result.get('jobResultsPayloadSchema', {})
-                
-                logger.info(f'📊 Extracting from {len(schema)} output fields')
-                
-                # Extract by display_name
-                for var_name, info in schema.items():
-                    if isinstance(info, dict) and 'value' in info:
-                        display_name = info.get('display_name', '').lower()
-                        field_value = info['value']
-                        
-                        logger.info(f'  ✓ {info.get("display_name")}: {field_value}')
-                        
-                        # Map by exact display_name matching
-                        if display_name == 'strength':
-                            grading_data['strengths'] = field_value if isinstance(field_value, list) else [field_value]
-                        elif display_name == 'weakness':
-                            grading_data['weaknesses'] = field_value if isinstance(field_value, list) else [field_value]
-                        elif 'ai summary' in display_name:
-                            grading_data['aiSummary'] = field_value
-                        elif display_name == 'score':
-                            grading_data['score'] = int(field_value)
-                        elif 'total questions' in display_name:
-                            grading_data['totalQuestions'] = int(field_value)
-                        elif 'correctly answered' in display_name:
-                            grading_data['correctAnswers'] = int(field_value)
-            
-            # Build response
-            total_questions = len(submission.get('fullTestContext', {}).get('questions', []))
-            response = {
-                "score": grading_data.get('score', 0),
-                "aiSummary": grading_data.get('aiSummary', 'Test completed'),
-                "strengths": grading_data.get('strengths', []),
-                "weaknesses": grading_data.get('weaknesses', []),
-                "correctAnswers": grading_data.get('correctAnswers', 0),
-                "totalQuestions": grading_data.get('totalQuestions', total_questions)
-            }
+            logger.debug('Opus result keys: %s', list(opus_result.keys()) if isinstance(opus_result, dict) else type(opus_result))
             
+            response = grading_response(submission, opus_result)
             logger.info(f'✅ Grading: {response["correctAnswers"]}/{response["totalQuestions"]} - Score: {response["score"]}%')
             
             # Save grading results to database
             try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                # Check if test_results has strengths/weaknesses columns, add if not
-                cursor.execute("PRAGMA table_info(test_results)")
-                columns = [col[1] for col in cursor.fetchall()]
-                
-                if 'strengths' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN strengths TEXT')
-                if 'weaknesses' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN weaknesses TEXT')
-                if 'ai_summary' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN ai_summary TEXT')
-                if 'test_id' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN test_id TEXT')
-                
-                # Insert result
-                cursor.execute('''
-                    INSERT INTO test_results 
-                    (user_id, test_id, test_name, score, duration_seconds, questions_answered, 
-                     total_questions, strengths, weaknesses, ai_summary)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    USER_ID,
-                    test_id,
-                    submission.get('fullTestContext', {}).get('name', 'Test'),
-                    response['score'],
-                    submission.get('durationSeconds', 0),
-                    response['correctAnswers'],
-                    response['totalQuestions'],
-                    json.dumps(response['strengths']),
-                    json.dumps(response['weaknesses']),
-                    response['aiSummary']
-                ))
-                
-                conn.commit()
-                conn.close()
-                logger.info(f'💾 Grading results saved to database')
+                if ledger_id is None:
+                    logger.info(f'🔁 Identical submission already graded and saved, not saving again')
+                elif job_ledger.claim_persist(ledger_id):
+                    save_test_result(submission, response)
+                    logger.info(f'💾 Grading results saved to database')
             except Exception as e:
                 logger.error(f'⚠️ Failed to save results: {e}')
             
+            schedule_prefetch(test_id, test_inputs, response['weaknesses'])
+            response['percentile'] = score_percentile(submission.get('fullTestContext', {}).get('name', 'Test'),
+                                                      response['score'])
             return jsonify(response), 200
             
+        except OpusQueueFull as e:
+            return opus_busy_response(e)
+        except OpusCancelled as e:
+            # Nobody is waiting for a grade, so don't fall back to a manual one and save it
+            return abandoned_response(e)
         except Exception as e:
             logger.error(f'❌ Opus grading failed: {e}', exc_info=True)
             
             # Fallback: Manual grading
+            metrics.fallbacks.inc(kind='manual_grading')
             answers = submission.get('answers', {})
             questions = submission.get('fullTestContext', {}).get('questions', [])
             
@@ -667,45 +1713,13 @@ def submit_test():
             
             # Save fallback results to database
             try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                cursor.execute("PRAGMA table_info(test_results)")
-                columns = [col[1] for col in cursor.fetchall()]
-                
-                if 'strengths' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN strengths TEXT')
-                if 'weaknesses' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN weaknesses TEXT')
-                if 'ai_summary' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN ai_summary TEXT')
-                if 'test_id' not in columns:
-                    cursor.execute('ALTER TABLE test_results ADD COLUMN test_id TEXT')
-                
-                cursor.execute('''
-                    INSERT INTO test_results 
-                    (user_id, test_id, test_name, score, duration_seconds, questions_answered, 
-                     total_questions, strengths, weaknesses, ai_summary)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    USER_ID,
-                    test_id,
-                    submission.get('fullTestContext', {}).get('name', 'Test'),
-                    score,
-                    submission.get('durationSeconds', 0),
-                    correct,
-                    total,
-                    json.dumps([]),
-                    json.dumps([]),
-                    response['aiSummary']
-                ))
-                
-                conn.commit()
-                conn.close()
+                save_test_result(submission, response)
                 logger.info(f'💾 Fallback results saved')
             except Exception as db_error:
                 logger.error(f'⚠️ Failed to save fallback results: {db_error}')
             
+            response['percentile'] = score_percentile(submission.get('fullTestContext', {}).get('name', 'Test'),
+                                                      response['score'])
             return jsonify(response), 200
         
     except Exception as e:
@@ -713,6 +1727,75 @@ def submit_test():
         return jsonify({"error": "Failed to grade test", "message": str(e)}), 500
 
 
+@app.route('/api/v1/tests/<test_id>', methods=['GET'])
+@conditional_get('generated_tests')
+def get_generated_test(test_id):
+    """
+    Get a previously generated test, including archived ones
+    
+    Returns the same test object as /tests/generate, straight from the
+    stored JSON. Archived tests are stored zlib-compressed, which is HTTP's
+    deflate encoding, so clients accepting deflate get those bytes as they are.
+    """
+    logger.info(f'📄 Get test: {test_id}')
+    
+    try:
+        deflate = compression.COMPRESS and request.accept_encodings['deflate'] > 0
+        stored = archive.load_test(current_user(), test_id, deflate=deflate)
+        if stored is None:
+            return jsonify({"error": "Test not found"}), 404
+        body, encoding = stored
+        response = json_response(body)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+        return response
+    
+    except Exception as e:
+        logger.error(f'❌ Error: {e}', exc_info=True)
+        return jsonify({"error": "Failed to load test", "message": str(e)}), 500
+
+
+def load_test_result(user_id, test_id):
+    """
+    A user's latest stored result for a test, or None. Served from the
+    response cache until the user's test_results change.
+    """
+    version_tag, _ = resource_versions.etag(user_id, 'test_results')
+    key = (user_id, 'test_result', test_id, version_tag)
+    cached = response_cache.get(key)
+    if cached is not None:
+        logger.debug('   ⚡ Result served from cache')
+        return cached
+    
+    conn = get_db_connection(user_id)
+    row = conn.execute('''
+        SELECT test_name, score, duration_seconds, questions_answered, 
+               total_questions, strengths, weaknesses, ai_summary, completed_at
+        FROM test_results 
+        WHERE test_id = ? AND user_id = ?
+        ORDER BY completed_at DESC
+        LIMIT 1
+    ''', (test_id, user_id)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    
+    result = {
+        "score": row[1],
+        "aiSummary": row[7] if row[7] else "Test completed",
+        "strengths": json.loads(row[5]) if row[5] else [],
+        "weaknesses": json.loads(row[6]) if row[6] else [],
+        "correctAnswers": row[3],
+        "totalQuestions": row[4],
+        "testName": row[0],
+        "durationSeconds": row[2],
+        "completedAt": row[8]
+    }
+    response_cache.set(key, result, len(json.dumps(result)), user_id, ('test_results',))
+    return result
+
+
 @app.route('/api/v1/tests/<test_id>/results', methods=['GET'])
 def get_test_results(test_id):
     """
@@ -727,41 +1810,20 @@ def get_test_results(test_id):
       "correctAnswers": 17,
       "totalQuestions": 20,
       "testName": "...",
-      "completedAt": "..."
+      "completedAt": "...",
+      "percentile": 82.5
     }
     """
     logger.info(f'📊 Get test results: {test_id}')
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT test_name, score, duration_seconds, questions_answered, 
-                   total_questions, strengths, weaknesses, ai_summary, completed_at
-            FROM test_results 
-            WHERE test_id = ? AND user_id = ?
-            ORDER BY completed_at DESC
-            LIMIT 1
-        ''', (test_id, USER_ID))
-        
-        row = cursor.fetchone()
-        conn.close()
-        
-        if not row:
+        result = load_test_result(current_user(), test_id)
+        if result is None:
             return jsonify({"error": "Test results not found"}), 404
         
-        response = {
-            "score": row[1],
-            "aiSummary": row[7] if row[7] else "Test completed",
-            "strengths": json.loads(row[5]) if row[5] else [],
-            "weaknesses": json.loads(row[6]) if row[6] else [],
-            "correctAnswers": row[3],
-            "totalQuestions": row[4],
-            "testName": row[0],
-            "durationSeconds": row[2],
-            "completedAt": row[8]
-        }
+        # The result is cached per user, but its rank moves with everyone's
+        # submissions, so it is looked up fresh on every request
+        response = {**result, "percentile": score_percentile(result['testName'], result['score'])}
         
         logger.info(f'✅ Results found: {response["score"]}%')
         return jsonify(response), 200
@@ -771,18 +1833,295 @@ def get_test_results(test_id):
         return jsonify({"error": "Failed to get results", "message": str(e)}), 500
 
 
+@app.route('/api/v1/opus/callback', methods=['POST'])
+def opus_callback():
+    """
+    Job completion callback from Opus.
+    
+    Body: {"jobExecutionId": "...", "status": "COMPLETED"}. When
+    MINDCRAFTR_OPUS_CALLBACK_SECRET is set the request must carry
+    X-Opus-Signature: sha256=<HMAC-SHA256 of the body>. A callback only
+    wakes the waiting job, which confirms the status with Opus before
+    acting on it, so a forged one costs at most an extra status poll.
+    """
+    body = request.get_data()
+    secret = OpusClient.CALLBACK_SECRET
+    if secret and not hmac.compare_digest(request.headers.get('X-Opus-Signature', ''), sign_callback(secret, body)):
+        logger.warning('   ⚠️  Rejected Opus callback with a bad signature')
+        metrics.opus_callbacks.inc(outcome='rejected')
+        return jsonify({"error": "Invalid signature"}), 401
+    
+    data = request.get_json(silent=True) or {}
+    job_id = data.get('jobExecutionId')
+    status = data.get('status')
+    if not job_id or not status:
+        metrics.opus_callbacks.inc(outcome='invalid')
+        return jsonify({"error": "jobExecutionId and status are required"}), 400
+    
+    job_ledger.record_callback(job_id, status)
+    local = job_completions.notify(job_id, status)
+    metrics.opus_callbacks.inc(outcome='accepted')
+    logger.info(f'📬 Opus callback: job {job_id} {status}{" (waiting here)" if local else ""}')
+    return jsonify({"received": True})
+
+
+@app.route('/api/v1/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Returns response cache hit/miss counters and occupancy.
+    """
+    return jsonify(response_cache.stats())
+
+
+@app.route('/api/v1/prefetch/stats', methods=['GET'])
+def get_prefetch_stats():
+    """
+    Returns speculative follow-up test counts by status over the last week
+    and the hit rate (served / (served + expired)).
+    """
+    return jsonify({"enabled": PREFETCH, **prefetch.stats()})
+
+
 @app.route('/', methods=['GET'])
 def home():
     """
     Health check endpoint.
     """
-    logger.info('🏠 Health check endpoint called')
+    logger.debug('🏠 Health check endpoint called')
     return jsonify({
         "message": "MindCraftr API is running!",
         "version": "1.0.0"
     })
 
 
+@app.route('/api/v1/percentiles', methods=['GET'])
+def get_percentiles():
+    """
+    Score distribution for a test name across all users.
+    
+    Query: testName (required), score (optional). Returns the sample size,
+    the 25th/50th/75th/90th percentile scores and, with score, its
+    percentile rank.
+    """
+    test_name = request.args.get('testName', '').strip()
+    if not test_name:
+        return jsonify({"error": "Missing testName"}), 400
+    quantiles, sample_size = score_histograms.quantiles(test_name)
+    enough = sample_size >= PERCENTILE_MIN_SAMPLE
+    response = {
+        "testName": test_name,
+        "sampleSize": sample_size,
+        "quantiles": {f"p{point}": score if enough else None for point, score in quantiles.items()}
+    }
+    if 'score' in request.args:
+        try:
+            score = float(request.args['score'])
+        except ValueError:
+            return jsonify({"error": "Invalid score", "message": "score must be a number"}), 400
+        response['score'] = score
+        response['percentile'] = score_percentile(test_name, score)
+    return jsonify(response)
+
+
+@app.route('/api/v1/reports/items', methods=['GET'])
+def get_item_report():
+    """
+    Item analysis for a test name across all users' graded submissions.
+    
+    Query: testName (required), minResponses (optional, default 1) to leave
+    out questions answered fewer times. Returns the score distribution and,
+    per question bank question, its pValue, discrimination and option
+    frequencies, hardest first. See item_analysis.py.
+    """
+    test_name = request.args.get('testName', '').strip()
+    if not test_name:
+        return jsonify({"error": "Missing testName"}), 400
+    try:
+        min_responses = int(request.args.get('minResponses', 1))
+    except ValueError:
+        return jsonify({"error": "Invalid minResponses", "message": "minResponses must be an integer"}), 400
+    submissions, items = item_analysis.item_report(test_name)
+    return jsonify({
+        "testName": test_name,
+        "submissions": submissions,
+        "scores": item_analysis.score_distribution(test_name),
+        "items": [item for item in items if item['responses'] >= min_responses]
+    })
+
+
+def start_histogram_flusher():
+    """Persist this process's score histogram counts every FLUSH_SECONDS until draining"""
+    def loop():
+        while not draining.wait(percentiles.FLUSH_SECONDS):
+            try:
+                score_histograms.flush()
+            except Exception as e:
+                logger.error(f'❌ Score histogram flush failed: {e}')
+        score_histograms.flush()
+    
+    threading.Thread(target=loop, daemon=True, name='score-histogram-flusher').start()
+
+
+def start_metrics_flusher():
+    """Write this process's metrics for other workers' scrapes every FLUSH_SECONDS until draining"""
+    if metrics.registry.directory is None:
+        return
+    
+    def loop():
+        while not draining.wait(metrics.FLUSH_SECONDS):
+            try:
+                metrics.registry.flush()
+            except OSError as e:
+                logger.error(f'❌ Metrics flush failed: {e}')
+    
+    threading.Thread(target=loop, daemon=True, name='metrics-flusher').start()
+
+
+def start_archiver():
+    """Run archival compaction every ARCHIVE_INTERVAL seconds until draining"""
+    if ARCHIVE_INTERVAL <= 0:
+        return
+    
+    def loop():
+        while not draining.wait(ARCHIVE_INTERVAL):
+            try:
+                for index, result in archive.compact().items():
+                    if result and result[0]:
+                        logger.info(f'🗄️ Archived {result[0]} tests ({result[1]} bytes) from shard {index}')
+            except Exception as e:
+                logger.error(f'❌ Archival compaction failed: {e}')
+    
+    threading.Thread(target=loop, daemon=True, name='test-archiver').start()
+
+
+def persist_ledger_job(row, result):
+    """Save a resumed job's results the way its original request would have"""
+    if not job_ledger.claim_persist(row['id']):
+        return
+    context = json.loads(row['context'])
+    try:
+        if row['kind'] == 'generation':
+            questions = context.get('bankQuestions', []) + bank_questions_from(
+                extract_opus_questions(result), context['inputs'], context['testId'])
+            question_bank.mark_seen(row['user_id'], questions)
+            test_data = build_test_data(context['testId'], context['examName'], context['numQuestions'], questions)
+            save_generated_test(context['payload'], context['inputs'], test_data, context['numQuestions'],
+                                user_id=row['user_id'])
+        else:
+            save_test_result(context['submission'], grading_response(context['submission'], result),
+                             user_id=row['user_id'])
+    except Exception:
+        job_ledger.release_persist(row['id'])
+        raise
+
+
+def resume_ledger_job(row):
+    """Finish an orphaned Opus job: poll it to completion and persist its results"""
+    ledger_id = row['id']
+    logger.info(f'♻️ Resuming {row["kind"]} job {ledger_id} ({row["status"]}, Opus job {row["job_execution_id"]})')
+    try:
+        if row['status'] == 'completed':
+            result = json.loads(row['result'])
+        elif row['job_execution_id'] is None:
+            # The process died before Opus assigned a job id; there is nothing to poll
+            job_ledger.update(ledger_id, status='failed', error='Abandoned before the Opus job was initiated')
+            return
+        else:
+            context = json.loads(row['context'])
+            try:
+                with job_ledger.heartbeat(ledger_id, JOB_HEARTBEAT_SECONDS):
+                    result = opus_client().resume_workflow(
+                        row['job_execution_id'], max_wait=OPUS_MAX_WAIT, workflow_id=row['workflow_id'],
+                        on_phase=job_ledger.phase_recorder(ledger_id),
+                        # Initiated but never executed: execute it now with the stored inputs
+                        inputs=context['inputs'] if row['status'] == 'initiated' else None)
+            except OpusTimeoutError as e:
+                job_ledger.update(ledger_id, status='timeout', error=str(e))
+                raise
+            except Exception as e:
+                job_ledger.update(ledger_id, status='failed', error=str(e))
+                raise
+            job_ledger.update(ledger_id, status='completed', result=result)
+        persist_ledger_job(row, result)
+        logger.info(f'✅ Resumed job {ledger_id} persisted')
+    except Exception as e:
+        logger.error(f'❌ Failed to resume job {ledger_id}: {e}')
+
+
+def resume_orphaned_jobs():
+    """Claim Opus jobs left behind by dead processes and finish them in the background"""
+    rows = job_ledger.claim_orphans(JOB_STALE_SECONDS, JOB_RESUME_WINDOW)
+    for row in rows:
+        threading.Thread(target=resume_ledger_job, args=(row,), daemon=True).start()
+    return len(rows)
+
+
+def start_job_resumer():
+    """Look for orphaned Opus jobs now and every JOB_STALE_SECONDS until draining"""
+    if not JOB_RESUME:
+        return
+    
+    def loop():
+        while not draining.is_set():
+            try:
+                resume_orphaned_jobs()
+            except Exception as e:
+                logger.error(f'❌ Opus job resume scan failed: {e}')
+            draining.wait(JOB_STALE_SECONDS)
+    
+    threading.Thread(target=loop, daemon=True, name='opus-job-resumer').start()
+
+
+metrics.registry.gauge('mindcraftr_opus_jobs_in_flight', 'Opus jobs currently running',
+                       function=active_job_count)
+# Already server-wide under gunicorn, so every worker reports the same count
+metrics.registry.gauge('mindcraftr_opus_slots_in_use', 'Opus scheduler slots in use',
+                       function=opus_scheduler.running, merge='max')
+for _field in ('hits', 'misses', 'evictions', 'invalidations', 'entries', 'bytes'):
+    metrics.registry.gauge(f'mindcraftr_response_cache_{_field}', f'Response cache {_field}',
+                           function=lambda field=_field: response_cache.stats()[field])
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus text exposition of request, SQLite, JSON and Opus metrics.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    """
+    Liveness probe: the process is up and serving requests.
+    """
+    return jsonify({
+        "status": "alive",
+        "pid": os.getpid(),
+        "activeOpusJobs": active_job_count()
+    })
+
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    """
+    Readiness probe: fails while draining for shutdown or if the database is unreachable.
+    """
+    if draining.is_set():
+        return jsonify({"status": "draining", "activeOpusJobs": active_job_count()}), 503
+    try:
+        connections = [get_db_connection()]
+        if database.SHARD_COUNT > 1:
+            connections += [database.get_shard_connection(index) for index in range(database.SHARD_COUNT)]
+        for conn in connections:
+            conn.execute('SELECT 1')
+            conn.close()
+    except Exception as e:
+        logger.error(f'❌ Readiness check failed: {e}')
+        return jsonify({"status": "unavailable", "message": str(e)}), 503
+    return jsonify({"status": "ready"})
+
+
 @app.errorhandler(Exception)
 def handle_error(error):
     """
@@ -796,8 +2135,14 @@ def handle_error(error):
 
 
 if __name__ == '__main__':
+    # Development server only; production runs `gunicorn -c gunicorn.conf.py server:app`
     logger.info('🚀 Starting MindCraftr API server...')
     logger.info('📍 Server will run on http://localhost:5001')
     logger.info('🔓 CORS is enabled for all origins')
+    # The debug reloader runs this file twice; only its serving child resumes jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_job_resumer()
+        start_histogram_flusher()
+        start_archiver()
     app.run(debug=True, port=5002, host='0.0.0.0')
 
@@ -0,0 +1,213 @@
+"""
+Move per-user data between shard layouts.
+
+Run with the server stopped. Rows of the sharded tables are copied from the
+current layout into freshly built shard files for the new one, routed by
+user id, and the new files are swapped in at the end; old shard files are
+kept as *.bak. Going from a single file to shards leaves the original rows
+in the main database unless --prune is given. Archived tests (archive.py)
+move to the archive files of their users' new shards the same way.
+
+    python shards.py status --shards 4
+    python shards.py migrate --from 1 --to 4            # split mindcraftr.db
+    MINDCRAFTR_DB_SHARDS=4 python server.py
+
+    python shards.py migrate --from 4 --to 8            # rebalance
+"""
+
+import argparse
+import os
+import sqlite3
+
+import archive
+import database
+from database import DATABASE_NAME, SHARDED_TABLES, create_tables, shard_for, shard_paths
+
+
+def _connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _columns(conn, table):
+    return {row[1]: row[2] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _add_missing_columns(src_columns, dst, table):
+    # Columns some databases gained later through ALTER TABLE
+    existing = _columns(dst, table)
+    for name, type_ in src_columns.items():
+        if name not in existing:
+            dst.execute(f'ALTER TABLE {table} ADD COLUMN {name} {type_}')
+
+
+def status(shards):
+    """Print row counts and user counts per shard and table"""
+    for index, path in enumerate(shard_paths(shards)):
+        if not os.path.exists(path):
+            print(f"shard {index}: {path} (missing)")
+            continue
+        conn = _connect(path)
+        print(f"shard {index}: {path}")
+        for table in SHARDED_TABLES:
+            if not _columns(conn, table):
+                continue
+            rows, users = conn.execute(f'SELECT COUNT(*), COUNT(DISTINCT user_id) FROM {table}').fetchone()
+            print(f"  {table:<20} {rows:>8} rows  {users:>6} users")
+        conn.close()
+
+
+def _migrate_archives(sources, targets, to_shards):
+    """Route archived tests into archive files next to the new shards; returns the number moved"""
+    staged = {}
+    for path in targets:
+        target = archive.archive_path(path)
+        if path == DATABASE_NAME:
+            conn = archive._connect_archive(target)
+            conn.execute('DELETE FROM archived_tests')
+        else:
+            if os.path.exists(f"{target}.migrating"):
+                os.remove(f"{target}.migrating")
+            conn = archive._connect_archive(f"{target}.migrating")
+        staged[path] = conn
+    outputs = [staged[path] for path in targets]
+
+    moved = 0
+    for path in sources:
+        if not os.path.exists(archive.archive_path(path)):
+            continue
+        src = _connect(archive.archive_path(path))
+        for row in src.execute('SELECT test_id, user_id, created_at, archived_at, test_data FROM archived_tests'):
+            outputs[shard_for(row['user_id'], to_shards)].execute(
+                'INSERT OR REPLACE INTO archived_tests (test_id, user_id, created_at, archived_at, test_data) '
+                'VALUES (?, ?, ?, ?, ?)', tuple(row))
+            moved += 1
+        src.close()
+
+    for conn in outputs:
+        conn.commit()
+        conn.close()
+    for path in sources:
+        if path != DATABASE_NAME and os.path.exists(archive.archive_path(path)):
+            os.replace(archive.archive_path(path), f"{archive.archive_path(path)}.bak")
+    for path in targets:
+        if path != DATABASE_NAME:
+            os.replace(f"{archive.archive_path(path)}.migrating", archive.archive_path(path))
+    return moved
+
+
+def migrate(from_shards, to_shards, prune=False):
+    """Copy every user's rows from the from_shards layout into a to_shards layout"""
+    if from_shards == to_shards:
+        print('Nothing to do: layouts are the same')
+        return
+    sources = shard_paths(from_shards)
+    targets = shard_paths(to_shards)
+    missing = [path for path in sources if not os.path.exists(path)]
+    if missing:
+        raise SystemExit(f"❌ Missing source shard files: {', '.join(missing)}")
+
+    # Build new shard files next to the old ones; the main database is written in place
+    staged = {}
+    for path in targets:
+        if path == DATABASE_NAME:
+            conn = _connect(path)
+            for table in SHARDED_TABLES:
+                if _columns(conn, table):
+                    conn.execute(f'DELETE FROM {table}')
+        else:
+            staging = f"{path}.migrating"
+            if os.path.exists(staging):
+                os.remove(staging)
+            conn = _connect(staging)
+            # Lets archive.py reclaim space without a full VACUUM
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            create_tables(conn)
+        staged[path] = conn
+    outputs = [staged[path] for path in targets]
+
+    copied, renumbered = {}, 0
+    for path in sources:
+        src = _connect(path)
+        for table in SHARDED_TABLES:
+            columns = _columns(src, table)
+            if not columns:
+                continue
+            for dst in outputs:
+                _add_missing_columns(columns, dst, table)
+            names = list(columns)
+            without_id = [name for name in names if name != 'id']
+            for row in src.execute(f'SELECT * FROM {table}'):
+                dst = outputs[shard_for(row['user_id'], to_shards)]
+                try:
+                    dst.execute(f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                                tuple(row))
+                except sqlite3.IntegrityError:
+                    if 'id' not in columns:
+                        raise
+                    # Two source shards used the same id; let the new shard assign one
+                    dst.execute(f"INSERT INTO {table} ({', '.join(without_id)}) "
+                                f"VALUES ({', '.join('?' * len(without_id))})",
+                                tuple(row[name] for name in without_id))
+                    renumbered += 1
+                copied[table] = copied.get(table, 0) + 1
+        src.close()
+
+    for conn in outputs:
+        conn.commit()
+        conn.close()
+
+    # Swap the new files in, keeping the old shards as backups
+    for path in sources:
+        if path != DATABASE_NAME:
+            os.replace(path, f"{path}.bak")
+    for path in targets:
+        if path != DATABASE_NAME:
+            os.replace(f"{path}.migrating", path)
+
+    archived = _migrate_archives(sources, targets, to_shards)
+
+    if DATABASE_NAME in sources and DATABASE_NAME not in targets:
+        if prune:
+            conn = _connect(DATABASE_NAME)
+            for table in SHARDED_TABLES:
+                if _columns(conn, table):
+                    conn.execute(f'DELETE FROM {table}')
+            conn.commit()
+            conn.close()
+            if os.path.exists(archive.archive_path(DATABASE_NAME)):
+                os.remove(archive.archive_path(DATABASE_NAME))
+        else:
+            print(f"ℹ️  Original rows left in {DATABASE_NAME}; rerun with --prune once the shards are verified")
+
+    for table, count in copied.items():
+        print(f"  {table:<20} {count:>8} rows")
+    if archived:
+        print(f"  {'archived_tests':<20} {archived:>8} rows")
+    if renumbered:
+        print(f"⚠️  {renumbered} rows got new ids because of collisions between source shards")
+    print(f"✅ Migrated {from_shards} → {to_shards} shard(s); start the server with MINDCRAFTR_DB_SHARDS={to_shards}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and migrate MindCraftr database shards')
+    commands = parser.add_subparsers(dest='command', required=True)
+    show = commands.add_parser('status', help='Row counts per shard')
+    show.add_argument('--shards', type=int, default=database.SHARD_COUNT)
+    move = commands.add_parser('migrate', help='Move data to a different number of shards')
+    move.add_argument('--from', dest='from_shards', type=int, default=database.SHARD_COUNT,
+                      help='Current shard count (default: MINDCRAFTR_DB_SHARDS)')
+    move.add_argument('--to', dest='to_shards', type=int, required=True, help='New shard count')
+    move.add_argument('--prune', action='store_true',
+                      help='Delete the migrated rows from the main database when splitting it')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        status(max(1, args.shards))
+    else:
+        migrate(max(1, args.from_shards), max(1, args.to_shards), prune=args.prune)
+
+
+if __name__ == '__main__':
+    main()
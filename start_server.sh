@@ -30,6 +30,13 @@ if [ ! -f "mindcraftr.db" ]; then
     echo ""
 fi
 
+# Production mode: preforked gunicorn workers (see gunicorn.conf.py)
+if [ "$MINDCRAFTR_ENV" = "production" ]; then
+    echo "🏭 Starting production server (gunicorn) on ${MINDCRAFTR_BIND:-0.0.0.0:5001}"
+    echo ""
+    exec gunicorn -c gunicorn.conf.py server:app
+fi
+
 # Start the server
 echo "🌐 Starting Flask server on http://localhost:5001"
 echo "📊 Server logs will appear below..."
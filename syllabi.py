@@ -0,0 +1,256 @@
+"""
+Uploaded syllabi.
+
+POST /api/v1/syllabi streams a syllabus to disk in READ_BYTES pieces,
+hashing it on the way, so a large upload is never held in memory whole.
+Files are stored once per SHA-256 under SYLLABUS_DIR (the same text uploaded
+by several users shares one file and one syllabi row); each user keeps a
+reference in user_syllabi, in their shard.
+
+When a syllabus is first stored its text is split into chunks of at most
+CHUNK_CHARS at paragraph boundaries, and each chunk is condensed to its
+headings and leading sentences so the whole prompt stays within
+PROMPT_CHARS. Generation requests that send a syllabusId get that stored
+prompt, so the Opus payload is bounded and the file is never re-read.
+Syllabi shorter than PROMPT_CHARS are sent verbatim.
+
+    MINDCRAFTR_SYLLABUS_DIR           where files are kept (default "syllabi")
+    MINDCRAFTR_SYLLABUS_MAX_BYTES     largest upload (default 5 MiB)
+    MINDCRAFTR_SYLLABUS_PROMPT_CHARS  largest prompt sent to Opus (default 8000)
+    MINDCRAFTR_SYLLABUS_CHUNK_CHARS   chunk size (default 4000)
+"""
+
+import codecs
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+import database
+
+SYLLABUS_DIR = os.environ.get('MINDCRAFTR_SYLLABUS_DIR', 'syllabi')
+MAX_BYTES = int(os.environ.get('MINDCRAFTR_SYLLABUS_MAX_BYTES', 5 * 1024 * 1024))
+PROMPT_CHARS = int(os.environ.get('MINDCRAFTR_SYLLABUS_PROMPT_CHARS', 8000))
+CHUNK_CHARS = int(os.environ.get('MINDCRAFTR_SYLLABUS_CHUNK_CHARS', 4000))
+
+READ_BYTES = 64 * 1024
+PROMPT_CACHE_SIZE = 128
+
+_HEADING = re.compile(r'^\s*(#+\s|\d+(\.\d+)*[.)]?\s|[A-Z][A-Z0-9 &/,-]{3,}$|.{1,80}:$)')
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s')
+
+_prompts = OrderedDict()
+_prompts_lock = threading.Lock()
+
+
+class SyllabusTooLarge(ValueError):
+    pass
+
+
+class UnknownSyllabus(LookupError):
+    pass
+
+
+def file_path(syllabus_id):
+    return os.path.join(SYLLABUS_DIR, syllabus_id[:2], f"{syllabus_id}.txt")
+
+
+def _connect():
+    conn = database.get_db_connection()
+    database.ensure_table(conn, database.create_syllabi_tables)
+    return conn
+
+
+def _connect_user(user_id):
+    conn = database.get_db_connection(user_id)
+    database.ensure_table(conn, database.create_user_syllabi_table)
+    return conn
+
+
+def _spool(stream, max_bytes):
+    """Copy stream to a temporary file in SYLLABUS_DIR; returns (path, sha256 hex, size)"""
+    os.makedirs(SYLLABUS_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    # Validates UTF-8 across chunk boundaries without decoding the whole file at once
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    size = 0
+    fd, path = tempfile.mkstemp(dir=SYLLABUS_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(READ_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise SyllabusTooLarge(f'Syllabus exceeds {max_bytes} bytes')
+                decoder.decode(chunk)
+                digest.update(chunk)
+                out.write(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        os.remove(path)
+        raise ValueError('Syllabus must be UTF-8 text')
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest(), size
+
+
+def split_chunks(text, size=CHUNK_CHARS):
+    """Split text into (offset, chunk) pieces of at most size chars, preferring paragraph and line breaks"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            for separator in ('\n\n', '\n', ' '):
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        if text[start:end].strip():
+            chunks.append((start, text[start:end]))
+        start = end
+    return chunks
+
+
+def condense(chunk, budget):
+    """Headings and each paragraph's first sentence from a chunk, cut to budget chars"""
+    lines = []
+    for paragraph in re.split(r'\n\s*\n', chunk):
+        for line in paragraph.strip().splitlines():
+            if _HEADING.match(line):
+                lines.append(line.strip())
+        first = _SENTENCE_END.split(' '.join(paragraph.split()), 1)[0]
+        if first and first not in lines:
+            lines.append(first)
+    condensed = ''
+    for line in lines:
+        if len(condensed) + len(line) + 1 > budget:
+            break
+        condensed += line + '\n'
+    return condensed.strip() or chunk.strip()[:budget]
+
+
+def _prepare(text):
+    """(prompt, [(offset, length, summary), ...]) for a syllabus text"""
+    pieces = split_chunks(text)
+    if len(text) <= PROMPT_CHARS:
+        return text.strip(), [(offset, len(piece), piece.strip()) for offset, piece in pieces]
+    budget = max(1, PROMPT_CHARS // max(1, len(pieces)) - 2)
+    chunks = [(offset, len(piece), condense(piece, budget)) for offset, piece in pieces]
+    return '\n\n'.join(summary for _, _, summary in chunks)[:PROMPT_CHARS], chunks
+
+
+def _describe(row, name=None, uploaded_at=None):
+    return {
+        "id": row['id'],
+        "name": name,
+        "sizeBytes": row['size_bytes'],
+        "chunks": row['chunk_count'],
+        "promptChars": len(row['prompt']),
+        "uploadedAt": uploaded_at
+    }
+
+
+def store(stream, user_id, name=None, max_bytes=MAX_BYTES):
+    """
+    Save an uploaded syllabus for user_id. Returns (description, created),
+    where created is False if the user already had this exact syllabus.
+    Raises SyllabusTooLarge or ValueError (not UTF-8 text, or empty).
+    """
+    path, syllabus_id, size = _spool(stream, max_bytes)
+    if size == 0:
+        os.remove(path)
+        raise ValueError('Syllabus is empty')
+    target = file_path(syllabus_id)
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    conn = _connect()
+    row = conn.execute('SELECT * FROM syllabi WHERE id = ?', (syllabus_id,)).fetchone()
+    if row is None:
+        with open(target, encoding='utf-8') as f:
+            prompt, chunks = _prepare(f.read())
+        conn.execute('INSERT OR IGNORE INTO syllabi (id, size_bytes, chunk_count, prompt) VALUES (?, ?, ?, ?)',
+                     (syllabus_id, size, len(chunks), prompt))
+        conn.executemany('''
+            INSERT OR IGNORE INTO syllabus_chunks (syllabus_id, position, char_offset, char_length, summary)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(syllabus_id, position, *chunk) for position, chunk in enumerate(chunks)])
+        conn.commit()
+        row = conn.execute('SELECT * FROM syllabi WHERE id = ?', (syllabus_id,)).fetchone()
+    conn.close()
+
+    conn = _connect_user(user_id)
+    cursor = conn.execute('INSERT OR IGNORE INTO user_syllabi (user_id, syllabus_id, name) VALUES (?, ?, ?)',
+                          (user_id, syllabus_id, name))
+    conn.commit()
+    ref = conn.execute('SELECT name, uploaded_at FROM user_syllabi WHERE user_id = ? AND syllabus_id = ?',
+                       (user_id, syllabus_id)).fetchone()
+    conn.close()
+    return _describe(row, ref['name'], ref['uploaded_at']), cursor.rowcount == 1
+
+
+def _owned(user_id, syllabus_id):
+    conn = _connect_user(user_id)
+    ref = conn.execute('SELECT name, uploaded_at FROM user_syllabi WHERE user_id = ? AND syllabus_id = ?',
+                       (user_id, syllabus_id)).fetchone()
+    conn.close()
+    if ref is None:
+        raise UnknownSyllabus(f'No syllabus {syllabus_id}')
+    return ref
+
+
+def prompt_for(syllabus_id, user_id):
+    """The bounded syllabus text sent to Opus; raises UnknownSyllabus if user_id never uploaded it"""
+    _owned(user_id, syllabus_id)
+    # Content-addressed, so a cached prompt never goes stale
+    with _prompts_lock:
+        if syllabus_id in _prompts:
+            _prompts.move_to_end(syllabus_id)
+            return _prompts[syllabus_id]
+    conn = _connect()
+    row = conn.execute('SELECT prompt FROM syllabi WHERE id = ?', (syllabus_id,)).fetchone()
+    conn.close()
+    if row is None:
+        raise UnknownSyllabus(f'No syllabus {syllabus_id}')
+    with _prompts_lock:
+        _prompts[syllabus_id] = row['prompt']
+        if len(_prompts) > PROMPT_CACHE_SIZE:
+            _prompts.popitem(last=False)
+    return row['prompt']
+
+
+def describe(syllabus_id, user_id):
+    """A user's syllabus with its prompt; raises UnknownSyllabus"""
+    ref = _owned(user_id, syllabus_id)
+    conn = _connect()
+    row = conn.execute('SELECT * FROM syllabi WHERE id = ?', (syllabus_id,)).fetchone()
+    conn.close()
+    if row is None:
+        raise UnknownSyllabus(f'No syllabus {syllabus_id}')
+    return dict(_describe(row, ref['name'], ref['uploaded_at']), prompt=row['prompt'])
+
+
+def list_for(user_id):
+    """Every syllabus user_id uploaded, newest first"""
+    conn = _connect_user(user_id)
+    refs = conn.execute('SELECT syllabus_id, name, uploaded_at FROM user_syllabi WHERE user_id = ? '
+                        'ORDER BY uploaded_at DESC', (user_id,)).fetchall()
+    conn.close()
+    if not refs:
+        return []
+    conn = _connect()
+    rows = {row['id']: row for row in conn.execute(
+        f"SELECT * FROM syllabi WHERE id IN ({', '.join('?' * len(refs))})",
+        [ref['syllabus_id'] for ref in refs])}
+    conn.close()
+    return [_describe(rows[ref['syllabus_id']], ref['name'], ref['uploaded_at'])
+            for ref in refs if ref['syllabus_id'] in rows]
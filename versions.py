@@ -0,0 +1,86 @@
+"""Per-user resource version counters used for conditional GETs"""
+
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+# Each shared slot holds (version, last_modified_unix_seconds)
+_SLOT = struct.Struct('<qq')
+
+
+class ResourceVersions:
+    """
+    Tracks a version number and last-modified time for each (user, resource).
+
+    Write paths call bump() after committing; read paths derive an ETag from
+    the current version. Counters live in process memory, so every ETag is
+    prefixed with a per-process epoch to keep tags from a previous run from
+    ever matching.
+
+    Under a preforking server, call use_shared_memory() in the master before
+    workers fork so a write handled by one worker is seen by all of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._shared = None
+        self._slots = 0
+        self._started = datetime.fromtimestamp(int(time.time()), tz=timezone.utc)
+        self.epoch = f"{os.getpid():x}{int(time.time() * 1000):x}"
+
+    def use_shared_memory(self, slots=65536):
+        """
+        Move counters into an anonymous shared mapping inherited by forked workers.
+
+        (user, resource) pairs are hashed into a fixed number of slots; two
+        pairs sharing a slot only cause an extra cache miss, never a stale hit.
+        """
+        self._shared = mmap.mmap(-1, slots * _SLOT.size)
+        self._slots = slots
+        self._lock = multiprocessing.Lock()
+
+    def _slot_offset(self, user_id, resource):
+        return (zlib.crc32(f"{user_id}:{resource}".encode()) % self._slots) * _SLOT.size
+
+    def get(self, user_id, resource):
+        """Return (version, last_modified) for a user's resource"""
+        if self._shared is not None:
+            version, modified = _SLOT.unpack_from(self._shared, self._slot_offset(user_id, resource))
+            if version == 0:
+                return 0, self._started
+            return version, datetime.fromtimestamp(modified, tz=timezone.utc)
+        with self._lock:
+            return self._versions.get((user_id, resource), (0, self._started))
+
+    def bump(self, user_id, *resources):
+        """Mark resources as changed for a user"""
+        now_ts = int(time.time())
+        now = datetime.fromtimestamp(now_ts, tz=timezone.utc)
+        with self._lock:
+            for resource in resources:
+                if self._shared is not None:
+                    offset = self._slot_offset(user_id, resource)
+                    version, _ = _SLOT.unpack_from(self._shared, offset)
+                    _SLOT.pack_into(self._shared, offset, version + 1, now_ts)
+                    continue
+                version, _ = self._versions.get((user_id, resource), (0, self._started))
+                self._versions[(user_id, resource)] = (version + 1, now)
+
+    def etag(self, user_id, *resources):
+        """Return (etag, last_modified) covering one or more resources"""
+        parts = []
+        last_modified = self._started
+        for resource in resources:
+            version, modified = self.get(user_id, resource)
+            parts.append(f"{resource}.{version}")
+            last_modified = max(last_modified, modified)
+        return f"{self.epoch}-{user_id}-{'-'.join(parts)}", last_modified
+
+
+resource_versions = ResourceVersions()